@@ -239,7 +239,15 @@ def cli():
     metavar="INT",
     help="Maximum read length (estimated from first read if omitted).",
 )
-def iteralign(reads_fq, genome, out_bam, threads, tempdir, aligner, min_len, read_len):
+@click.option(
+    "--persistent-index",
+    is_flag=True,
+    default=False,
+    help="Keep the genome index in memory across alignment rounds.",
+)
+def iteralign(
+    reads_fq, genome, out_bam, threads, tempdir, aligner, min_len, read_len, persistent_index
+):
     """Iteratively align reads to a reference genome.
 
     Truncates reads to 20 bp then iteratively extends and re-aligns unmapped
@@ -258,6 +266,7 @@ def iteralign(reads_fq, genome, out_bam, threads, tempdir, aligner, min_len, rea
             aligner=aligner,
             min_len=min_len,
             read_len=read_len,
+            persistent_index=persistent_index,
         )
     finally:
         shutil.rmtree(temp_directory)
@@ -362,7 +371,16 @@ def digest(fasta, enzyme, outdir, size, circular, plot, figdir, force):
     metavar="INT",
     help="Number of parallel threads.",
 )
-def cutsite(forward, reverse, prefix, enzyme, mode, seed_size, threads):
+@click.option(
+    "-l",
+    "--compress-level",
+    default=6,
+    show_default=True,
+    type=click.IntRange(0, 9),
+    metavar="INT",
+    help="Compression level of the output files, from 0 (none) to 9 (smallest).",
+)
+def cutsite(forward, reverse, prefix, enzyme, mode, seed_size, threads, compress_level):
     """Preprocess FASTQ files by cutting reads at religation sites.
 
     Generates gzipped FASTQ files with reads cut at ligation junctions,
@@ -380,6 +398,7 @@ def cutsite(forward, reverse, prefix, enzyme, mode, seed_size, threads):
         mode=mode,
         seed_size=seed_size,
         n_cpu=threads,
+        compress_level=compress_level,
     )
 
 
@@ -411,7 +430,24 @@ def cutsite(forward, reverse, prefix, enzyme, mode, seed_size, threads):
     metavar="INT-INT",
     help="Manual thresholds as UNCUT-LOOP (e.g. 4-5).",
 )
-def filter(input_pairs, output_pairs, figdir, interactive, plot, prefix, thresholds):
+@click.option(
+    "-T",
+    "--threads",
+    default=1,
+    show_default=True,
+    type=int,
+    metavar="INT",
+    help="Number of parallel processes.",
+)
+@click.option(
+    "-s",
+    "--sample",
+    is_flag=True,
+    help="Estimate thresholds from pairs sampled over the whole file instead of the first ones.",
+)
+def filter(
+    input_pairs, output_pairs, figdir, interactive, plot, prefix, thresholds, threads, sample
+):
     """Filter spurious Hi-C events (loops and uncuts) from a pairs file."""
     if thresholds:
         try:
@@ -432,6 +468,7 @@ def filter(input_pairs, output_pairs, figdir, interactive, plot, prefix, thresho
             plot_events=plot,
             fig_path=figpath,
             prefix=prefix,
+            sample=sample,
         )
     figpath = join(figdir, "event_distribution.pdf") if figdir else None
     hcf.filter_events(
@@ -442,6 +479,7 @@ def filter(input_pairs, output_pairs, figdir, interactive, plot, prefix, thresho
         plot_events=plot,
         fig_path=figpath,
         prefix=prefix,
+        threads=threads,
     )
 
 
@@ -894,6 +932,46 @@ def view(
     default=False,
     help="Skip the read-count check on input FASTQ files.",
 )
+@click.option(
+    "--binary-pairs",
+    is_flag=True,
+    default=False,
+    help="Store intermediate pairs in a binary columnar format.",
+)
+@click.option(
+    "--read-ids",
+    default="keep",
+    show_default=True,
+    metavar="STR",
+    type=click.Choice(["keep", "hash", "drop"]),
+    help="How read names are stored in binary pairs.",
+)
+@click.option(
+    "--max-mismatch",
+    default=0,
+    show_default=True,
+    type=int,
+    metavar="INT",
+    help="Max. bp between positions of PCR duplicates on each side (with -D).",
+)
+@click.option(
+    "--stream-align",
+    is_flag=True,
+    default=False,
+    help="Align both mates concurrently into pairs, without intermediate BAM files.",
+)
+@click.option(
+    "--stream-cutsite",
+    is_flag=True,
+    default=False,
+    help="With --mapping cutsite, stream digested reads to the aligner without intermediate files.",
+)
+@click.option(
+    "--persistent-index",
+    is_flag=True,
+    default=False,
+    help="With --mapping iterative, keep the genome index in memory across alignment rounds.",
+)
 def pipeline(
     input1,
     input2,
@@ -924,6 +1002,12 @@ def pipeline(
     tmpdir,
     zoomify,
     skip_count,
+    binary_pairs,
+    read_ids,
+    max_mismatch,
+    stream_align,
+    stream_cutsite,
+    persistent_index,
 ):
     """Run the full Hi-C pipeline from FASTQ to contact matrix.
 
@@ -962,6 +1046,7 @@ def pipeline(
         no_cleanup=no_cleanup,
         out_dir=outdir,
         pcr_duplicates=duplicates,
+        pcr_max_mismatch=max_mismatch,
         plot=plot,
         prefix=prefix,
         read_len=read_len,
@@ -970,6 +1055,11 @@ def pipeline(
         threads=threads,
         tmp_dir=tmpdir,
         skip_count=skip_count,
+        binary_pairs=binary_pairs,
+        read_ids=read_ids,
+        stream_align=stream_align,
+        stream_cutsite=stream_cutsite,
+        persistent_index=persistent_index,
     )
 
 
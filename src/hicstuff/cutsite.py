@@ -13,24 +13,45 @@ It's the most releveant one for usual workflow. 2. "all": All 2-combinations are
 made. 3. "pile": Only combinations between adjacent fragments in the initial
 reads are made.
 
+Batches of read pairs are cut and compressed in a pool of worker processes.
+Each batch is compressed as independent BGZF blocks, which are gzip members
+holding their own size. A gzip file can hold several members, so the
+compressed batches are written one after the other, in the input order, and
+the output can be read by gzip as well as by htslib based tools.
+
 This module contains the following functions:
     - cut_ligation_sites
     - cutsite_read
     - write_pair
-    - _writer
 """
 
-import gzip
+import collections
+import contextlib
+import functools
+import itertools
 import multiprocessing
+import struct
 import sys
+import zlib
 
 import pyfastx
 
 import hicstuff.digest as hcd
 from hicstuff.log import logger
 
+# Number of read pairs cut at once by a worker
+BATCH_SIZE = 1000
+
+# Maximum uncompressed size of a BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xFF00
+
+# Empty BGZF block marking the end of a file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
 
-def cut_ligation_sites(fq_for, fq_rev, digest_for, digest_rev, enzyme, mode, seed_size, n_cpu):
+
+def cut_ligation_sites(
+    fq_for, fq_rev, digest_for, digest_rev, enzyme, mode, seed_size, n_cpu, compress_level=6
+):
     """Create new reads to manage pairs with a digestion and create multiple
     pairs to take into account all the contact present.
 
@@ -63,41 +84,66 @@ def cut_ligation_sites(fq_for, fq_rev, digest_for, digest_rev, enzyme, mode, see
         smaller won't be mapped.)
     n_cpu : int
         Number of CPUs.
+    compress_level : int or None
+        Compression level of the output files, from 0 (no compression) to 9
+        (smallest files). If None, plain fastq is written, e.g. to a named
+        pipe read by an aligner.
     """
     # Process the ligation sites given
-    ligation_sites = hcd.gen_enzyme_religation_regex(enzyme)
-
-    # Defined stop_token which is used to mark the end of input file
-    stop_token = "STOP"
-    # A stack is a string cointaining multiple read pairs
-    max_stack_size = 1000
+    ligation_sites = hcd.gen_ligation_matcher(enzyme)
 
     # Create count to have an idea of the digested pairs repartition.
     original_number_of_pairs = 0
     final_number_of_pairs = 0
-    new_reads_for = ""
-    new_reads_rev = ""
-    current_stack = 0
-
-    # Start parallel threading to compute the
-    # ctx = multiprocessing.get_context("spawn")
-    queue = multiprocessing.Queue(max(1, n_cpu - 1))
-    writer_process = multiprocessing.Process(
-        target=_writer, args=(digest_for, digest_rev, queue, stop_token)
+
+    cut_batch = functools.partial(
+        _cut_batch,
+        ligation_sites=ligation_sites,
+        mode=mode,
+        seed_size=seed_size,
+        compress_level=compress_level,
     )
-    writer_process.start()
+    # The main process reads and writes, the other ones cut reads
+    n_workers = max(1, n_cpu - 1)
+    with contextlib.ExitStack() as stack:
+        for_fq = stack.enter_context(open(digest_for, "wb"))
+        rev_fq = stack.enter_context(open(digest_rev, "wb"))
+        pool = stack.enter_context(multiprocessing.Pool(n_workers)) if n_cpu > 1 else None
+        # Results are collected in the order of batches. The number of
+        # pending batches is bounded to limit memory usage.
+        pending = collections.deque()
+        for batch in _read_batches(fq_for, fq_rev, BATCH_SIZE):
+            original_number_of_pairs += len(batch)
+            if pool is None:
+                pending.append(cut_batch(batch))
+            else:
+                pending.append(pool.apply_async(cut_batch, (batch,)))
+            while pending and (pool is None or len(pending) > 2 * n_workers):
+                final_number_of_pairs += _write_batch(pending.popleft(), for_fq, rev_fq)
+        while pending:
+            final_number_of_pairs += _write_batch(pending.popleft(), for_fq, rev_fq)
+        if compress_level is not None:
+            for_fq.write(BGZF_EOF)
+            rev_fq.write(BGZF_EOF)
 
+    # Return information on the different pairs created
+    logger.info(f"Library used: {fq_for} - {fq_rev}")
+    logger.info(f"Number of pairs before digestion: {original_number_of_pairs}")
+    logger.info(f"Number of pairs after digestion: {final_number_of_pairs}")
+
+
+def _read_batches(fq_for, fq_rev, batch_size):
+    """
+    Iterate over batches of read pairs from two fastq files, as lists of
+    (name, forward sequence, forward quality, reverse sequence, reverse
+    quality) tuples.
+    """
+    batch = []
     # Iterate on all pairs
     for read_for, read_rev in zip(
         pyfastx.Fastq(fq_for, build_index=False),
         pyfastx.Fastq(fq_rev, build_index=False),
     ):
-        # Count the numbers of original reads processed.
-        original_number_of_pairs += 1
-
-        # Count for stack size.
-        current_stack += 1
-
         # Extract components of the reads.
         for_name, for_seq, for_qual = read_for
         rev_name, rev_seq, rev_qual = read_rev
@@ -106,55 +152,104 @@ def cut_ligation_sites(fq_for, fq_rev, digest_for, digest_rev, enzyme, mode, see
         if for_name != rev_name:
             logger.error(f"The fastq files contains reads not sorted :\n{for_name}\n{rev_name}")
             sys.exit(1)
+        batch.append((for_name, for_seq, for_qual, rev_seq, rev_qual))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
+
+def _cut_batch(batch, ligation_sites, mode, seed_size, compress_level=6):
+    """
+    Cut a batch of read pairs from _read_batches at ligation sites. Returns
+    the new forward and reverse reads, each compressed as BGZF blocks
+    unless compress_level is None, and the number of new pairs.
+    """
+    new_reads_for = []
+    new_reads_rev = []
+    n_pairs = 0
+    for name, for_seq, for_qual, rev_seq, rev_qual in batch:
         # Cut the forward and reverse reads at the ligation sites.
-        for_seq_list, for_qual_list = cutsite_read(
-            ligation_sites,
-            for_seq,
-            for_qual,
-            seed_size,
-        )
-        rev_seq_list, rev_qual_list = cutsite_read(
-            ligation_sites,
-            rev_seq,
-            rev_qual,
-            seed_size,
-        )
+        for_seq_list, for_qual_list = cutsite_read(ligation_sites, for_seq, for_qual, seed_size)
+        rev_seq_list, rev_qual_list = cutsite_read(ligation_sites, rev_seq, rev_qual, seed_size)
 
         # Write the new combinations of fragments.
-        new_reads_for, new_reads_rev, final_number_of_pairs = write_pair(
+        new_reads_for, new_reads_rev, n_pairs = write_pair(
             new_reads_for,
             new_reads_rev,
-            for_name,
+            name,
             for_seq_list,
             for_qual_list,
             rev_seq_list,
             rev_qual_list,
             mode,
-            final_number_of_pairs,
+            n_pairs,
         )
+    if compress_level is None:
+        return b"".join(new_reads_for), b"".join(new_reads_rev), n_pairs
+    return (
+        _bgzf_compress(b"".join(new_reads_for), compress_level),
+        _bgzf_compress(b"".join(new_reads_rev), compress_level),
+        n_pairs,
+    )
 
-        # If stack full, add it in the queue.
-        if current_stack == max_stack_size:
-            # Add the pair in the queue.
-            pairs = (new_reads_for.encode(), new_reads_rev.encode())
-            queue.put(pairs)
 
-            # Empty the stack
-            current_stack = 0
-            new_reads_for = ""
-            new_reads_rev = ""
+def _bgzf_compress(data, level=6):
+    """
+    Compress data as a series of BGZF blocks. Each block is a gzip member
+    with an extra field giving its compressed size, so that blocks can be
+    decompressed independently. The end of file marker is not included.
 
-    # End the parallel processing.
-    pairs = (new_reads_for.encode(), new_reads_rev.encode())
-    queue.put(pairs)
-    queue.put(stop_token)
-    writer_process.join()
+    Examples
+    --------
+    >>> import gzip
+    >>> blocks = _bgzf_compress(b"ACGT" * 50000)
+    >>> blocks[:4] == BGZF_EOF[:4]
+    True
+    >>> gzip.decompress(blocks + BGZF_EOF) == b"ACGT" * 50000
+    True
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start : start + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        # Header with the BC extra field, holding the block size minus one
+        blocks.append(
+            struct.pack(
+                "<4BI2BH2BHH",
+                0x1F,
+                0x8B,
+                8,
+                4,
+                0,
+                0,
+                0xFF,
+                6,
+                ord("B"),
+                ord("C"),
+                2,
+                len(deflated) + 25,
+            )
+        )
+        blocks.append(deflated)
+        blocks.append(struct.pack("<2I", zlib.crc32(chunk), len(chunk)))
+    return b"".join(blocks)
 
-    # Return information on the different pairs created
-    logger.info(f"Library used: {fq_for} - {fq_rev}")
-    logger.info(f"Number of pairs before digestion: {original_number_of_pairs}")
-    logger.info(f"Number of pairs after digestion: {final_number_of_pairs}")
+
+def _write_batch(result, for_fq, rev_fq):
+    """
+    Write a batch cut by _cut_batch, given directly or as a pending
+    multiprocessing result, to the open output files. Returns the number of
+    pairs written.
+    """
+    if not isinstance(result, tuple):
+        result = result.get()
+    new_reads_for, new_reads_rev, n_pairs = result
+    for_fq.write(new_reads_for)
+    rev_fq.write(new_reads_rev)
+    return n_pairs
 
 
 def cutsite_read(ligation_sites, seq, qual, seed_size=0):
@@ -164,7 +259,8 @@ def cutsite_read(ligation_sites, seq, qual, seed_size=0):
     Parameters:
     -----------
     ligation_sites : re.Pattern
-        Regex of all possible ligations according to the given enzymes.
+        Regex of all possible ligations according to the given enzymes, as
+        made by hicstuff.digest.gen_ligation_matcher.
     seq : str
         Sequence where to search for ligation_sites.
     qual : str
@@ -183,14 +279,12 @@ def cutsite_read(ligation_sites, seq, qual, seed_size=0):
 
     Examples:
     ---------
-    >>> cutsite_read(re.compile(r'GA.TA.TC'), "AAGAGTATTC", "FFF--FAFAF")
+    >>> cutsite_read(hcd.gen_ligation_matcher("HinfI"), "AAGAGTATTC", "FFF--FAFAF")
     (['AAGAGT', 'ATTC'], ['FFF--F', 'AFAF'])
     """
 
-    # Find the ligation sites.
-    ligation_sites_list = []
-    if ligation_sites.search(seq):
-        ligation_sites_list = [site.start() for site in ligation_sites.finditer(seq)]
+    # Find the ligation sites, in a single pass.
+    ligation_sites_list = [site.start() for site in ligation_sites.finditer(seq)]
     ligation_sites_list.append(len(seq))
 
     # Split the sequences on the ligation sites.
@@ -222,10 +316,12 @@ def write_pair(
 
     Parameters:
     -----------
-    new_reads_for : str
-        Stack of the new forward reads ready to be written.
-    new_reads_rev : str
-        Stack of the new reverse reads ready to be written.
+    new_reads_for : list of bytes
+        Stack of the new forward fastq records ready to be written, extended
+        inplace.
+    new_reads_rev : list of bytes
+        Stack of the new reverse fastq records ready to be written, extended
+        inplace.
     name : str
         Name of the fastq read.
     for_seq_list : list
@@ -244,126 +340,60 @@ def write_pair(
 
     Returns:
     --------
-    str
-        Stack of forward reads ready to be written with the last pairs added.
-    str
-        Stack of reverse reads ready to be written with the last pairs added.
+    list of bytes
+        Stack of forward records ready to be written with the last pairs added.
+    list of bytes
+        Stack of reverse records ready to be written with the last pairs added.
     int
         Count of pairs after cutting.
-    """
 
+    Examples:
+    ---------
+    >>> new_for, new_rev, n = write_pair([], [], "r", ["AC"], ["FF"], ["GT"], ["F-"], "all", 0)
+    >>> b"".join(new_for)
+    b'@r:01\\nAC\\n+\\nFF\\n'
+    >>> b"".join(new_rev)
+    b'@r:01\\nGT\\n+\\nF-\\n'
+    """
     # Mode "for_vs_rev": Make contacts only between fragments from different
     # reads (one fragment from forward and one from reverse).
     if mode == "for_vs_rev":
-        for i in range(len(for_seq_list)):
-            for j in range(len(rev_seq_list)):
-                final_number_of_pairs += 1
-                new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(j),
-                    for_seq_list[i],
-                    for_qual_list[i],
-                )
-                new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(j),
-                    rev_seq_list[j],
-                    rev_qual_list[j],
-                )
-
-    #  Mode "all": Make all the possible contacts between the fragments.
-    elif mode == "all":
-        seq_list = for_seq_list + rev_seq_list
-        qual_list = for_qual_list + rev_qual_list
-        for i in range(len(seq_list)):
-            for j in range(i + 1, len(seq_list)):
-                final_number_of_pairs += 1
-                if i < len(for_seq_list):
-                    new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                        name + ":" + str(i) + str(j),
-                        seq_list[i],
-                        qual_list[i],
-                    )
-                # Reverse the forward read if comes from reverse.
-                else:
-                    new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                        name + ":" + str(i) + str(j),
-                        seq_list[i][::-1],
-                        qual_list[i][::-1],
-                    )
-                # Reverse the reverse read if comes from forward.
-                if j < len(for_seq_list):
-                    new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                        name + ":" + str(i) + str(j),
-                        seq_list[j][::-1],
-                        qual_list[j][::-1],
-                    )
-                else:
-                    new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                        name + ":" + str(i) + str(j),
-                        seq_list[j],
-                        qual_list[j],
-                    )
-
-    # Mode "pile": Only make contacts bewteen two adjacent fragments.
-    elif mode == "pile":
+        as_for = [_fastq_body(seq, qual) for seq, qual in zip(for_seq_list, for_qual_list)]
+        as_rev = [_fastq_body(seq, qual) for seq, qual in zip(rev_seq_list, rev_qual_list)]
+        combinations = itertools.product(range(len(as_for)), range(len(as_rev)))
+    elif mode in ("all", "pile"):
         seq_list = for_seq_list + rev_seq_list
         qual_list = for_qual_list + rev_qual_list
-        for i in range(len(seq_list) - 1):
-            final_number_of_pairs += 1
-            if i < len(for_seq_list) - 1:
-                new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i],
-                    qual_list[i],
-                )
-                new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i + 1][::-1],
-                    qual_list[i + 1][::-1],
-                )
-            elif i == len(for_seq_list) - 1:
-                new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i],
-                    qual_list[i],
-                )
-                new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i + 1],
-                    qual_list[i + 1],
-                )
-            else:
-                new_reads_for += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i][::-1],
-                    qual_list[i][::-1],
-                )
-                new_reads_rev += "@{}\n{}\n+\n{}\n".format(
-                    name + ":" + str(i) + str(i + 1),
-                    seq_list[i + 1],
-                    qual_list[i + 1],
-                )
+        n_for = len(for_seq_list)
+        # Reverse the forward read if comes from reverse, and the reverse
+        # read if comes from forward. Each fragment is encoded once.
+        as_for = [
+            _fastq_body(seq, qual) if k < n_for else _fastq_body(seq[::-1], qual[::-1])
+            for k, (seq, qual) in enumerate(zip(seq_list, qual_list))
+        ]
+        as_rev = [
+            _fastq_body(seq[::-1], qual[::-1]) if k < n_for else _fastq_body(seq, qual)
+            for k, (seq, qual) in enumerate(zip(seq_list, qual_list))
+        ]
+        #  Mode "all": Make all the possible contacts between the fragments.
+        if mode == "all":
+            combinations = itertools.combinations(range(len(seq_list)), 2)
+        # Mode "pile": Only make contacts bewteen two adjacent fragments.
+        else:
+            combinations = ((i, i + 1) for i in range(len(seq_list) - 1))
+    else:
+        combinations = ()
+
+    name = name.encode()
+    for i, j in combinations:
+        final_number_of_pairs += 1
+        header = b"@%s:%d%d" % (name, i, j)
+        new_reads_for.append(header + as_for[i])
+        new_reads_rev.append(header + as_rev[j])
 
     return new_reads_for, new_reads_rev, final_number_of_pairs
 
 
-def _writer(output_for, output_rev, queue, stop_token):
-    """Function to write the pair throw parallel processing.
-
-    Parameters:
-    -----------
-    output_for : str
-        Path to the output forward compressed fastq file.
-    output_rev : str
-        Path to the output reverse compressed fastq file.
-    queue : multiprocessing.queues.Queue
-        Queue for the multiprocesing of the whole file.
-    stop_token : str
-        Token to signal that the end of the file have been reached.
-    """
-    with gzip.open(output_for, "wb") as for_fq, gzip.open(output_rev, "wb") as rev_fq:
-        while True:
-            line = queue.get()
-            if line == stop_token:
-                return 0
-            for_fq.write(line[0])
-            rev_fq.write(line[1])
+def _fastq_body(seq, qual):
+    """Encode the lines following the read name in a fastq record."""
+    return f"\n{seq}\n+\n{qual}\n".encode()
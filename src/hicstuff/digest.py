@@ -6,9 +6,15 @@ Functions used to write auxiliary instagraal compatible
 sparse matrices.
 """
 
-import csv
+import io
+import itertools
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
+from multiprocessing import shared_memory
+from os.path import join
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -17,6 +23,7 @@ from Bio import SeqIO, SeqUtils
 from Bio.Restriction import RestrictionBatch
 from Bio.Seq import Seq
 
+import hicstuff.filter as hcf
 import hicstuff.io as hio
 from hicstuff.log import logger
 
@@ -130,7 +137,17 @@ def write_frag_info(
                 info_contigs.write(current_contig_line)
 
 
-def attribute_fragments(pairs_file, idx_pairs_file, restriction_table):
+def attribute_fragments(
+    pairs_file,
+    idx_pairs_file,
+    restriction_table,
+    chunksize=hio.DEFAULT_PAIRS_CHUNKSIZE,
+    threads=1,
+    count_events=False,
+    sort_keys=None,
+    tmp_dir=None,
+    buffer="2G",
+):
     """
     Writes the indexed pairs file, which has two more columns than the input
     pairs file corresponding to the restriction fragment index of each read.
@@ -150,26 +167,366 @@ def attribute_fragments(pairs_file, idx_pairs_file, restriction_table):
     restriction_table: dict
         Dictionary with chromosome identifiers (str) as keys and list of
         positions (int) of restriction sites as values.
-    """
+    chunksize: int
+        Number of pairs loaded in memory and attributed at once.
+    threads: int
+        Number of worker processes. If above 1, an uncompressed pairs file
+        is split in as many parts, which are attributed in parallel.
+    count_events: bool
+        If True, histograms of event types by number of restriction sites
+        between reads are counted while attributing pairs, as in
+        hicstuff.filter.count_events.
+    sort_keys: list of str or None
+        If given, the indexed pairs file is sorted by these columns, as with
+        hicstuff.io.sort_pairs. Attributed pairs are sorted in runs as they
+        are produced, by each worker process, and runs are merged into the
+        indexed pairs file without writing unsorted pairs.
+    tmp_dir: str
+        Path to the directory where sorted runs are written. Defaults to the
+        system temporary directory.
+    buffer: str
+        Memory used for sorting, shared by all worker processes. Consists of
+        a number and a unit, as in UNIX sort (e.g. 500M, 2G).
 
-    # NOTE: Bottlenecks here are 1. binary search in find_frag and 2. writerow
-    # 1. could be reduced by searching groups of N frags in parallel and 2. by
-    # writing N frags simultaneously using a single call of writerows.
+    Returns
+    -------
+    dict :
+        Statistics of the attribution: number of pairs written ("pairs"),
+        number of pairs discarded ("discarded") and set of contigs missing
+        from the header ("missing_contigs"), and histograms of events
+        ("events") if count_events is True. A sidecar index is also written
+        next to the indexed pairs file.
+    """
 
     # Parse and update header section
-    pairs_header = hio.get_pairs_header(pairs_file)
-    header_size = len(pairs_header)
+    header = []
     chrom_order = []
-    with open(idx_pairs_file, "w") as idx_pairs:
-        for line in pairs_header:
-            # Add new column names to header
-            if line.startswith("#columns"):
-                line = line.rstrip() + " frag1 frag2"
-            if line.startswith("#chromsize"):
-                chrom_order.append(line.split()[1])
-            idx_pairs.write(line + "\n")
+    for line in hio.get_pairs_header(pairs_file):
+        # Add new column names to header
+        if line.startswith("#columns"):
+            line = line.rstrip() + " frag1 frag2"
+        if line.startswith("#chromsize"):
+            chrom_order.append(line.split()[1])
+        header.append(line)
 
     # Get number of fragments per chrom to allow genome-based indices
+    shift_frags = get_frag_shifts(chrom_order, restriction_table)
+
+    if sort_keys is not None:
+        stats = _attribute_sorted(
+            pairs_file,
+            idx_pairs_file,
+            header,
+            restriction_table,
+            shift_frags,
+            threads,
+            chunksize,
+            count_events,
+            sort_keys,
+            tmp_dir,
+            buffer,
+        )
+    elif threads > 1 and not hio.is_compressed(pairs_file):
+        with open(idx_pairs_file, "w") as idx_pairs:
+            for line in header:
+                idx_pairs.write(line + "\n")
+        stats, shard_files = _attribute_shards(
+            pairs_file,
+            idx_pairs_file,
+            restriction_table,
+            shift_frags,
+            threads,
+            chunksize,
+            count_events=count_events,
+        )
+        # Concatenate shards in input order
+        with open(idx_pairs_file, "ab") as idx_pairs:
+            for shard_file in shard_files:
+                with open(shard_file, "rb") as shard:
+                    shutil.copyfileobj(shard, idx_pairs)
+                os.remove(shard_file)
+        hio.index_pairs(idx_pairs_file)
+    else:
+        index = hio.new_pairs_index()
+        with hio.read_compressed(pairs_file) as pairs, open(idx_pairs_file, "w") as idx_pairs:
+            for line in header:
+                idx_pairs.write(line + "\n")
+            # Skip header lines
+            for _ in range(len(header)):
+                next(pairs)
+            stats = _attribute_lines(
+                pairs,
+                idx_pairs,
+                restriction_table,
+                shift_frags,
+                chunksize,
+                index=index,
+                count_events=count_events,
+            )
+        hio.write_pairs_index(idx_pairs_file, index)
+
+    if stats["missing_contigs"]:
+        logger.warning(
+            "Pairs on the following contigs were discarded as "
+            "those contigs are not listed in the paris file header. "
+            "This is normal if you filtered out small contigs: {}".format(
+                " ".join(list(stats["missing_contigs"]))
+            )
+        )
+    return stats
+
+
+def _attribution_stats(count_events=False):
+    """Empty statistics of attribution, as returned by attribute_fragments."""
+    stats = {"pairs": 0, "discarded": 0, "missing_contigs": set()}
+    if count_events:
+        stats["events"] = {}
+    return stats
+
+
+def _attribute_blocks(lines, restriction_table, shift_frags, chunksize, stats, columns=()):
+    """
+    Attribute pairs records to fragments by blocks. Only coordinates and the
+    given columns are parsed. Yields attributed records, as input lines
+    without line terminators with fragment indices appended to them, along
+    with their parsed columns, frag1 and frag2. The number of written and
+    discarded pairs, the set of missing contigs and, if stats has an
+    "events" entry, the histograms of events are added to stats.
+    """
+    needed = {"chr1", "pos1", "chr2", "pos2"} | set(columns)
+    if "events" in stats:
+        # Strands are needed to get event types
+        needed |= {"strand1", "strand2"}
+    usecols = [i for i, col in enumerate(hio.PAIRS_COLS) if col in needed]
+    names = [hio.PAIRS_COLS[i] for i in usecols]
+    for block in iter(lambda: list(itertools.islice(lines, chunksize)), []):
+        coords = pd.read_csv(
+            io.StringIO("".join(block)),
+            sep="\t",
+            header=None,
+            usecols=usecols,
+            names=names,
+            dtype={col: (np.int64 if col in ("pos1", "pos2") else str) for col in names},
+            na_filter=False,
+        )
+        # A single binary search per chromosome for the whole block
+        coords, missing = attribute_pairs(coords, restriction_table, shift_frags)
+        if "events" in stats:
+            hcf.count_events(coords, stats["events"])
+        if missing:
+            stats["missing_contigs"] |= missing
+            stats["discarded"] += len(block) - coords.shape[0]
+            block = [block[i] for i in coords.index]
+        stats["pairs"] += len(block)
+        records = [
+            f"{line}\t{frag1}\t{frag2}"
+            for line, frag1, frag2 in zip(
+                (line.rstrip("\r\n") for line in block),
+                coords.frag1.tolist(),
+                coords.frag2.tolist(),
+            )
+        ]
+        yield records, coords
+
+
+def _attribute_lines(
+    lines, idx_pairs, restriction_table, shift_frags, chunksize, index=None, count_events=False
+):
+    """
+    Attribute pairs records to fragments by blocks and write them to an open
+    file. Only coordinates are parsed, input records are copied as is and
+    fragment indices are appended to them. If a pairs index is given, it is
+    updated with written records. Returns the number of written and
+    discarded pairs, the set of missing contigs and, if count_events is
+    True, the histograms of events.
+    """
+    stats = _attribution_stats(count_events)
+    for records, _ in _attribute_blocks(lines, restriction_table, shift_frags, chunksize, stats):
+        # Records end with CRLF, as written by the csv module previously
+        hio.write_records(records, idx_pairs, lineterminator="\r\n", index=index)
+    return stats
+
+
+def _attribute_runs(lines, run_prefix, restriction_table, shift_frags, chunksize, stats, sort):
+    """
+    Attribute pairs records to fragments by blocks and write them to sorted
+    runs, as hicstuff.io.write_pairs_runs. sort holds the header, sort keys
+    and buffer size. Returns the paths of the run files.
+    """
+    header, sort_keys, buffer = sort
+    blocks = _attribute_blocks(
+        lines, restriction_table, shift_frags, chunksize, stats, columns=sort_keys
+    )
+    return hio.write_pairs_runs(blocks, header, run_prefix, sort_keys, buffer=buffer)
+
+
+def _attribute_sorted(
+    pairs_file,
+    idx_pairs_file,
+    header,
+    restriction_table,
+    shift_frags,
+    threads,
+    chunksize,
+    count_events,
+    sort_keys,
+    tmp_dir,
+    buffer,
+):
+    """
+    Attribute pairs to fragments and write them sorted by sort_keys. Records
+    are sorted in runs as they are attributed, in each worker process if
+    the pairs file is split in shards, and all runs are merged at once into
+    the indexed pairs file. Returns the statistics of the attribution.
+    """
+    run_dir = tempfile.mkdtemp(prefix="hicstuff_attribute_", dir=tmp_dir)
+    try:
+        if threads > 1 and not hio.is_compressed(pairs_file):
+            # Worker processes share the sort buffer
+            sort = (header, sort_keys, f"{hio.parse_buffer_size(buffer) // threads}b")
+            stats, run_files = _attribute_shards(
+                pairs_file,
+                join(run_dir, "shard"),
+                restriction_table,
+                shift_frags,
+                threads,
+                chunksize,
+                count_events=count_events,
+                sort=sort,
+            )
+        else:
+            stats = _attribution_stats(count_events)
+            with hio.read_compressed(pairs_file) as pairs:
+                # Skip header lines
+                for _ in range(len(header)):
+                    next(pairs)
+                run_files = _attribute_runs(
+                    pairs,
+                    join(run_dir, "run"),
+                    restriction_table,
+                    shift_frags,
+                    chunksize,
+                    stats,
+                    (header, sort_keys, buffer),
+                )
+        hio.merge_pairs_runs(run_files, header, idx_pairs_file, sort_keys, buffer=buffer)
+    finally:
+        shutil.rmtree(run_dir)
+    return stats
+
+
+# Restriction tables and fragment shifts of attribution worker processes
+_WORKER_TABLES = {}
+
+
+def _init_attribution_worker(shm_name, layout, shift_frags):
+    """Attach worker process to restriction tables in shared memory."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    sites = np.ndarray((layout["size"],), dtype=np.int64, buffer=shm.buf)
+    _WORKER_TABLES["shm"] = shm
+    _WORKER_TABLES["shift_frags"] = shift_frags
+    _WORKER_TABLES["restriction_table"] = {
+        chrom: sites[start:end] for chrom, (start, end) in layout["chroms"].items()
+    }
+
+
+def _attribute_shard(shard):
+    """
+    Attribute pairs in a byte range of a pairs file to a shard file, or to
+    sorted runs prefixed by the shard file name if sort is set. Returns the
+    statistics of the shard and the files written.
+    """
+    pairs_file, start, end, shard_file, chunksize, count_events, sort = shard
+    lines = hio.read_lines_range(pairs_file, start, end)
+    tables = (_WORKER_TABLES["restriction_table"], _WORKER_TABLES["shift_frags"])
+    if sort is not None:
+        stats = _attribution_stats(count_events)
+        return stats, _attribute_runs(lines, shard_file, *tables, chunksize, stats, sort)
+    with open(shard_file, "w") as idx_pairs:
+        stats = _attribute_lines(lines, idx_pairs, *tables, chunksize, count_events=count_events)
+    return stats, [shard_file]
+
+
+def _attribute_shards(
+    pairs_file,
+    out_prefix,
+    restriction_table,
+    shift_frags,
+    threads,
+    chunksize,
+    count_events=False,
+    sort=None,
+):
+    """
+    Split the body of a pairs file in line-aligned byte ranges and attribute
+    each of them in a worker process, to files named after out_prefix.
+    Restriction tables are concatenated in a single shared memory block
+    instead of being copied to each worker. If sort is set (header, sort
+    keys and buffer size of each worker), each worker writes sorted runs of
+    its records. Returns the statistics of all shards merged, as given by
+    _attribute_lines, and the files written, in input order.
+    """
+    shards = hio.get_line_shards(pairs_file, threads)
+    layout = {"chroms": {}, "size": 0}
+    for chrom, sites in restriction_table.items():
+        layout["chroms"][chrom] = (layout["size"], layout["size"] + len(sites))
+        layout["size"] += len(sites)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 8 * layout["size"]))
+    try:
+        shared_sites = np.ndarray((layout["size"],), dtype=np.int64, buffer=shm.buf)
+        for chrom, (start, end) in layout["chroms"].items():
+            shared_sites[start:end] = restriction_table[chrom]
+        with multiprocessing.Pool(
+            threads,
+            initializer=_init_attribution_worker,
+            initargs=(shm.name, layout, shift_frags),
+        ) as pool:
+            results = pool.map(
+                _attribute_shard,
+                [
+                    (pairs_file, start, end, f"{out_prefix}.{i}", chunksize, count_events, sort)
+                    for i, (start, end) in enumerate(shards)
+                ],
+            )
+        del shared_sites
+    finally:
+        shm.close()
+        shm.unlink()
+    stats = _attribution_stats(count_events)
+    files = []
+    for shard, shard_files in results:
+        stats["pairs"] += shard["pairs"]
+        stats["discarded"] += shard["discarded"]
+        stats["missing_contigs"] |= shard["missing_contigs"]
+        for event, count in shard.get("events", {}).items():
+            stats["events"][event] = stats["events"].get(event, 0) + count
+        files.extend(shard_files)
+    return stats, files
+
+
+def get_frag_shifts(chrom_order, restriction_table):
+    """
+    Compute the offset to add to chromosome-based fragment indices of each
+    chromosome to make them genome-based.
+
+    Parameters
+    ----------
+    chrom_order : list of str
+        Chromosome names, in the order in which they appear in the genome.
+    restriction_table : dict
+        Dictionary with chromosome identifiers (str) as keys and list of
+        positions (int) of restriction sites as values.
+
+    Returns
+    -------
+    dict :
+        Number of fragments in previous chromosomes, for each chromosome.
+
+    Examples
+    --------
+    >>> get_frag_shifts(["a", "b", "c"], {"a": [0, 5, 9], "b": [0, 3], "c": [0, 2]})
+    {'a': 0, 'b': 2, 'c': 3}
+    """
     shift_frags = {}
     prev_frags = 0
     for rank, chrom in enumerate(chrom_order):
@@ -178,57 +535,54 @@ def attribute_fragments(pairs_file, idx_pairs_file, restriction_table):
             prev_frags += len(restriction_table[chrom_order[rank - 1]]) - 1
         # Idx of each chrom's frags will be shifted by n frags in previous chroms
         shift_frags[chrom] = prev_frags
+    return shift_frags
+
+
+def attribute_pairs(pairs, restriction_table, shift_frags):
+    """
+    Attribute a block of pairs records to restriction fragments. Reads are
+    grouped by chromosome so that a single binary search is performed per
+    chromosome for the whole block.
 
+    Parameters
+    ----------
+    pairs : pandas.DataFrame
+        Block of pairs records with at least columns chr1, pos1, chr2, pos2.
+        Positions are 1-based.
+    restriction_table : dict
+        Dictionary with chromosome identifiers (str) as keys and list of
+        positions (int) of restriction sites as values.
+    shift_frags : dict
+        Number of fragments preceding each chromosome in the genome, as
+        returned by get_frag_shifts.
+
+    Returns
+    -------
+    pandas.DataFrame :
+        The input records with genome-based 0-based fragment indices in
+        columns frag1 and frag2. Records where either read is on a contig
+        absent from shift_frags are discarded.
+    set of str :
+        Names of the contigs absent from shift_frags.
+    """
+    keep = np.ones(pairs.shape[0], dtype=bool)
     missing_contigs = set()
-    # Attribute pairs to fragments and append them to output file (after header)
-    with open(pairs_file) as pairs, open(idx_pairs_file, "a") as idx_pairs:
-        # Skip header lines
-        for _ in range(header_size):
-            next(pairs)
-
-        # Define input and output fields
-        pairs_cols = [
-            "readID",
-            "chr1",
-            "pos1",
-            "chr2",
-            "pos2",
-            "strand1",
-            "strand2",
-        ]
-        idx_cols = pairs_cols + ["frag1", "frag2"]
-
-        # Use csv reader / writer to automatically parse columns into a dict
-        pairs_reader = csv.DictReader(pairs, fieldnames=pairs_cols, delimiter="\t")
-        pairs_writer = csv.DictWriter(idx_pairs, fieldnames=idx_cols, delimiter="\t")
-
-        for pair in pairs_reader:
-            # Get the 0-based indices of corresponding restriction fragments
-            # Deducing 1 from pair position to get it into 0bp point
-            pair["frag1"] = find_frag(int(pair["pos1"]) - 1, restriction_table[pair["chr1"]])
-            pair["frag2"] = find_frag(int(pair["pos2"]) - 1, restriction_table[pair["chr2"]])
-            # Shift fragment indices to make them genome-based instead of
-            # chromosome-based
-            try:
-                pair["frag1"] += shift_frags[pair["chr1"]]
-            except KeyError:
-                missing_contigs.add(pair["chr1"])
-            try:
-                pair["frag2"] += shift_frags[pair["chr2"]]
-            except KeyError:
-                missing_contigs.add(pair["chr2"])
-
-            # Write indexed pairs in the new file
-            pairs_writer.writerow(pair)
-
-        if missing_contigs:
-            logger.warning(
-                "Pairs on the following contigs were discarded as "
-                "those contigs are not listed in the paris file header. "
-                "This is normal if you filtered out small contigs: {}".format(
-                    " ".join(list(missing_contigs))
-                )
-            )
+    frags = {}
+    for end in ("1", "2"):
+        frag = np.zeros(pairs.shape[0], dtype=np.int64)
+        # Deducing 1 from pair position to get it into 0bp point
+        pos = pairs["pos" + end].to_numpy() - 1
+        for chrom, idx in pairs.groupby("chr" + end, sort=False).indices.items():
+            if chrom not in shift_frags or chrom not in restriction_table:
+                missing_contigs.add(chrom)
+                keep[idx] = False
+                continue
+            frag[idx] = find_frags(pos[idx], restriction_table[chrom]) + shift_frags[chrom]
+        frags["frag" + end] = frag
+    pairs = pairs.assign(**frags)
+    if not keep.all():
+        pairs = pairs[keep]
+    return pairs, missing_contigs
 
 
 def get_restriction_table(seq, enzyme, circular=False):
@@ -340,6 +694,42 @@ def find_frag(pos, r_sites):
     return int(index)
 
 
+def find_frags(pos, r_sites):
+    """
+    Vectorized version of find_frag: find the indices of the restriction
+    fragments corresponding to an array of genomic positions on the same
+    chromosome.
+
+    Parameters
+    ----------
+    pos : numpy.array of int
+        Genomic positions, in base pairs.
+    r_sites : numpy.array of int
+        Genomic positions corresponding to restriction sites.
+
+    Returns
+    -------
+    numpy.array of int
+        The 0-based indices of the restriction fragments to which positions
+        belong.
+
+    >>> find_frags(np.array([15, 0, 29]), np.array([0, 20, 30]))
+    array([0, 0, 1])
+    >>> find_frags(np.array([15, 31]), np.array([0, 20, 30]))
+    Traceback (most recent call last):
+        ...
+    ValueError: Read position is larger than last entry in restriction table.
+
+    """
+    if r_sites[0] != 0:
+        raise ValueError("The first position in the restriction table is not 0.")
+    if pos.size and pos.max() > r_sites[-1]:
+        raise ValueError("Read position is larger than last entry in restriction table.")
+    index = np.searchsorted(r_sites, pos, side="right") - 1
+    # Last site = end of the chrom, index of last fragment is last site - 1
+    return np.clip(index, 0, len(r_sites) - 2)
+
+
 def frag_len(
     frags_file_name=DEFAULT_FRAGMENTS_LIST_FILE_NAME,
     output_dir=None,
@@ -405,24 +795,26 @@ def frag_len(
         logger.info(f"Genome digested into {nfrags} fragments with a median length of {med_len}")
 
 
-def gen_enzyme_religation_regex(enzyme):
-    """Return a regex which corresponds to all possible religation sites given a
-    set of enzyme.
+def gen_religation_sites(enzyme):
+    """Return all possible religation sites given a set of enzymes, with
+    ambiguous bases as IUPAC codes.
+
     Parameters:
     -----------
     enzyme : str
         String that contains the names of the enzyme separated by a comma.
+
     Returns:
     --------
-    re.Pattern :
-        Regex that corresponds to all possible ligation sites given a set of
-        enzyme.
+    list of str :
+        Sorted religation sites, on both strands.
+
     Examples:
     ---------
-    >>> gen_enzyme_religation_regex('HpaII')
-    re.compile('CCGCGG')
-    >>> gen_enzyme_religation_regex('HpaII,MluCI')
-    re.compile('AATTAATT|AATTCGG|CCGAATT|CCGCGG')
+    >>> gen_religation_sites('HpaII,MluCI')
+    ['AATTAATT', 'AATTCGG', 'CCGAATT', 'CCGCGG']
+    >>> gen_religation_sites('HinfI')
+    ['GANTANTC']
     """
 
     # Split the str on the comma to separate the different enzymes.
@@ -458,12 +850,90 @@ def gen_enzyme_religation_regex(enzyme):
     # Iterates on the two list to build all the possible HiC ligation sites.
     for give_site in give_list:
         for accept_site in accept_list:
-            # Replace "N" by "." for regex searching of the sites
-            ligation_list.append((give_site + accept_site).replace("N", "."))
-            ligation_list.append(
-                str(Seq(give_site + accept_site).reverse_complement()).replace("N", ".")
-            )
+            ligation_list.append(give_site + accept_site)
+            ligation_list.append(str(Seq(give_site + accept_site).reverse_complement()))
+
+    return sorted(set(ligation_list))
+
+
+def gen_enzyme_religation_regex(enzyme):
+    """Return a regex which corresponds to all possible religation sites given a
+    set of enzyme.
+    Parameters:
+    -----------
+    enzyme : str
+        String that contains the names of the enzyme separated by a comma.
+    Returns:
+    --------
+    re.Pattern :
+        Regex that corresponds to all possible ligation sites given a set of
+        enzyme.
+    Examples:
+    ---------
+    >>> gen_enzyme_religation_regex('HpaII')
+    re.compile('CCGCGG')
+    >>> gen_enzyme_religation_regex('HpaII,MluCI')
+    re.compile('AATTAATT|AATTCGG|CCGAATT|CCGCGG')
+    """
+    # Replace "N" by "." for regex searching of the sites
+    sites = [site.replace("N", ".") for site in gen_religation_sites(enzyme)]
 
     # Build the regex for any ligation sites.
-    pattern = "|".join(sorted(list(set(ligation_list))))
+    pattern = "|".join(sorted(sites))
     return re.compile(pattern)
+
+
+def gen_ligation_matcher(enzyme):
+    """Return a matcher finding all the religation sites of a set of enzymes
+    in a single pass over a sequence. Sites are merged in a prefix tree
+    compiled as one regex, so that each position of the sequence is only
+    compared once to the bases shared by several sites, instead of once per
+    site as with gen_enzyme_religation_regex. Matches are identical to those
+    of gen_enzyme_religation_regex: N is the only wildcard, and the other
+    IUPAC codes of degenerate sites (e.g. W or Y) are matched literally.
+
+    Parameters:
+    -----------
+    enzyme : str
+        String that contains the names of the enzyme separated by a comma.
+
+    Returns:
+    --------
+    re.Pattern :
+        Compiled matcher, use its finditer method to find all sites.
+
+    Examples:
+    ---------
+    >>> matcher = gen_ligation_matcher('HpaII,MluCI')
+    >>> matcher.pattern
+    '(?:AATT(?:AATT|CGG)|CCG(?:AATT|CGG))'
+    >>> [site.start() for site in matcher.finditer("TCCGCGGAAATTCGGA")]
+    [1, 8]
+    >>> gen_ligation_matcher('HinfI').pattern
+    'GA.TA.TC'
+    """
+    # Replace "N" by "." for regex searching of the sites
+    sites = [site.replace("N", ".") for site in gen_religation_sites(enzyme)]
+    return re.compile(_trie_regex(_sites_trie(sites)))
+
+
+def _sites_trie(sites):
+    """Build a prefix tree of sites as nested dictionaries. The end of a site
+    is marked by an empty key."""
+    trie = {}
+    for site in sites:
+        node = trie
+        for base in site:
+            node = node.setdefault(base, {})
+        node[""] = {}
+    return trie
+
+
+def _trie_regex(node):
+    """Convert a prefix tree from _sites_trie to a regex. Alternatives are
+    in the sorted order of the sites, as in gen_enzyme_religation_regex, so
+    that the same site is matched at each position."""
+    alternatives = [base + _trie_regex(node[base]) if base else "" for base in sorted(node)]
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return "(?:" + "|".join(alternatives) + ")"
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import csv as csv
-import io
 import os as os
 import sys
 
@@ -263,37 +262,58 @@ def _circular_distance_law(distance, chr_segment_length, chr_bin):
 
     Parameters
     ----------
-    chr_segment_bins : list of floats
-        The start and end indices of chromosomes/arms to compute the distance
-        law on each chromosome/arm separately.
+    distance : int or numpy.ndarray
+        Distance between two fragments with a contact.
     chr_segment_length: list of floats
         List of the size in base pairs of the different arms or chromosomes.
-    distance : int
-        Distance between two fragments with a contact.
+    chr_bin : int or numpy.ndarray
+        Index of the chromosome of each distance in chr_segment_length.
 
     Returns
     -------
-    int :
+    int or numpy.ndarray :
         The real distance in the chromosome circular and not the distance
         between two genomic positions
 
     Examples
     --------
-    >>> circular_distance_law(7500, [2800, 9000], 1)
+    >>> int(_circular_distance_law(7500, [2800, 9000], 1))
     1500
-    >>> circular_distance_law(1300, [2800, 9000], 0)
+    >>> int(_circular_distance_law(1300, [2800, 9000], 0))
     1300
-    >>> circular_distance_law(1400, [2800, 9000], 0)
-    1400
+    >>> _circular_distance_law(np.array([1400, 2000]), [2800, 9000], 0)
+    array([1400,  800])
+    """
+    chr_len = np.asarray(chr_segment_length)[chr_bin]
+    return np.where(distance > chr_len / 2, chr_len - distance, distance)[()]
+
+
+def _add_distances(distance, chr_bin, xs, ps):
+    """Count distances in the logbins of their chromosome/arm. A single
+    binary search is made per chromosome/arm. As when counting contacts one
+    by one in lists, distances below the first logbin are counted in the
+    last one.
+
+    Parameters
+    ----------
+    distance : numpy.ndarray
+        Distance between the two reads of each contact.
+    chr_bin : numpy.ndarray
+        Index of the chromosome/arm of each contact in xs.
+    xs : list of numpy.ndarray
+        The start coordinate of each logbin, one array per chromosome or arm.
+    ps : list of numpy.ndarray
+        Contact counts per logbin per chromosome or arm. Modified in place.
     """
-    chr_len = chr_segment_length[chr_bin]
-    if distance > chr_len / 2:
-        distance = chr_len - distance
-    return distance
+    for i in np.unique(chr_bin):
+        ps_indice = np.searchsorted(xs[i], distance[chr_bin == i], side="right") - 1
+        ps_indice[ps_indice < 0] += len(xs[i])
+        ps[i] += np.bincount(ps_indice, minlength=len(xs[i]))
 
 
-def _get_pairs_distance_pos(line, chr_to_idx, chr_segment_length, xs, ps, circular=False):
-    """Compute distance law from a plain pairs line using read positions directly.
+def _get_pairs_distance_pos(chunk, chr_to_idx, chr_segment_length, xs, ps, circular=False):
+    """Compute distance law from a block of plain pairs records using read
+    positions directly.
 
     For use when no fragments file is available. Uses abs(pos2 - pos1) as the
     genomic distance between two reads, keeping only same-chromosome, same-strand
@@ -301,50 +321,51 @@ def _get_pairs_distance_pos(line, chr_to_idx, chr_segment_length, xs, ps, circul
 
     Parameters
     ----------
-    line : dict
-        Line of a pairs file with keys readID, chr1, pos1, chr2, pos2,
-        strand1, strand2. Values are strings.
+    chunk : dict
+        Block of pairs records as arrays of columns chr1, pos1, chr2, pos2,
+        strand1, strand2, as generated by hicstuff.io.read_pairs_columns.
     chr_to_idx : dict
         Mapping of chromosome name to its index in xs/ps/chr_segment_length.
     chr_segment_length : list of int
         Length in base pairs of each chromosome.
     xs : list of numpy.ndarray
         The start coordinate of each logbin, one array per chromosome.
-    ps : list of list
+    ps : list of numpy.ndarray
         Contact counts per logbin per chromosome. Modified in place.
     circular : bool
         If True, compute circular distance. Default is False.
     """
-    if line["chr1"] != line["chr2"]:
-        return
-    if line["chr1"] not in chr_to_idx:
-        return
-    if line["strand1"] == line["strand2"]:
-        chr_bin = chr_to_idx[line["chr1"]]
-        distance = abs(int(line["pos2"]) - int(line["pos1"]))
-        if distance <= 0:
-            return
-        if circular:
-            distance = _circular_distance_law(distance, chr_segment_length, chr_bin)
-        xs_temp = xs[chr_bin][:]
-        ps_indice = np.searchsorted(xs_temp, distance, side="right") - 1
-        if 0 <= ps_indice < len(ps[chr_bin]):
-            ps[chr_bin][ps_indice] += 1
+    chr_bin = pd.Series(chunk["chr1"]).map(chr_to_idx).fillna(-1).to_numpy(dtype=np.int64)
+    distance = np.abs(chunk["pos2"] - chunk["pos1"])
+    keep = (
+        (chunk["chr1"] == chunk["chr2"])
+        & (chr_bin >= 0)
+        & (chunk["strand1"] == chunk["strand2"])
+        & (distance > 0)
+    )
+    chr_bin, distance = chr_bin[keep], distance[keep]
+    if circular:
+        distance = _circular_distance_law(distance, chr_segment_length, chr_bin)
+    # Distances below the first logbin are not counted
+    first_bins = np.array([x[0] for x in xs])
+    in_range = distance >= first_bins[chr_bin]
+    _add_distances(distance[in_range], chr_bin[in_range], xs, ps)
 
 
 def _get_pairs_distance(
-    line, fragments, chr_segment_bins, chr_segment_length, xs, ps, circular=False
+    chunk, fragments, chr_segment_bins, chr_segment_length, xs, ps, circular=False
 ):
-    """From a line of a pair reads file, filter -/+ or +/- reads, keep only the
-    reads in the same chromosome/arm and compute the distance of the the two
-    fragments. It modify the input ps in order to count or not the line given.
-    It will add one in the logbin corresponding to the distance.
+    """From a block of pair reads records, filter -/+ or +/- reads, keep only
+    the reads in the same chromosome/arm and compute the distance of the the
+    two fragments. It modify the input ps in order to count the contacts,
+    adding one in the logbin corresponding to the distance of each kept
+    record.
 
     Parameters
     ----------
-    line : OrderedDict
-        Line of a pair reads file with the these keys readID, chr1, pos1, chr2,
-        pos2, strand1, strand2, frag1, frag2. The values are in a dictionnary.
+    chunk : dict
+        Block of pair reads records as arrays of columns strand1, strand2,
+        frag1 and frag2, as generated by hicstuff.io.read_pairs_columns.
     fragments : pandas.DataFrame
         Table containing in the first coulum the ID of the fragment, in the
         second the names of the chromosome in the third and fourth the start
@@ -355,58 +376,63 @@ def _get_pairs_distance(
         law on each chromosome/arm separately.
     chr_segment_length: list of floats
         List of the size in base pairs of the different arms or chromosomes.
-    xs : list of lists
+    xs : list of numpy.ndarray
         The start coordinate of each bin one array per chromosome or arm.
-    ps : list of lists
+    ps : list of numpy.ndarray
         The sum of contact already count. xs and ps should have the same
         dimensions.
     circular : bool
         If True, calculate the distance as the chromosome is circular. Default
         value is False.
     """
-    # Check this is a pairs_idx file and not simple pairs
-    if line["frag1"] is None:
-        logger.error(
-            "Input pairs file must have frag1 and frag2 columns. In hicstuff "
-            'pipeline, this is the "valid_idx.pairs" file.'
-        )
+    strand1 = chunk["strand1"]
+    frag1 = chunk["frag1"]
+    frag2 = chunk["frag2"]
+    # Find in which chromosome/arm are the fragment 1 and 2.
+    chr_bin1 = np.searchsorted(chr_segment_bins, frag1, side="right") - 1
+    chr_bin2 = np.searchsorted(chr_segment_bins, frag2, side="right") - 1
     # We only keep the event +/+ or -/-. This is done to avoid to have any
     # event of uncut which are not possible in these events. We can remove the
     # good events of +/- or -/+ because we don't need a lot of reads to compute
     # the distance law and if we eliminate these reads we do not create others
-    # biases as they should have the same distribution.
-    if line["strand1"] == line["strand2"]:
-        # Find in which chromosome/arm are the fragment 1 and 2.
-        chr_bin1 = np.searchsorted(chr_segment_bins, int(line["frag1"]), side="right") - 1
-        chr_bin2 = np.searchsorted(chr_segment_bins, int(line["frag2"]), side="right") - 1
-        # We only keep the reads with the two fragments in the same chromosome
-        # or arm.
-        if chr_bin1 == chr_bin2:
-            # Remove the contacts in the centromeres if centro_remove
-            if chr_bin1 % 2 == 0:
-                chr_bin1 = int(chr_bin1 / 2)
-                # For the reads -/-, the fragments should be religated with both
-                # their start position (position in the left on the genomic
-                # sequence, 5'). For the reads +/+ it's the contrary. We compute
-                # the distance as the distance between the two extremities which
-                # are religated.
-                if line["strand1"] == "-":
-                    distance = abs(
-                        np.array(fragments["start_pos"][int(line["frag1"])])
-                        - np.array(fragments["start_pos"][int(line["frag2"])])
-                    )
-                if line["strand1"] == "+":
-                    distance = abs(
-                        np.array(fragments["end_pos"][int(line["frag1"])])
-                        - np.array(fragments["end_pos"][int(line["frag2"])])
-                    )
-                if circular:
-                    distance = _circular_distance_law(distance, chr_segment_length, chr_bin1)
-                xs_temp = xs[chr_bin1][:]
-                # Find the logbins in which the distance is and add one to the sum
-                # of contact.
-                ps_indice = np.searchsorted(xs_temp, distance, side="right") - 1
-                ps[chr_bin1][ps_indice] += 1
+    # biases as they should have the same distribution. We only keep the reads
+    # with the two fragments in the same chromosome or arm, outside of
+    # removed centromeres.
+    keep = (
+        (strand1 == chunk["strand2"])
+        & ((strand1 == "+") | (strand1 == "-"))
+        & (chr_bin1 == chr_bin2)
+        & (chr_bin1 % 2 == 0)
+    )
+    chr_bin = chr_bin1[keep] // 2
+    frag1, frag2, strand1 = frag1[keep], frag2[keep], strand1[keep]
+    # For the reads -/-, the fragments should be religated with both
+    # their start position (position in the left on the genomic
+    # sequence, 5'). For the reads +/+ it's the contrary. We compute
+    # the distance as the distance between the two extremities which
+    # are religated.
+    start_pos = fragments["start_pos"].to_numpy()
+    end_pos = fragments["end_pos"].to_numpy()
+    distance = np.where(
+        strand1 == "-",
+        np.abs(start_pos[frag1] - start_pos[frag2]),
+        np.abs(end_pos[frag1] - end_pos[frag2]),
+    )
+    if circular:
+        distance = _circular_distance_law(distance, chr_segment_length, chr_bin)
+    # Find the logbins in which the distance is and add one to the sum
+    # of contact.
+    _add_distances(distance, chr_bin, xs, ps)
+
+
+def _normalize_logbins(xs, ps, chr_segment_length):
+    """Divide the number of contacts by the area of the logbin, inplace."""
+    for i in range(len(xs)):
+        n = chr_segment_length[i]
+        ps[i][:-1] /= ((2 * n - xs[i][1:] - xs[i][:-1]) / 2) * (
+            (1 / np.sqrt(2)) * (xs[i][1:] - xs[i][:-1])
+        )
+        ps[i][-1] /= ((n - xs[i][-1]) ** 2) / 2
 
 
 def _get_names(fragments, chr_segment_bins):
@@ -451,7 +477,8 @@ def _get_chrom_info_from_pairs(pairs_reads_file):
     Parameters
     ----------
     pairs_reads_file : str
-        Path to a pairs file (plain or gzip-compressed).
+        Path to a pairs file (plain or gzip-compressed) or binary pairs
+        directory.
 
     Returns
     -------
@@ -462,16 +489,12 @@ def _get_chrom_info_from_pairs(pairs_reads_file):
     """
     chrom_sizes = {}
     columns = None
-    with hio.read_compressed(pairs_reads_file) as fh:
-        for raw_line in fh:
-            if not raw_line.startswith("#"):
-                break
-            line = raw_line.rstrip()
-            if line.startswith("#chromsize:"):
-                parts = line.split()
-                chrom_sizes[parts[1]] = int(parts[2])
-            elif line.startswith("#columns:"):
-                columns = line.split()[1:]
+    for line in hio.get_pairs_header(pairs_reads_file):
+        if line.startswith("#chromsize:"):
+            parts = line.split()
+            chrom_sizes[parts[1]] = int(parts[2])
+        elif line.startswith("#columns:"):
+            columns = line.split()[1:]
     return chrom_sizes, columns
 
 
@@ -483,6 +506,7 @@ def get_distance_law(
     out_file=None,
     circular=False,
     rm_centro=0,
+    chunksize=hio.DEFAULT_PAIRS_CHUNKSIZE,
 ):
     """Compute distance law as a function of the genomic coordinate aka P(s).
     Bin length increases exponentially with distance. Works on pairs file
@@ -527,6 +551,9 @@ def get_distance_law(
     rm_centro : int
         If a value is given, will remove the contacts close the centromeres.
         It will remove as many kb as the argument given. Default is None.
+    chunksize : int
+        Number of pairs read at once. Only the columns needed are held in
+        memory, by blocks of chunksize pairs.
 
     Returns
     -------
@@ -553,7 +580,7 @@ def get_distance_law(
                 "Please provide --frags or omit --centromeres."
             )
             sys.exit(1)
-        chrom_sizes, columns = _get_chrom_info_from_pairs(pairs_reads_file)
+        chrom_sizes, _ = _get_chrom_info_from_pairs(pairs_reads_file)
         if not chrom_sizes:
             logger.error(
                 "No #chromsize entries found in pairs header. "
@@ -564,44 +591,14 @@ def get_distance_law(
         chr_segment_length = list(chrom_sizes.values())
         chr_to_idx = {name: i for i, name in enumerate(chr_names)}
         xs = _logbins_xs(None, chr_segment_length, base, circular)
-        ps = [[0] * len(xs[i]) for i in range(len(xs))]
-        # Determine fieldnames from header columns, falling back to 7-column standard
-        if columns is not None:
-            fieldnames = columns
-        else:
-            fieldnames = [
-                "readID",
-                "chr1",
-                "pos1",
-                "chr2",
-                "pos2",
-                "strand1",
-                "strand2",
-            ]
-        with hio.read_compressed(pairs_reads_file) as reads:
-            # Skip header lines
-            raw_line = reads.readline()
-            while raw_line.startswith("#"):
-                raw_line = reads.readline()
-            # raw_line now holds the first data line; re-read via DictReader
-            first_data = raw_line
-            rest = reads.read()
-            data_stream = io.StringIO(first_data + rest)
-            reader = csv.DictReader(
-                data_stream,
-                fieldnames=fieldnames,
-                delimiter="\t",
-            )
-            for line in reader:
-                _get_pairs_distance_pos(line, chr_to_idx, chr_segment_length, xs, ps, circular)
+        ps = [np.zeros(len(xs[i])) for i in range(len(xs))]
+        # Pairs are read by blocks, columns are named after the header or
+        # the standard pairs columns
+        columns = ["chr1", "pos1", "chr2", "pos2", "strand1", "strand2"]
+        for chunk in hio.read_pairs_columns(pairs_reads_file, columns, chunksize):
+            _get_pairs_distance_pos(chunk, chr_to_idx, chr_segment_length, xs, ps, circular)
         # Normalise by logbin area (same formula as fragment-based path)
-        for i in range(len(xs)):
-            n = chr_segment_length[i]
-            for j in range(len(xs[i]) - 1):
-                ps[i][j] /= ((2 * n - xs[i][j + 1] - xs[i][j]) / 2) * (
-                    (1 / np.sqrt(2)) * (xs[i][j + 1] - xs[i][j])
-                )
-            ps[i][-1] /= ((n - xs[i][-1]) ** 2) / 2
+        _normalize_logbins(xs, ps, chr_segment_length)
         names = chr_names
         if out_file:
             export_distance_law(xs, ps, names, out_file)
@@ -620,47 +617,23 @@ def get_distance_law(
     xs = _logbins_xs(fragments, chr_segment_length, base, circular)
     # Create the list of p(s) with one array for each chromosome/arm and each
     # array contain as many values as in the logbin
-    ps = [None] * len(chr_segment_length)
-    for i in range(len(xs)):
-        ps[i] = [0] * len(xs[i])
-    # Read the pair reads file (supports plain and gzip-compressed files)
-    with hio.read_compressed(pairs_reads_file) as reads:
-        # Skip header lines (lines starting with '#')
-        raw_line = reads.readline()
-        while raw_line.startswith("#"):
-            raw_line = reads.readline()
-        # raw_line is the first data line; feed it together with the rest into DictReader
-        data_stream = io.StringIO(raw_line + reads.read())
-        # Reads all the others lines and put the values in a dictionnary with
-        # the keys : 'readID', 'chr1', 'pos1', 'chr2', 'pos2', 'strand1',
-        # 'strand2', 'frag1', 'frag2'
-        reader = csv.DictReader(
-            data_stream,
-            fieldnames=[
-                "readID",
-                "chr1",
-                "pos1",
-                "chr2",
-                "pos2",
-                "strand1",
-                "strand2",
-                "frag1",
-                "frag2",
-            ],
-            delimiter="\t",
+    ps = [np.zeros(len(xs[i])) for i in range(len(xs))]
+    # Check this is a pairs_idx file and not simple pairs
+    if not {"frag1", "frag2"} <= set(hio.get_pairs_columns(pairs_reads_file)):
+        logger.error(
+            "Input pairs file must have frag1 and frag2 columns. In hicstuff "
+            'pipeline, this is the "valid_idx.pairs" file.'
+        )
+        sys.exit(1)
+    # Read the pair reads file by blocks (supports plain and gzip-compressed
+    # files, as well as binary pairs), only with the columns needed
+    columns = ["strand1", "strand2", "frag1", "frag2"]
+    for chunk in hio.read_pairs_columns(pairs_reads_file, columns, chunksize):
+        _get_pairs_distance(
+            chunk, fragments, chr_segment_bins, chr_segment_length, xs, ps, circular
         )
-        for line in reader:
-            _get_pairs_distance(
-                line, fragments, chr_segment_bins, chr_segment_length, xs, ps, circular
-            )
     # Divide the number of contacts by the area of the logbin
-    for i in range(len(xs)):
-        n = chr_segment_length[i]
-        for j in range(len(xs[i]) - 1):
-            ps[i][j] /= ((2 * n - xs[i][j + 1] - xs[i][j]) / 2) * (
-                (1 / np.sqrt(2)) * (xs[i][j + 1] - xs[i][j])
-            )
-        ps[i][-1] /= ((n - xs[i][-1]) ** 2) / 2
+    _normalize_logbins(xs, ps, chr_segment_length)
     names = _get_names(fragments, chr_segment_bins)
     if out_file:
         export_distance_law(xs, ps, names, out_file)
@@ -18,13 +18,29 @@ attributed.
 @author: cmdoret (reimplementation of Axel KournaK's code)
 """
 
+import io
+import itertools
+import multiprocessing
+import os
+import shutil
 import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 
+import hicstuff.io as hio
 from hicstuff.log import logger
 
+# Intrachromosomal event types, by strands of the reads
+EVENT_TYPES = ["++", "--", "+-", "-+"]
+
+# Number of restriction sites up to which events are counted
+MAX_SITES = 50
+
+# Number of pairs used to estimate thresholds
+THRESHOLD_PAIRS = 1000000
+
 
 def process_read_pair(line):
     r"""Process and order read pairs in a .pairs record.
@@ -110,18 +126,173 @@ def process_read_pair(line):
     return p
 
 
-def get_thresholds(in_dat, interactive=False, plot_events=False, fig_path=None, prefix=None):
+def count_events(pairs, n_events=None, max_sites=MAX_SITES):
+    """Count intrachromosomal events of each type by number of restriction
+    sites between reads.
+
+    Parameters
+    ----------
+    pairs : pandas.DataFrame
+        Block of pairs records with columns chr1, pos1, chr2, pos2, strand1,
+        strand2, frag1, frag2.
+    n_events : dict or None
+        Histograms to which the counts of the block are added inplace, as
+        returned by a previous call. Can be empty.
+    max_sites : int
+        Pairs with at least this number of restriction sites between reads
+        are not counted.
+
+    Returns
+    -------
+    dict :
+        Number of events of each type in EVENT_TYPES, as arrays indexed by
+        number of restriction sites.
+    """
+    if n_events is None:
+        n_events = {}
+    keys = _event_keys(pairs, max_sites)
+    counts = _keys_histogram(keys, max_sites)
+    for event, count in counts.items():
+        n_events[event] = n_events.get(event, 0) + count
+    return n_events
+
+
+def sample_events(chunks, n_pairs=THRESHOLD_PAIRS, max_sites=MAX_SITES, seed=0):
+    """Count events as in count_events in a uniform random sample of pairs
+    drawn from the whole stream by reservoir sampling, instead of its first
+    pairs which are biased by the sort order.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records, as generated by hicstuff.io.read_pairs_chunks.
+    n_pairs : int
+        Number of pairs in the sample.
+    max_sites : int
+        Pairs with at least this number of restriction sites between reads
+        are not counted.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    dict :
+        Number of events of each type in the sample, as in count_events.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = np.empty(0, dtype=np.int64)
+    n_seen = 0
+    for chunk in chunks:
+        keys = _event_keys(chunk, max_sites)
+        # Fill the reservoir with the first pairs
+        n_fill = min(len(keys), n_pairs - len(reservoir))
+        reservoir = np.concatenate([reservoir, keys[:n_fill]])
+        # Then, the i-th pair replaces a random pair with probability n / i
+        slots = rng.integers(0, np.arange(n_seen + n_fill, n_seen + len(keys)) + 1)
+        replace = slots < n_pairs
+        reservoir[slots[replace]] = keys[n_fill:][replace]
+        n_seen += len(keys)
+    return _keys_histogram(reservoir, max_sites)
+
+
+def _event_keys(pairs, max_sites):
+    """Histogram bin of each pair, numbered by event type then number of
+    restriction sites. Interchromosomal pairs and pairs with at least
+    max_sites sites between reads are in bin -1."""
+    pairs, intra = _reorder_pairs(pairs)
+    # Number of restriction site between reads
+    nsites = np.abs(pairs["frag2"].to_numpy() - pairs["frag1"].to_numpy())
+    strand1 = pairs["strand1"].to_numpy()
+    strand2 = pairs["strand2"].to_numpy()
+    keys = np.full(len(nsites), -1, dtype=np.int64)
+    for code, etype in enumerate(EVENT_TYPES):
+        selected = intra & (nsites < max_sites) & (strand1 == etype[0]) & (strand2 == etype[1])
+        keys[selected] = code * max_sites + nsites[selected]
+    return keys
+
+
+def _keys_histogram(keys, max_sites):
+    """Count histogram bins given by _event_keys, by event type."""
+    counts = np.bincount(keys[keys >= 0], minlength=len(EVENT_TYPES) * max_sites)
+    return dict(zip(EVENT_TYPES, counts.reshape(len(EVENT_TYPES), max_sites)))
+
+
+def estimate_thresholds(n_events):
+    """Estimate distance thresholds for uncuts and loops from histograms of
+    events. At long distances, all event types are equally abundant. The
+    threshold of uncuts (+-) and loops (-+) is the closest distance from
+    which their abundance deviates from the median of all event types by at
+    most the expected standard deviation, estimated from the median absolute
+    deviation of all events.
+
+    Parameters
+    ----------
+    n_events : dict
+        Number of events of each type by number of restriction sites, as
+        returned by count_events.
+
+    Returns
+    -------
+    thr_uncut : int
+        Threshold for uncuts.
+    thr_loop : int
+        Threshold for loops.
+
+    Examples
+    --------
+    >>> flat = np.full(20, 100)
+    >>> excess = np.concatenate([[10000, 5000, 1000, 500], np.full(16, 100)])
+    >>> estimate_thresholds({"++": flat, "--": flat, "+-": excess, "-+": flat})
+    (4, 2)
+    """
+    thr_uncut = None
+    thr_loop = None
+    all_events = np.log(np.maximum(np.array(list(n_events.values())), 1))
+    log_uncuts = np.log(np.maximum(n_events["+-"], 1))
+    log_loops = np.log(np.maximum(n_events["-+"], 1))
+    # Compute median occurences at each restriction sites
+    event_med = np.median(all_events, axis=0)
+    # Compute MAD, to have a robust estimator of the expected deviation
+    # from median at long distances
+    mad = np.median(abs(all_events - event_med))
+    exp_stdev = mad / 0.67449
+    # Iterate over sites, from furthest to frag+2
+    for site in range(all_events.shape[1])[:1:-1]:
+        # For uncuts and loops, keep the last (closest) site where the
+        # deviation from other events <= expected_stdev
+        if abs(log_uncuts[site] - event_med[site]) <= exp_stdev:
+            thr_uncut = site
+        if abs(log_loops[site] - event_med[site]) <= exp_stdev:
+            thr_loop = site
+    if thr_uncut is None or thr_loop is None:
+        raise ValueError(
+            "The threshold for loops or uncut could not be estimated. "
+            "Please try running with -i to investigate the problem."
+        )
+    return thr_uncut, thr_loop
+
+
+def get_thresholds(
+    in_dat,
+    interactive=False,
+    plot_events=False,
+    fig_path=None,
+    prefix=None,
+    n_events=None,
+    sample=False,
+):
     """Guess distance threshold for event filtering
 
     Analyse the events in the first million of Hi-C pairs in the library, plot
     the occurrences of each event type according to number of restriction
     fragments, and ask user interactively for the minimum threshold for uncuts
-    and loops.
+    and loops, or estimate them with estimate_thresholds.
 
     Parameters
     ----------
     in_dat: str
-        Path to the .pairs file containing Hi-C pairs.
+        Path to the .pairs file (or binary pairs directory) containing Hi-C
+        pairs. Not read if n_events is given.
     interactive: bool
         If True, plots are diplayed and thresholds are required interactively.
     plot_events : bool
@@ -131,6 +302,12 @@ def get_thresholds(in_dat, interactive=False, plot_events=False, fig_path=None,
         diplayed interactively.
     prefix : str
         If the library has a name, it will be shown on plots.
+    n_events : dict or None
+        Histograms of events, e.g. accumulated with count_events while
+        pairs are streamed through a previous step, to avoid reading in_dat.
+    sample : bool
+        If True, a million pairs are sampled at random over the whole file
+        instead of taking the first ones.
 
     Returns
     -------
@@ -140,7 +317,6 @@ def get_thresholds(in_dat, interactive=False, plot_events=False, fig_path=None,
     """
     thr_uncut = None
     thr_loop = None
-    max_sites = 50
     # Map of event -> legend name of event for intrachromosomal pairs.
     legend = {
         "++": "++ (weird)",
@@ -149,26 +325,18 @@ def get_thresholds(in_dat, interactive=False, plot_events=False, fig_path=None,
         "-+": "-+ (loops)",
     }
     colors = {"++": "#222222", "+-": "r", "--": "#666666", "-+": "tab:orange"}
-    n_events = {event: np.zeros(max_sites) for event in legend}
-    i = 0
-    # open the file for reading (just the first 1 000 000 lines)
-    with open(in_dat) as pairs:
-        for line in pairs:
-            # Skip header lines
-            if line.startswith("#"):
-                continue
-            i += 1
+    if n_events is None:
+        if sample:
+            n_events = sample_events(hio.read_pairs_chunks(in_dat))
+        else:
             # Only use the first million pairs to estimate thresholds
-            if i == 1000000:
-                break
-            # Process Hi-C pair into a dictionary
-            p = process_read_pair(line)
-            # Type of event and number of restriction site between reads
-            etype = p["type"]
-            nsites = p["nsites"]
-            # Count number of events for intrachrom pairs
-            if etype != "inter" and nsites < max_sites:
-                n_events[etype][nsites] += 1
+            pairs = next(hio.read_pairs_chunks(in_dat, chunksize=THRESHOLD_PAIRS), None)
+            n_events = {}
+            if pairs is not None:
+                count_events(pairs, n_events)
+    n_events = {
+        event: np.asarray(n_events.get(event, np.zeros(MAX_SITES)), dtype=float) for event in legend
+    }
 
     def plot_event(n_events, legend, name):
         """Plot the frequency of a given event types over distance."""
@@ -221,27 +389,7 @@ def get_thresholds(in_dat, interactive=False, plot_events=False, fig_path=None,
             fixed = n_events[event]
             fixed[fixed == 0] = 1
             n_events[event] = fixed
-
-        all_events = np.log(np.array(list(n_events.values())))
-        # Compute median occurences at each restriction sites
-        event_med = np.median(all_events, axis=0)
-        # Compute MAD, to have a robust estimator of the expected deviation
-        # from median at long distances
-        mad = np.median(abs(all_events - event_med))
-        exp_stdev = mad / 0.67449
-        # Iterate over sites, from furthest to frag+2
-        for site in range(max_sites)[:1:-1]:
-            # For uncuts and loops, keep the last (closest) site where the
-            # deviation from other events <= expected_stdev
-            if abs(np.log(n_events["+-"][site]) - event_med[site]) <= exp_stdev:
-                thr_uncut = site
-            if abs(np.log(n_events["-+"][site]) - event_med[site]) <= exp_stdev:
-                thr_loop = site
-        if thr_uncut is None or thr_loop is None:
-            raise ValueError(
-                "The threshold for loops or uncut could not be estimated. "
-                "Please try running with -i to investigate the problem."
-            )
+        thr_uncut, thr_loop = estimate_thresholds(n_events)
         logger.info(f"Filtering with thresholds: uncuts={thr_uncut} loops={thr_loop}")
         if plot_events:
             try:
@@ -331,6 +479,7 @@ def filter_events(
     plot_events=False,
     fig_path=None,
     prefix=None,
+    threads=1,
 ):
     """Filter events (loops, uncuts and weirds)
 
@@ -344,6 +493,8 @@ def filter_events(
     ----------
     in_dat : file object
         File handle in read mode to the 2D BED file containing Hi-C pairs.
+        Can also be a binary pairs directory, in which case out_filtered
+        is written as a binary pairs directory.
     out_filtered : file object
         File handle in write mode the output filtered 2D BED file.
     thr_uncut : int
@@ -360,56 +511,210 @@ def filter_events(
         interactively.
     prefix : str
         If the library has a name, it will be shown on plots.
+    threads : int
+        Number of worker processes. If above 1, an uncompressed text pairs
+        file is split in as many parts, which are filtered in parallel.
+
+    Returns
+    -------
+    dict :
+        Number of pairs of each event type: "uncuts", "loops" and "weirds"
+        are discarded, "intra" and "inter" are written to the output.
     """
-    n_uncuts = 0
-    n_loops = 0
-    n_weirds = 0
-    lrange_intra = 0
-    lrange_inter = 0
-
-    # open the files for reading and writing
-    with open(in_dat) as pairs, open(out_filtered, "w") as filtered:
-        for line in pairs:  # iterate over each line
-            # Copy header lines to output
-            if line.startswith("#"):
-                filtered.write(line)
-                continue
-
-            p = process_read_pair(line)
-            line_to_write = (
-                "\t".join(
-                    map(
-                        str,
-                        (
-                            p["readID"],
-                            p["chr1"],
-                            p["pos1"],
-                            p["chr2"],
-                            p["pos2"],
-                            p["strand1"],
-                            p["strand2"],
-                            p["frag1"],
-                            p["frag2"],
-                        ),
-                    )
-                )
-                + "\n"
+    counts = {"uncuts": 0, "loops": 0, "weirds": 0, "intra": 0, "inter": 0}
+
+    # Pairs are filtered by blocks of records parsed into typed columns
+    def filtered_chunks():
+        for chunk in hio.read_pairs_chunks(in_dat):
+            chunk, chunk_counts = filter_pairs(_check_columns(chunk), thr_uncut, thr_loop)
+            for event, count in chunk_counts.items():
+                counts[event] += count
+            yield chunk
+
+    header = hio.get_pairs_header(in_dat)
+    if threads > 1 and not hio.is_binary_pairs(in_dat) and not hio.is_compressed(in_dat):
+        with open(out_filtered, "w") as filtered:
+            for line in header:
+                filtered.write(line + "\n")
+        for shard_counts in _filter_shards(in_dat, out_filtered, thr_uncut, thr_loop, threads):
+            for event, count in shard_counts.items():
+                counts[event] += count
+        hio.index_pairs(out_filtered)
+    elif hio.is_binary_pairs(in_dat):
+        # Binary pairs are filtered into a binary pairs directory
+        read_ids = hio.load_pairs_binary(in_dat)[0]["read_ids"]
+        hio.write_pairs_binary(filtered_chunks(), out_filtered, header, read_ids=read_ids)
+    else:
+        hio.write_pairs(filtered_chunks(), out_filtered, header)
+
+    summarize_events(
+        counts,
+        thr_uncut,
+        thr_loop,
+        plot_events=plot_events,
+        fig_path=fig_path,
+        prefix=prefix,
+    )
+    return counts
+
+
+def _check_columns(pairs):
+    """Check that a block of pairs has the columns of indexed pairs."""
+    if list(pairs.columns) != hio.IDX_PAIRS_COLS:
+        raise ValueError(
+            "Your input file does not have 9 columns. Make sure "
+            "the file has the readID and twice the following 4 fields "
+            "(once for each read in the pair): chr pos strand frag."
+        )
+    return pairs
+
+
+def _filter_shard(shard):
+    """
+    Filter pairs in a byte range of a pairs file to a shard file. Returns the
+    number of pairs of each event type, as given by filter_pairs.
+    """
+    in_dat, start, end, shard_file, thr_uncut, thr_loop, chunksize = shard
+    counts = {"uncuts": 0, "loops": 0, "weirds": 0, "intra": 0, "inter": 0}
+    dtypes = {col: (np.int64 if col in hio.PAIRS_INT_COLS else str) for col in hio.IDX_PAIRS_COLS}
+    lines = hio.read_lines_range(in_dat, start, end)
+    with open(shard_file, "w") as filtered:
+        for block in iter(lambda: list(itertools.islice(lines, chunksize)), []):
+            chunk = pd.read_csv(
+                io.StringIO("".join(block)),
+                sep="\t",
+                header=None,
+                names=hio.IDX_PAIRS_COLS,
+                dtype=dtypes,
+                na_filter=False,
             )
-            if p["chr1"] == p["chr2"]:
-                # Do not report ++ and -- pairs on the same fragment (impossible)
-                if p["frag1"] == p["frag2"] and p["strand1"] == p["strand2"]:
-                    n_weirds += 1
-                elif p["nsites"] <= thr_loop and p["type"] == "-+":
-                    n_loops += 1
-                elif p["nsites"] <= thr_uncut and p["type"] == "+-":
-                    n_uncuts += 1
-                else:
-                    lrange_intra += 1
-                    filtered.write(line_to_write)
+            chunk, chunk_counts = filter_pairs(chunk, thr_uncut, thr_loop)
+            for event, count in chunk_counts.items():
+                counts[event] += count
+            hio.write_pairs_chunk(chunk, filtered)
+    return counts
+
+
+def _filter_shards(in_dat, out_filtered, thr_uncut, thr_loop, threads):
+    """
+    Split the body of a pairs file in line-aligned byte ranges, filter each
+    of them in a worker process and append results to the output file in
+    input order. Returns the counts of each shard.
+    """
+    # Column names of the file are checked once, shards are parsed directly
+    first = next(hio.read_pairs_chunks(in_dat, chunksize=1), None)
+    if first is not None:
+        _check_columns(first)
+    shards = hio.get_line_shards(in_dat, threads)
+    shard_files = [f"{out_filtered}.{i}" for i in range(len(shards))]
+    with multiprocessing.Pool(threads) as pool:
+        shard_counts = pool.map(
+            _filter_shard,
+            [
+                (in_dat, start, end, shard_file, thr_uncut, thr_loop, hio.DEFAULT_PAIRS_CHUNKSIZE)
+                for (start, end), shard_file in zip(shards, shard_files)
+            ],
+        )
+    # Concatenate shards in input order
+    with open(out_filtered, "ab") as filtered:
+        for shard_file in shard_files:
+            with open(shard_file, "rb") as shard:
+                shutil.copyfileobj(shard, filtered)
+            os.remove(shard_file)
+    return shard_counts
+
+
+def _reorder_pairs(pairs):
+    """Swap reads of intrachromosomal pairs where read 2 comes before read 1
+    in genomic coordinates. Returns the reordered pairs and the boolean mask
+    of intrachromosomal pairs."""
+    intra = pairs["chr1"].to_numpy() == pairs["chr2"].to_numpy()
+    flip = intra & (pairs["pos2"].to_numpy() < pairs["pos1"].to_numpy())
+    if flip.any():
+        swapped = {}
+        for col1, col2 in (("pos1", "pos2"), ("strand1", "strand2"), ("frag1", "frag2")):
+            val1, val2 = pairs[col1].to_numpy(), pairs[col2].to_numpy()
+            swapped[col1] = np.where(flip, val2, val1)
+            swapped[col2] = np.where(flip, val1, val2)
+        pairs = pairs.assign(**swapped)
+    return pairs, intra
+
+
+def filter_pairs(pairs, thr_uncut, thr_loop):
+    """Filter events (loops, uncuts and weirds) from a block of pairs.
+
+    Vectorized counterpart of process_read_pair, used by filter_events.
+    Intrachromosomal pairs are first reordered so that read 1 has the smallest
+    genomic coordinate, the same way as in process_read_pair.
 
-            if p["chr1"] != p["chr2"]:
-                lrange_inter += 1
-                filtered.write(line_to_write)
+    Parameters
+    ----------
+    pairs : pandas.DataFrame
+        Block of pairs records with columns readID, chr1, pos1, chr2, pos2,
+        strand1, strand2, frag1, frag2.
+    thr_uncut : int
+        Minimum number of restriction sites between reads to keep an
+        intrachromosomal +- pair.
+    thr_loop : int
+        Minimum number of restriction sites between reads to keep an
+        intrachromosomal -+ pair.
+
+    Returns
+    -------
+    pandas.DataFrame :
+        The reordered records which passed the filters.
+    dict :
+        Number of pairs of each category, with keys "uncuts", "loops",
+        "weirds", "intra" and "inter". The last two are kept pairs.
+    """
+    pairs, intra = _reorder_pairs(pairs)
+    frag1 = pairs["frag1"].to_numpy()
+    frag2 = pairs["frag2"].to_numpy()
+    strand1 = pairs["strand1"].to_numpy()
+    strand2 = pairs["strand2"].to_numpy()
+    # Number of restriction sites separating reads in the pair
+    nsites = np.abs(frag2 - frag1)
+    # Do not report ++ and -- pairs on the same fragment (impossible)
+    weird = intra & (frag1 == frag2) & (strand1 == strand2)
+    loop = intra & ~weird & (nsites <= thr_loop) & (strand1 == "-") & (strand2 == "+")
+    uncut = intra & ~weird & (nsites <= thr_uncut) & (strand1 == "+") & (strand2 == "-")
+    kept = ~(weird | loop | uncut)
+    counts = {
+        "uncuts": int(uncut.sum()),
+        "loops": int(loop.sum()),
+        "weirds": int(weird.sum()),
+        "intra": int((intra & kept).sum()),
+        "inter": int((~intra).sum()),
+    }
+    return pairs[kept], counts
+
+
+def summarize_events(counts, thr_uncut, thr_loop, plot_events=False, fig_path=None, prefix=None):
+    """Log and optionally plot the proportion of each type of event.
+
+    Parameters
+    ----------
+    counts : dict
+        Number of pairs of each category, with keys "uncuts", "loops",
+        "weirds", "intra" and "inter", as returned by filter_pairs.
+    thr_uncut : int
+        Threshold used for uncuts.
+    thr_loop : int
+        Threshold used for loops.
+    plot_events : bool
+        If True, a plot showing the proportion of each type of event will be
+        shown.
+    fig_path : str
+        Path where the figure will be saved. If None, figure is displayed
+        interactively.
+    prefix : str
+        If the library has a name, it will be shown on plots.
+    """
+    n_uncuts = counts["uncuts"]
+    n_loops = counts["loops"]
+    n_weirds = counts["weirds"]
+    lrange_intra = counts["intra"]
+    lrange_inter = counts["inter"]
 
     if lrange_inter > 0:
         ratio_inter = round(100 * lrange_inter / float(lrange_intra + lrange_inter), 2)
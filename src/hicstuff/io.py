@@ -4,13 +4,19 @@ import bz2
 import collections
 import functools
 import gzip
+import heapq
 import io
+import itertools
+import json
 import os
 import pathlib
 import re
+import shutil
 import subprocess as sp
 import sys
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists, join
 from random import getrandbits
 from shutil import which
@@ -20,6 +26,7 @@ import numpy as np
 import pandas as pd
 import scipy.stats as ss
 from Bio import SeqIO, SeqUtils
+from pandas.api.types import is_string_dtype
 from scipy.sparse import coo_matrix, tril, triu
 
 import hicstuff.hicstuff as hcs
@@ -31,6 +38,22 @@ DEFAULT_MAX_MATRIX_SHAPE = 10000
 DEFAULT_FRAGMENTS_LIST_FILE_NAME = "fragments_list.txt"
 DEFAULT_INFO_CONTIGS_FILE_NAME = "info_contigs.txt"
 DEFAULT_SPARSE_MATRIX_FILE_NAME = "abs_fragments_contacts_weighted.txt"
+# Number of pairs records held in memory at once when streaming pairs files
+DEFAULT_PAIRS_CHUNKSIZE = 1000000
+# Number of characters of pairs files read at once when sorting
+DEFAULT_PAIRS_BLOCK_SIZE = 2**26
+
+PAIRS_COLS = ["readID", "chr1", "pos1", "chr2", "pos2", "strand1", "strand2"]
+IDX_PAIRS_COLS = PAIRS_COLS + ["frag1", "frag2"]
+# Pairs columns holding integers, all others are parsed as strings
+PAIRS_INT_COLS = ["pos1", "pos2", "frag1", "frag2"]
+# Metadata file and format version of binary columnar pairs directories
+BINARY_PAIRS_META = "meta.json"
+BINARY_PAIRS_VERSION = 1
+
+# Sidecar index stored next to text pairs files
+PAIRS_INDEX_EXT = ".idx"
+PAIRS_INDEX_STEP = 100000
 
 
 def _cols_to_sparse(sparse_array, shape=None, dtype=np.float64):
@@ -1098,9 +1121,403 @@ def gc_bins(genome_path, frags):
     return gc_bins
 
 
-def sort_pairs(in_file, out_file, keys, tmp_dir=None, threads=1, buffer="2G"):
+def parse_buffer_size(buffer):
     """
-    Sort a pairs file in batches using UNIX sort.
+    Convert a sort buffer size to a number of bytes. The size is a number
+    followed by an optional unit, as in UNIX sort: b (bytes), K, M, G, T
+    (powers of 1024) or % (percentage of physical memory). Numbers without
+    unit are in kibibytes.
+
+    Parameters
+    ----------
+    buffer : str
+        The buffer size, e.g. 500M or 2G.
+
+    Returns
+    -------
+    int :
+        The buffer size in bytes.
+
+    Examples
+    --------
+    >>> parse_buffer_size("2G")
+    2147483648
+    >>> parse_buffer_size("512")
+    524288
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([bkmgt%]?)\s*", str(buffer), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid buffer size: {buffer}")
+    size, unit = float(match.group(1)), match.group(2).lower()
+    if unit == "%":
+        return int(size / 100 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    return int(size * {"b": 1, "": 2**10, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}[unit])
+
+
+def _get_sort_keys(chunk, keys, chrom_codes):
+    """
+    Compute the sort key columns of a block of pairs records. Chromosomes are
+    replaced by their code in chrom_codes, where chromosomes absent from it
+    are added in order of appearance. Positions and fragment indices are
+    integers, other columns are compared as strings.
+    """
+    key_cols = []
+    for key in keys:
+        if key not in chunk.columns:
+            raise KeyError(f"Unknown column name: {key}")
+        values = chunk[key]
+        if key in ("chr1", "chr2"):
+            for chrom in values.unique():
+                chrom_codes.setdefault(chrom, len(chrom_codes))
+            key_cols.append(values.map(chrom_codes).to_numpy(dtype=np.int64))
+        elif key in PAIRS_INT_COLS:
+            key_cols.append(values.to_numpy(dtype=np.int64))
+        else:
+            key_cols.append(values.to_numpy(dtype=object))
+    return key_cols
+
+
+def _argsort_keys(key_cols):
+    """Stable order of records sorted by key columns, by decreasing priority."""
+    # np.lexsort uses the last key as primary key and only compares numbers
+    return np.lexsort(
+        [
+            pd.factorize(col, sort=True)[0] if col.dtype == object else col
+            for col in reversed(key_cols)
+        ]
+    )
+
+
+def _frame_blocks(chunks, keys, chrom_codes):
+    """
+    Convert blocks of pairs records to blocks of record lines and their sort
+    key columns.
+    """
+    for chunk in chunks:
+        if chunk.shape[0]:
+            lines = [record + "\n" for record in format_pairs_chunk(chunk)]
+            yield lines, _get_sort_keys(chunk, keys, chrom_codes)
+
+
+def _read_text_blocks(handle, block_size):
+    """
+    Read an open text file by blocks of about block_size characters ending
+    on line boundaries. A line terminator is added to the last line if it
+    lacks one.
+    """
+    rest = ""
+    for text in iter(lambda: handle.read(block_size), ""):
+        text = rest + text
+        cut = text.rfind("\n") + 1
+        rest = text[cut:]
+        if cut:
+            yield text[:cut]
+    if rest:
+        yield rest + "\n"
+
+
+def _split_lines(text):
+    """
+    Split a block of text ending with a line terminator into its lines,
+    skipping blank lines as pandas.read_csv does, so that lines match the
+    records parsed from the same block.
+    """
+    return [line + "\n" for line in text[:-1].split("\n") if line]
+
+
+def _line_blocks(handle, columns, keys, chrom_codes, block_size):
+    """
+    Read blocks of record lines from an open pairs file positioned after its
+    header, along with their sort key columns. Only key columns are parsed.
+    """
+    key_pos = sorted(columns.index(key) for key in keys)
+    names = [columns[pos] for pos in key_pos]
+    dtypes = {col: (np.int64 if col in PAIRS_INT_COLS else str) for col in names}
+    for text in _read_text_blocks(handle, block_size):
+        lines = _split_lines(text)
+        if not lines:
+            continue
+        # Parse only the key columns of the block at once
+        fields = pd.read_csv(
+            io.StringIO("".join(lines)),
+            sep="\t",
+            header=None,
+            usecols=key_pos,
+            names=names,
+            dtype=dtypes,
+            na_filter=False,
+        )
+        yield lines, _get_sort_keys(fields, keys, chrom_codes)
+
+
+def _run_blocks(run_file, columns, keys, chrom_codes, block_size):
+    """
+    Read a sorted run by blocks of record lines and sort key columns. Keys
+    are loaded from the run keys file if numeric keys were stored.
+    """
+    keys_file = run_file + ".keys.npy"
+    with gzip.open(run_file, "rt") as handle:
+        if not os.path.exists(keys_file):
+            yield from _line_blocks(handle, columns, keys, chrom_codes, block_size)
+            return
+        run_keys = np.load(keys_file, mmap_mode="r")
+        start = 0
+        for text in _read_text_blocks(handle, block_size):
+            lines = _split_lines(text)
+            end = start + len(lines)
+            yield lines, [np.array(run_keys[start:end, i]) for i in range(len(keys))]
+            start = end
+
+
+def _lines_memory(lines, n_keys):
+    """Approximate memory used by record lines, as python strings, and by
+    their sort keys, including temporary copies made while sorting."""
+    return sum(map(len, lines)) + (80 + 16 * n_keys) * len(lines)
+
+
+def _gather_runs(blocks, run_size):
+    """
+    Concatenate consecutive blocks of record lines and sort keys into runs
+    of about run_size bytes in memory.
+    """
+    run_lines, run_keys, run_bytes = [], [], 0
+    for lines, key_cols in blocks:
+        run_lines.extend(lines)
+        run_keys.append(key_cols)
+        run_bytes += _lines_memory(lines, len(key_cols))
+        if run_bytes >= run_size:
+            yield run_lines, [np.concatenate(cols) for cols in zip(*run_keys)]
+            run_lines, run_keys, run_bytes = [], [], 0
+    if run_lines:
+        yield run_lines, [np.concatenate(cols) for cols in zip(*run_keys)]
+
+
+def _drop_duplicates(key_cols, order, last=None):
+    """
+    Remove records with the same keys as the previous one from a sorted
+    order of records. last holds the keys of the record preceding the
+    first one, if any.
+    """
+    if len(order) == 0:
+        return order
+    dup = np.ones(len(order), dtype=bool)
+    for i, col in enumerate(key_cols):
+        values = col[order]
+        dup[1:] &= values[1:] == values[:-1]
+        dup[0] &= last is not None and values[0] == last[i]
+    return order[~dup]
+
+
+def _spill_run(lines, key_cols, run_file, dedup=False):
+    """
+    Sort a run of record lines and write it to a compressed file. Numeric
+    sort keys are saved next to it so that they are not parsed again.
+    """
+    order = _argsort_keys(key_cols)
+    if dedup:
+        order = _drop_duplicates(key_cols, order)
+    with gzip.open(run_file, "wt", compresslevel=1) as handle:
+        for start in range(0, len(order), PAIRS_INDEX_STEP):
+            handle.write("".join([lines[i] for i in order[start : start + PAIRS_INDEX_STEP]]))
+    if all(col.dtype != object for col in key_cols):
+        np.save(run_file + ".keys.npy", np.column_stack(key_cols)[order])
+
+
+def _bisect_keys(key_cols, bound, lo, hi, strict=False):
+    """Position after the last record with keys below bound (or equal to it,
+    unless strict is set) in a range of sorted key columns."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        keys = tuple(col[mid] for col in key_cols)
+        if bound < keys or (strict and bound == keys):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _merge_runs(readers, write, dedup=False):
+    """
+    K-way merge of sorted runs. Runs are read by blocks of records and their
+    key columns, and a heap holds the keys of the last record of each block.
+    All records up to the smallest of those keys are gathered from every run
+    and passed to write, with their sorted order, after which the exhausted
+    blocks are replaced by the next blocks of their runs. Records equal to
+    the smallest key are held back in runs following the run it comes from,
+    to keep the merge stable. If dedup is set, records with the same keys as
+    the previous record written are dropped. Blocks of records can be any
+    sequence supporting len and slicing, write receives the list of slices
+    taken from each run and the order of their concatenated records.
+    """
+    # Current block of each run: records, key columns and next record
+    blocks = [None] * len(readers)
+    heap = []
+
+    def next_block(run):
+        for records, key_cols in readers[run]:
+            blocks[run] = [records, key_cols, 0]
+            heapq.heappush(heap, (tuple(col[-1] for col in key_cols), run))
+            return
+        blocks[run] = None
+
+    for run in range(len(readers)):
+        next_block(run)
+    last = None
+    while heap:
+        bound, bound_run = heap[0]
+        parts, part_keys = [], []
+        for run, block in enumerate(blocks):
+            if block is None:
+                continue
+            records, key_cols, start = block
+            end = _bisect_keys(key_cols, bound, start, len(records), strict=run > bound_run)
+            if end > start:
+                parts.append(records[start:end])
+                part_keys.append([col[start:end] for col in key_cols])
+                block[2] = end
+        # Runs are concatenated in input order, the sort is stable
+        key_cols = [np.concatenate(cols) for cols in zip(*part_keys)]
+        order = _argsort_keys(key_cols)
+        if dedup:
+            last_order, order = order[-1], _drop_duplicates(key_cols, order, last)
+            last = tuple(col[last_order] for col in key_cols)
+        write(parts, order)
+        # Exhausted blocks ended with the smallest key: they are on top of the heap
+        while heap and blocks[heap[0][1]][2] == len(blocks[heap[0][1]][0]):
+            next_block(heapq.heappop(heap)[1])
+
+
+def _spill_runs(runs, run_prefix, threads, dedup=False):
+    """
+    Sort runs of record lines and sort keys and write them to compressed
+    files in a pool of threads. The number of runs in memory is limited to
+    the number of threads. Returns the run files, along with the number of
+    records, of characters and of bytes in memory of all runs.
+    """
+    run_files = []
+    n_pairs = n_chars = n_mem = 0
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for lines, key_cols in runs:
+            if len(pending) >= threads:
+                pending.popleft().result()
+            n_pairs += len(lines)
+            n_chars += sum(map(len, lines))
+            n_mem += _lines_memory(lines, len(key_cols))
+            run_files.append(f"{run_prefix}_{len(run_files)}.pairs.gz")
+            pending.append(pool.submit(_spill_run, lines, key_cols, run_files[-1], dedup))
+            del lines, key_cols
+        for future in pending:
+            future.result()
+    return run_files, n_pairs, n_chars, n_mem
+
+
+def _merge_run_files(run_files, output, index, columns, keys, chrom_codes, block_size, dedup):
+    """Merge sorted run files written by _spill_run into an open pairs file."""
+    readers = [
+        _run_blocks(run_file, columns, keys, chrom_codes, block_size) for run_file in run_files
+    ]
+
+    def write(parts, order):
+        lines = list(itertools.chain.from_iterable(parts))
+        write_records([lines[i] for i in order], output, lineterminator="", index=index)
+
+    try:
+        _merge_runs(readers, write, dedup=dedup)
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _sorted_header(header, keys):
+    """Update the sorting order in pairs header lines."""
+    return [
+        "#sorted: {}".format("-".join(keys)) if line.startswith("#sorted") else line
+        for line in header
+    ]
+
+
+def _sort_blocks(
+    blocks, header, out_file, keys, chrom_codes, tmp_dir, threads, buffer, dedup, stats
+):
+    """
+    External merge sort of blocks of record lines and their sort keys. See
+    sort_pairs_chunks. Returns the number of records written.
+    """
+    columns = _get_sort_columns(header, keys)
+    buffer = parse_buffer_size(buffer)
+    threads = max(1, threads)
+    # One run is gathered while the sorting threads hold one run each
+    runs = _gather_runs(blocks, buffer // (threads + 1))
+    first_run = next(runs, None)
+    second_run = next(runs, None)
+    index = new_pairs_index()
+    n_pairs = 0
+    with open(out_file, "w") as output:
+        for line in _sorted_header(header, keys):
+            output.write(line + "\n")
+        # Small inputs are sorted in memory
+        if second_run is None:
+            if first_run is not None:
+                lines, key_cols = first_run
+                n_pairs = len(lines)
+                order = _argsort_keys(key_cols)
+                if dedup:
+                    order = _drop_duplicates(key_cols, order)
+                write_records([lines[i] for i in order], output, lineterminator="", index=index)
+        else:
+            run_dir = tempfile.mkdtemp(prefix="hicstuff_sort_", dir=tmp_dir)
+            try:
+                runs = itertools.chain([first_run, second_run], runs)
+                first_run = second_run = None
+                run_files, n_pairs, n_chars, n_mem = _spill_runs(
+                    runs, join(run_dir, "run"), threads, dedup
+                )
+                # Share the buffer between one block per run
+                block_size = max(2**16, buffer // (2 * len(run_files)) * n_chars // n_mem)
+                _merge_run_files(
+                    run_files, output, index, columns, keys, chrom_codes, block_size, dedup
+                )
+            finally:
+                shutil.rmtree(run_dir)
+    write_pairs_index(out_file, index)
+    if stats is not None:
+        stats["pairs"] = stats.get("pairs", 0) + n_pairs
+        stats["duplicates"] = stats.get("duplicates", 0) + n_pairs - index["n_pairs"]
+    return index["n_pairs"]
+
+
+def _get_sort_columns(header, keys):
+    """
+    Get pairs columns from the "#columns:" header line, or standard hicstuff
+    columns if there is none, and check that sort keys are among them.
+    """
+    columns = IDX_PAIRS_COLS
+    for line in header:
+        if line.startswith("#columns:"):
+            columns = line.split()[1:]
+    for key in keys:
+        if key not in columns:
+            raise KeyError(f"Unknown column name: {key}")
+    return columns
+
+
+def _get_chrom_codes(header):
+    """Map chromosomes to their rank in the "#chromsize" lines of a header."""
+    chrom_codes = {}
+    for line in header:
+        if line.startswith("#chromsize"):
+            chrom_codes.setdefault(line.split()[1], len(chrom_codes))
+    return chrom_codes
+
+
+def sort_pairs(
+    in_file, out_file, keys, tmp_dir=None, threads=1, buffer="2G", dedup=False, stats=None
+):
+    """
+    Sort a pairs file with an external merge sort. Only the key columns are
+    parsed, records are written as they appear in the input file, with
+    newline line terminators. See sort_pairs_chunks for the sorting order.
 
     Parameters
     ----------
@@ -1110,75 +1527,1088 @@ def sort_pairs(in_file, out_file, keys, tmp_dir=None, threads=1, buffer="2G"):
         Path to the sorted output file.
     keys : list of str
         list of columns to use as sort keys. Each column can be one of readID,
-        chr1, pos1, chr2, pos2, frag1, frag2. Key priorities are according to
-        the order in the list.
+        chr1, pos1, chr2, pos2, strand1, strand2, frag1, frag2. Key priorities
+        are according to the order in the list.
     tmp_dir : str
         Path to the directory where temporary files will be created. Defaults
-        to current directory.
+        to the system temporary directory.
     threads : int
         Number of parallel sorting threads.
     buffer : str
-        Buffer size used for sorting. Consists of a number and a unit.
+        Memory used for sorting, shared by all threads. Consists of a number
+        and a unit, as in UNIX sort (e.g. 500M, 2G).
+    dedup : bool
+        Whether to drop records with the same keys as the previous one while
+        sorting, keeping the first of each group of duplicates.
+    stats : dict or None
+        If given, the number of input records ("pairs") and of duplicates
+        dropped ("duplicates") are added to it.
+
+    Returns
+    -------
+    int :
+        The number of records written.
     """
-    # TODO: Write a pure python implementation to drop GNU coreutils depencency,
-    # could be inspired from: https://stackoverflow.com/q/14465154/8440675
+    header = get_pairs_header(in_file)
+    columns = _get_sort_columns(header, keys)
+    chrom_codes = _get_chrom_codes(header)
+    # Blocks read must be small enough to fill runs without exceeding the buffer
+    block_size = max(2**16, min(DEFAULT_PAIRS_BLOCK_SIZE, parse_buffer_size(buffer) // 8))
+    with read_compressed(in_file) as handle:
+        # Skip header lines
+        for _ in header:
+            handle.readline()
+        return _sort_blocks(
+            _line_blocks(handle, columns, keys, chrom_codes, block_size // (max(1, threads) + 1)),
+            header,
+            out_file,
+            keys,
+            chrom_codes,
+            tmp_dir,
+            threads,
+            buffer,
+            dedup,
+            stats,
+        )
 
-    # Check if UNIX sort version supports parallelism
-    parallel_ok = True
-    sort_ver = sp.Popen(["sort", "--version"], stdout=sp.PIPE)
-    sort_ver = sort_ver.communicate()[0].decode().split("\n")[0].split(" ")[-1].split(".")
-    # If so, specify threads, otherwise don't mention it in the command line
-    try:
-        sort_ver = list(map(int, sort_ver))
-        if sort_ver[0] < 8 or (sort_ver[0] == 8 and sort_ver[1] < 23):
-            logger.warning(
-                "GNU sort version is {} but >8.23 is required for parallel "
-                "sort. Sorting on a single thread.".format(".".join(map(str, sort_ver)))
+
+def sort_pairs_chunks(
+    chunks,
+    header,
+    out_file,
+    keys,
+    tmp_dir=None,
+    threads=1,
+    buffer="2G",
+    dedup=False,
+    stats=None,
+):
+    """
+    Sort a stream of pairs records with an external merge sort. Records are
+    gathered in runs filling the buffer, each run is sorted and written to a
+    compressed temporary file in a pool of threads, and runs are then merged.
+    If all records fit in a single run, they are sorted in memory. The sort
+    is stable. Chromosomes are sorted in the order of the "#chromsize" header
+    lines, then by order of appearance for chromosomes missing from the
+    header. Other strings are sorted by code points, numbers numerically. A
+    sidecar index is written next to the sorted file. Duplicate records can
+    be dropped as runs are sorted and merged, removing PCR duplicates
+    without a separate pass.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records, as generated by read_pairs_chunks.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines.
+    out_file : str
+        Path to the sorted output file.
+    keys : list of str
+        list of columns to use as sort keys. See sort_pairs.
+    tmp_dir : str
+        Path to the directory where temporary files will be created. Defaults
+        to the system temporary directory.
+    threads : int
+        Number of parallel sorting threads.
+    buffer : str
+        Memory used for sorting, shared by all threads. Consists of a number
+        and a unit, as in UNIX sort (e.g. 500M, 2G).
+    dedup : bool
+        Whether to drop records with the same keys as the previous one while
+        sorting, keeping the first of each group of duplicates.
+    stats : dict or None
+        If given, the number of input records ("pairs") and of duplicates
+        dropped ("duplicates") are added to it.
+
+    Returns
+    -------
+    int :
+        The number of records written.
+    """
+    chrom_codes = _get_chrom_codes(header)
+    return _sort_blocks(
+        _frame_blocks(chunks, keys, chrom_codes),
+        header,
+        out_file,
+        keys,
+        chrom_codes,
+        tmp_dir,
+        threads,
+        buffer,
+        dedup,
+        stats,
+    )
+
+
+def write_pairs_runs(blocks, header, run_prefix, keys, buffer="2G", threads=1, dedup=False):
+    """
+    Sort a stream of pairs records into sorted runs, to be merged with
+    merge_pairs_runs. This is the first half of sort_pairs_chunks, which
+    lets runs be produced in separate processes, each sorting its own part
+    of the records, and merged in a single pass. Records are only parsed by
+    the caller, and written as given.
+
+    Parameters
+    ----------
+    blocks : iterable of tuple
+        Blocks of records, as pairs of a list of record lines without line
+        terminators and a pandas.DataFrame with at least the sort key
+        columns of the same records.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines. Records on
+        chromosomes absent from its "#chromsize" lines cannot be sorted by
+        chromosome in separate runs.
+    run_prefix : str
+        Prefix of the paths of run files.
+    keys : list of str
+        list of columns to use as sort keys. See sort_pairs.
+    buffer : str
+        Memory used for sorting, shared by all threads. Consists of a number
+        and a unit, as in UNIX sort (e.g. 500M, 2G).
+    threads : int
+        Number of parallel sorting threads.
+    dedup : bool
+        Whether to drop records with the same keys as the previous one in
+        each run.
+
+    Returns
+    -------
+    list of str :
+        Paths of the run files, in input order.
+    """
+    _get_sort_columns(header, keys)
+    chrom_codes = _get_chrom_codes(header)
+    n_chroms = len(chrom_codes)
+    threads = max(1, threads)
+
+    def line_blocks():
+        for lines, chunk in blocks:
+            if chunk.shape[0]:
+                key_cols = _get_sort_keys(chunk, keys, chrom_codes)
+                if len(chrom_codes) > n_chroms:
+                    raise ValueError("Chromosomes of pairs records are missing from the header.")
+                yield [line + "\n" for line in lines], key_cols
+
+    runs = _gather_runs(line_blocks(), parse_buffer_size(buffer) // (threads + 1))
+    return _spill_runs(runs, run_prefix, threads, dedup)[0]
+
+
+def merge_pairs_runs(run_files, header, out_file, keys, buffer="2G", dedup=False):
+    """
+    Merge runs written by write_pairs_runs into a sorted pairs file, along
+    with its sidecar index. The merge is stable: records with equal keys
+    are written in the order of run_files.
+
+    Parameters
+    ----------
+    run_files : list of str
+        Paths of the run files.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines, as given
+        to write_pairs_runs.
+    out_file : str
+        Path to the sorted output file.
+    keys : list of str
+        Sort keys used to write the runs.
+    buffer : str
+        Memory used for merging. Consists of a number and a unit, as in UNIX
+        sort (e.g. 500M, 2G).
+    dedup : bool
+        Whether to drop records with the same keys as the previous one.
+
+    Returns
+    -------
+    int :
+        The number of records written.
+    """
+    columns = _get_sort_columns(header, keys)
+    chrom_codes = _get_chrom_codes(header)
+    # Share the buffer between one block per run, lines in memory take about
+    # three times their number of characters
+    block_size = max(2**16, parse_buffer_size(buffer) // (6 * max(1, len(run_files))))
+    index = new_pairs_index()
+    with open(out_file, "w") as output:
+        for line in _sorted_header(header, keys):
+            output.write(line + "\n")
+        _merge_run_files(run_files, output, index, columns, keys, chrom_codes, block_size, dedup)
+    write_pairs_index(out_file, index)
+    return index["n_pairs"]
+
+
+def read_pairs_chunks(pairs, chunksize=DEFAULT_PAIRS_CHUNKSIZE):
+    """
+    Iterate over the records of a pairs file, in blocks of consecutive
+    records. Header lines are skipped and column names are read from the
+    "#columns:" header line. If the header has no such line, columns are
+    named after the standard hicstuff pairs columns (readID chr1 pos1 chr2
+    pos2 strand1 strand2 frag1 frag2).
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the pairs file. Compressed files and binary pairs
+        directories (see write_pairs_binary) are supported.
+    chunksize : int
+        Maximum number of records in each block.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        Block of records with one column per pairs column. pos1, pos2, frag1
+        and frag2 are parsed as 64 bits integers, all other columns as
+        strings.
+    """
+    if is_binary_pairs(pairs):
+        yield from _read_pairs_binary_chunks(pairs, chunksize=chunksize)
+        return
+    yield from _read_pairs_text_chunks(pairs, chunksize=chunksize)
+
+
+def read_pairs_columns(pairs, columns=None, chunksize=DEFAULT_PAIRS_CHUNKSIZE):
+    """
+    Iterate over selected columns of a pairs file, in blocks of consecutive
+    records, as arrays. Only the selected columns of text pairs are parsed,
+    and at most chunksize records are held in memory, whatever the size of
+    the file. Column names are found as in read_pairs_chunks.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the pairs file. Files compressed with gzip or bgzip (or bz2,
+        zip) and binary pairs directories (see write_pairs_binary) are
+        supported.
+    columns : list of str or None
+        Names of the columns to read. All columns are read if None.
+    chunksize : int
+        Maximum number of records in each block.
+
+    Yields
+    ------
+    dict :
+        Block of records as a numpy.ndarray per column name, in the order of
+        columns. pos1, pos2, frag1 and frag2 are 64 bits integers, all other
+        columns are arrays of strings (objects).
+
+    Examples
+    --------
+    >>> chunks = read_pairs_columns("test_data/valid_idx.pairs", ["chr1", "frag1"], 4000)
+    >>> [len(chunk["frag1"]) for chunk in chunks]
+    [4000, 4000, 2000]
+    """
+    names = get_pairs_columns(pairs)
+    if columns is None:
+        columns = names
+    missing = [col for col in columns if col not in names]
+    if missing:
+        raise ValueError(f"Columns missing from pairs file {pairs}: {', '.join(missing)}")
+    if is_binary_pairs(pairs):
+        chunks = _read_pairs_binary_chunks(pairs, chunksize=chunksize)
+    else:
+        chunks = _read_pairs_text_chunks(pairs, chunksize=chunksize, usecols=columns)
+    for chunk in chunks:
+        yield {col: chunk[col].to_numpy() for col in columns}
+
+
+def get_pairs_columns(pairs):
+    """
+    Get the column names of a pairs file, from its "#columns:" header line,
+    or named after the standard hicstuff pairs columns (readID chr1 pos1 chr2
+    pos2 strand1 strand2 frag1 frag2) according to the number of columns of
+    the first record.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the pairs file, possibly compressed, or binary pairs
+        directory.
+
+    Returns
+    -------
+    list of str :
+        The names of the columns.
+
+    Examples
+    --------
+    >>> get_pairs_columns("test_data/valid.pairs")
+    ['readID', 'chr1', 'pos1', 'chr2', 'pos2', 'strand1', 'strand2']
+    """
+    if is_binary_pairs(pairs):
+        return load_pairs_binary(pairs)[0]["columns"]
+    header = get_pairs_header(pairs)
+    for line in header:
+        if line.startswith("#columns:"):
+            return line.split()[1:]
+    with read_compressed(pairs) as handle:
+        # Count columns of the first record
+        for _ in header:
+            handle.readline()
+        n_cols = len(handle.readline().split("\t"))
+    return IDX_PAIRS_COLS[:n_cols]
+
+
+def _read_pairs_text_chunks(pairs, chunksize=DEFAULT_PAIRS_CHUNKSIZE, usecols=None):
+    """Generates blocks of records from a text pairs file, with only the
+    columns in usecols if given. See read_pairs_chunks."""
+    header = get_pairs_header(pairs)
+    names = get_pairs_columns(pairs)
+    with read_compressed(pairs) as handle:
+        # Skip header lines
+        for _ in header:
+            handle.readline()
+        dtypes = {col: (np.int64 if col in PAIRS_INT_COLS else str) for col in names}
+        try:
+            reader = pd.read_csv(
+                handle,
+                sep="\t",
+                header=None,
+                names=names,
+                usecols=usecols,
+                dtype=dtypes,
+                na_filter=False,
+                chunksize=chunksize,
             )
-            parallel_ok = False
-    # BSD sort has a different format and will throw error upon parsing. It does
-    # not support parallel processes anyway.
-    except ValueError:
-        logger.warning("Using BSD sort instead of GNU sort, sorting on a single thread.")
-        parallel_ok = False
-
-    key_map = {
-        "readID": "-k1,1d",
-        "chr1": "-k2,2V",
-        "pos1": "-k3,3n",
-        "chr2": "-k4,4V",
-        "pos2": "-k5,5n",
-        "strand1": "-k6,6d",
-        "strand2": "-k7,7d",
-        "frag1": "-k8,8n",
-        "frag2": "-k9,9n",
-    }
+            yield from reader
+        # Pairs file without any record
+        except pd.errors.EmptyDataError:
+            return
 
-    # transform column names to corresponding sort keys
-    try:
-        sort_keys = map(lambda k: key_map[k], keys)
-    except KeyError:
-        print("Unkown column name.")
-        raise
-    # Rewrite header with new sorting order
-    header = get_pairs_header(in_file)
+
+def write_pairs_chunk(chunk, handle, lineterminator="\n", index=None):
+    """
+    Write a block of pairs records to an open file handle.
+
+    Parameters
+    ----------
+    chunk : pandas.DataFrame
+        Block of records, with columns in pairs order.
+    handle : file object
+        Text handle in write mode.
+    lineterminator : str
+        Character sequence terminating each record.
+    index : dict or None
+        Pairs index being built for the file, as returned by new_pairs_index.
+        If given, the record count and the byte offsets of every index step
+        are updated. The handle must then support tell().
+    """
+    if chunk.shape[0] == 0:
+        return
+    write_records(format_pairs_chunk(chunk), handle, lineterminator=lineterminator, index=index)
+
+
+def format_pairs_chunk(chunk):
+    """
+    Format a block of pairs records as a list of tab-separated strings,
+    without line terminators.
+    """
+    # Joining python strings is about twice faster than DataFrame.to_csv
+    cols = [
+        chunk[col].tolist() if is_string_dtype(chunk[col]) else map(str, chunk[col].tolist())
+        for col in chunk.columns
+    ]
+    return list(map("\t".join, zip(*cols)))
+
+
+def write_records(records, handle, lineterminator="\n", index=None):
+    """
+    Write pairs records, given as strings without line terminators, to an
+    open file handle and update the pairs index if given. See
+    write_pairs_chunk.
+    """
+    if index is None:
+        handle.write(lineterminator.join(records) + lineterminator)
+        return
+    step = index["step"]
+    start = 0
+    # Records starting an index step are written separately to get offsets
+    for first in range(-index["n_pairs"] % step, len(records), step):
+        if first > start:
+            handle.write(lineterminator.join(records[start:first]) + lineterminator)
+        index["offsets"].append(handle.tell())
+        start = first
+    if len(records) > start:
+        handle.write(lineterminator.join(records[start:]) + lineterminator)
+    index["n_pairs"] += len(records)
+
+
+def write_pairs(chunks, out_file, header):
+    """
+    Write a pairs file from its header and a stream of records. A sidecar
+    index is written next to the file (see write_pairs_index).
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records, as generated by read_pairs_chunks.
+    out_file : str
+        Path to the output pairs file.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines.
+
+    Returns
+    -------
+    int :
+        The number of records written.
+    """
+    index = new_pairs_index()
     with open(out_file, "w") as output:
         for line in header:
-            if line.startswith("#sorted"):
-                output.write("#sorted: {}\n".format("-".join(keys)))
+            output.write(line + "\n")
+        for chunk in chunks:
+            write_pairs_chunk(chunk, output, index=index)
+    write_pairs_index(out_file, index)
+    return index["n_pairs"]
+
+
+def get_pairs_index_path(pairs):
+    """Return the path to the sidecar index of a pairs file."""
+    return pairs + PAIRS_INDEX_EXT
+
+
+def new_pairs_index(step=PAIRS_INDEX_STEP):
+    """
+    Make an empty pairs index, to be filled by write_pairs_chunk.
+
+    Parameters
+    ----------
+    step : int
+        Number of records between two indexed byte offsets.
+
+    Returns
+    -------
+    dict :
+        The index, with the number of records in "n_pairs", and the byte
+        offsets of records 0, step, 2 * step... in "offsets".
+    """
+    return {"n_pairs": 0, "step": step, "offsets": []}
+
+
+def write_pairs_index(pairs, index):
+    """
+    Write the sidecar index of a complete pairs file. The size and
+    modification time of the pairs file are added to the index so that
+    stale indices can be detected.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the indexed pairs file.
+    index : dict
+        Pairs index, as built by write_pairs_chunk or index_pairs.
+    """
+    stat = os.stat(pairs)
+    index.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    with open(get_pairs_index_path(pairs), "w") as handle:
+        json.dump(index, handle)
+
+
+def read_pairs_index(pairs):
+    """
+    Read the sidecar index of a pairs file.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the pairs file.
+
+    Returns
+    -------
+    dict or None :
+        The pairs index (see new_pairs_index), or None if the file has no
+        index or if the file changed since it was indexed.
+    """
+    try:
+        with open(get_pairs_index_path(pairs)) as handle:
+            index = json.load(handle)
+        stat = os.stat(pairs)
+    except (OSError, ValueError):
+        return None
+    if (index.get("size"), index.get("mtime_ns")) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return index
+
+
+def index_pairs(pairs, step=PAIRS_INDEX_STEP, block_size=2**24):
+    """
+    Scan an uncompressed pairs file to build and write its sidecar index.
+    Only line terminators are searched, without parsing records. This is
+    used for files written by external programs.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the uncompressed pairs file.
+    step : int
+        Number of records between two indexed byte offsets.
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    dict :
+        The pairs index.
+    """
+    index = new_pairs_index(step)
+    with open(pairs, "rb") as handle:
+        body_start = 0
+        for line in handle:
+            if not line.startswith(b"#"):
+                break
+            body_start += len(line)
+        handle.seek(body_start)
+        file_size = os.fstat(handle.fileno()).st_size
+        n_lines = 0
+        offset = body_start
+        for block in iter(lambda: handle.read(block_size), b""):
+            ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            # Record k * step starts after the (k * step)th line terminator
+            first = (-n_lines - 1) % step
+            index["offsets"].extend((offset + ends[first::step] + 1).tolist())
+            n_lines += len(ends)
+            offset += len(block)
+    # Last record may lack a line terminator
+    has_partial = file_size > body_start and not _ends_with_newline(pairs)
+    index["n_pairs"] = n_lines + has_partial
+    if index["n_pairs"] > 0:
+        index["offsets"] = [body_start] + [o for o in index["offsets"] if o < file_size]
+    else:
+        index["offsets"] = []
+    write_pairs_index(pairs, index)
+    return index
+
+
+def _ends_with_newline(path):
+    """Whether a non-empty file ends with a line terminator."""
+    with open(path, "rb") as handle:
+        handle.seek(-1, os.SEEK_END)
+        return handle.read(1) == b"\n"
+
+
+def rename_pairs(src, dst):
+    """
+    Rename a pairs file along with its sidecar index, if any.
+
+    Parameters
+    ----------
+    src : str
+        Path to the pairs file.
+    dst : str
+        New path of the pairs file.
+    """
+    os.rename(src, dst)
+    if os.path.exists(get_pairs_index_path(src)):
+        os.rename(get_pairs_index_path(src), get_pairs_index_path(dst))
+
+
+def is_binary_pairs(pairs):
+    """Check whether pairs is a binary columnar pairs directory."""
+    return os.path.isdir(pairs) and exists(join(pairs, BINARY_PAIRS_META))
+
+
+def _binary_pairs_path(pairs, name):
+    """Path to the data file of a column in a binary pairs directory."""
+    return join(pairs, name + ".bin")
+
+
+def init_pairs_binary(out_dir):
+    """
+    Create an empty binary columnar pairs directory, removing data files
+    from any previous content.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the binary pairs directory.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.endswith(".bin") or name == BINARY_PAIRS_META:
+            os.remove(join(out_dir, name))
+
+
+def write_pairs_binary_chunk(chunk, out_dir, chroms, read_ids="keep"):
+    """
+    Append a block of pairs records to a binary columnar pairs directory.
+    Each column is stored as a raw array in its own file: chromosomes as
+    int32 codes (index in the header "#chromsize:" lines), positions as int32,
+    both strands packed in the two lowest bits of a uint8 (set for "-") and
+    fragment indices as int64.
+
+    Parameters
+    ----------
+    chunk : pandas.DataFrame
+        Block of records, as generated by read_pairs_chunks.
+    out_dir : str
+        Path to the binary pairs directory, created with init_pairs_binary.
+    chroms : list of str
+        Chromosome names, in the order of the pairs header.
+    read_ids : str
+        How to store read names: "keep" stores them as text, "hash" as 64
+        bits hashes and "drop" does not store them.
+    """
+    if read_ids not in ("keep", "hash", "drop"):
+        raise ValueError("read_ids must be one of keep, hash or drop.")
+    unknown = set(chunk.columns) - set(IDX_PAIRS_COLS)
+    if unknown:
+        raise ValueError(f"Unsupported columns in binary pairs: {', '.join(unknown)}")
+    columns = {}
+    for col in ("chr1", "chr2"):
+        codes = pd.Categorical(chunk[col], categories=chroms).codes.astype(np.int32)
+        if np.any(codes < 0):
+            raise ValueError("Chromosomes of pairs must be listed in the pairs header.")
+        columns[col] = codes
+    for col in ("pos1", "pos2"):
+        pos = chunk[col].to_numpy()
+        if len(pos) and pos.max() > np.iinfo(np.int32).max:
+            raise ValueError("Positions above 2^31 cannot be stored in binary pairs.")
+        columns[col] = pos.astype(np.int32)
+    columns["strands"] = (chunk.strand1.to_numpy() == "-").astype(np.uint8) | (
+        (chunk.strand2.to_numpy() == "-").astype(np.uint8) << 1
+    )
+    for col in ("frag1", "frag2"):
+        if col in chunk.columns:
+            columns[col] = chunk[col].to_numpy().astype(np.int64)
+    if read_ids == "hash":
+        columns["readID"] = pd.util.hash_array(chunk.readID.to_numpy(dtype=object))
+    for name, values in columns.items():
+        with open(_binary_pairs_path(out_dir, name), "ab") as out:
+            values.tofile(out)
+    if read_ids == "keep":
+        _append_read_ids(chunk.readID.tolist(), out_dir)
+
+
+def _append_read_ids(names, out_dir):
+    """
+    Append read names to a binary pairs directory. Names are stored as
+    newline-terminated text, with the end offset of each name in a separate
+    file to allow random access.
+    """
+    if not names:
+        return
+    names = ("\n".join(names) + "\n").encode()
+    names_file = _binary_pairs_path(out_dir, "readID")
+    offset = os.path.getsize(names_file) if exists(names_file) else 0
+    ends = np.flatnonzero(np.frombuffer(names, dtype=np.uint8) == ord("\n")) + 1 + offset
+    with open(names_file, "ab") as out:
+        out.write(names)
+    with open(_binary_pairs_path(out_dir, "readID_end"), "ab") as out:
+        ends.astype(np.int64).tofile(out)
+
+
+def write_pairs_binary_meta(out_dir, header, read_ids="keep"):
+    """
+    Write the metadata of a binary columnar pairs directory once all records
+    have been appended with write_pairs_binary_chunk.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the binary pairs directory.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines.
+    read_ids : str
+        How read names were stored, see write_pairs_binary_chunk.
+
+    Returns
+    -------
+    int :
+        The number of records in the directory.
+    """
+    pos_file = _binary_pairs_path(out_dir, "pos1")
+    n_pairs = os.path.getsize(pos_file) // 4 if exists(pos_file) else 0
+    columns = PAIRS_COLS[:]
+    if exists(_binary_pairs_path(out_dir, "frag1")):
+        columns += ["frag1", "frag2"]
+    meta = {
+        "format": "hicstuff binary pairs",
+        "version": BINARY_PAIRS_VERSION,
+        "n_pairs": n_pairs,
+        "columns": columns,
+        "read_ids": read_ids,
+        "chroms": [line.split()[1] for line in header if line.startswith("#chromsize")],
+        "header": header,
+    }
+    with open(join(out_dir, BINARY_PAIRS_META), "w") as out:
+        json.dump(meta, out, indent=2)
+    return n_pairs
+
+
+def write_pairs_binary(chunks, out_dir, header, read_ids="keep"):
+    """
+    Write a binary columnar pairs directory from its header and a stream of
+    records. See write_pairs_binary_chunk for the storage of columns.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records, as generated by read_pairs_chunks.
+    out_dir : str
+        Path to the output binary pairs directory.
+    header : list of str
+        Header lines of the pairs file, without trailing newlines.
+    read_ids : str
+        How to store read names: "keep", "hash" or "drop".
+
+    Returns
+    -------
+    int :
+        The number of records written.
+    """
+    chroms = [line.split()[1] for line in header if line.startswith("#chromsize")]
+    init_pairs_binary(out_dir)
+    for chunk in chunks:
+        write_pairs_binary_chunk(chunk, out_dir, chroms, read_ids=read_ids)
+    return write_pairs_binary_meta(out_dir, header, read_ids=read_ids)
+
+
+def load_pairs_binary(pairs):
+    """
+    Memory-map the columns of a binary columnar pairs directory.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the binary pairs directory.
+
+    Returns
+    -------
+    meta : dict
+        Metadata of the directory, with keys "n_pairs", "columns", "chroms",
+        "read_ids" and "header".
+    columns : dict of numpy.ndarray
+        Read-only arrays of stored values. Chromosomes are stored as codes in
+        "chr1" and "chr2", strands as bits in "strands", hashed read names in
+        "readID" and text read names in "readID" (bytes) with their end
+        offsets in "readID_end".
+    """
+    with open(join(pairs, BINARY_PAIRS_META)) as handle:
+        meta = json.load(handle)
+    dtypes = {
+        "chr1": np.int32,
+        "chr2": np.int32,
+        "pos1": np.int32,
+        "pos2": np.int32,
+        "strands": np.uint8,
+        "frag1": np.int64,
+        "frag2": np.int64,
+        "readID": {"keep": np.uint8, "hash": np.uint64}.get(meta["read_ids"]),
+        "readID_end": np.int64,
+    }
+    columns = {}
+    for name, dtype in dtypes.items():
+        path = _binary_pairs_path(pairs, name)
+        if dtype is None or not exists(path):
+            continue
+        # Empty files cannot be memory-mapped
+        if os.path.getsize(path) == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(path, dtype=dtype, mode="r")
+    return meta, columns
+
+
+def _read_pairs_binary_chunks(pairs, chunksize=DEFAULT_PAIRS_CHUNKSIZE):
+    """Generates blocks of records from a binary pairs directory, decoded as
+    read_pairs_chunks does for text pairs files."""
+    meta, columns = load_pairs_binary(pairs)
+    chroms = np.array(meta["chroms"], dtype=object)
+    strands = np.array(["+", "-"], dtype=object)
+    for start in range(0, meta["n_pairs"], chunksize):
+        end = min(start + chunksize, meta["n_pairs"])
+        chunk = {}
+        for col in meta["columns"]:
+            if col == "readID":
+                if meta["read_ids"] == "keep":
+                    ends = columns["readID_end"]
+                    first = ends[start - 1] if start > 0 else 0
+                    names = columns["readID"][first : ends[end - 1]].tobytes().decode()
+                    chunk[col] = names.split("\n")[:-1]
+                elif meta["read_ids"] == "hash":
+                    chunk[col] = columns["readID"][start:end].astype(str)
+                else:
+                    chunk[col] = np.full(end - start, ".", dtype=object)
+            elif col in ("chr1", "chr2"):
+                chunk[col] = chroms[columns[col][start:end]]
+            elif col in ("strand1", "strand2"):
+                bit = int(col[-1]) - 1
+                chunk[col] = strands[(columns["strands"][start:end] >> bit) & 1]
+            else:
+                chunk[col] = columns[col][start:end].astype(np.int64)
+        yield pd.DataFrame(chunk)
+
+
+def _binary_records(meta, columns, start, end):
+    """
+    Block of records of a binary pairs directory, with columns as stored
+    except read names kept as text, which are decoded. The block must not
+    be empty.
+    """
+    block = {}
+    for name, values in columns.items():
+        if name == "readID_end":
+            continue
+        if name == "readID" and meta["read_ids"] == "keep":
+            ends = columns["readID_end"]
+            first = ends[start - 1] if start > 0 else 0
+            names = values[first : ends[end - 1]].tobytes().decode()
+            block[name] = np.array(names.split("\n")[:-1], dtype=object)
+        else:
+            block[name] = np.array(values[start:end])
+    return pd.DataFrame(block)
+
+
+def _append_binary_records(records, out_dir, read_ids):
+    """Append a block of records, as given by _binary_records, to a binary
+    pairs directory."""
+    for name in records.columns:
+        if name == "readID" and read_ids == "keep":
+            _append_read_ids(records[name].tolist(), out_dir)
+        else:
+            with open(_binary_pairs_path(out_dir, name), "ab") as out:
+                records[name].to_numpy().tofile(out)
+
+
+def _binary_sort_keys(records, keys):
+    """
+    Sort key columns of a block of records given by _binary_records.
+    Chromosomes are sorted by code and strands by bit, which gives the
+    order of sort_pairs. Hashed read names are sorted as numbers.
+    """
+    key_cols = []
+    for key in keys:
+        if key in ("strand1", "strand2"):
+            bit = int(key[-1]) - 1
+            key_cols.append(((records["strands"].to_numpy() >> bit) & 1).astype(np.int64))
+        elif key == "readID" and key in records.columns:
+            values = records[key].to_numpy()
+            key_cols.append(values if values.dtype == np.uint64 else values.astype(object))
+        elif key in records.columns:
+            key_cols.append(records[key].to_numpy().astype(np.int64))
+        else:
+            raise KeyError(f"Unknown column name: {key}")
+    return key_cols
+
+
+def _binary_run_blocks(run_dir, keys, block_size):
+    """Read a sorted binary run by blocks of records and sort key columns."""
+    meta, columns = load_pairs_binary(run_dir)
+    for start in range(0, meta["n_pairs"], block_size):
+        records = _binary_records(meta, columns, start, min(start + block_size, meta["n_pairs"]))
+        yield records, _binary_sort_keys(records, keys)
+
+
+def sort_pairs_binary(
+    in_pairs,
+    out_pairs,
+    keys,
+    chunksize=DEFAULT_PAIRS_CHUNKSIZE,
+    tmp_dir=None,
+    buffer="2G",
+    dedup=False,
+    stats=None,
+):
+    """
+    Sort a binary columnar pairs directory with an external merge sort.
+    Consecutive records are read in runs filling the buffer, each run is
+    sorted in memory and written to a temporary binary pairs directory, and
+    runs are then merged by blocks. If all records fit in a single run, they
+    are sorted in memory. The sort is stable. Chromosomes are sorted in the
+    order of the pairs header, other columns as in sort_pairs, except hashed
+    read names which are sorted as numbers.
+
+    Parameters
+    ----------
+    in_pairs : str
+        Path to the input binary pairs directory.
+    out_pairs : str
+        Path to the sorted output binary pairs directory.
+    keys : list of str
+        List of columns to use as sort keys, by decreasing priority.
+    chunksize : int
+        Maximum number of records gathered and written at once.
+    tmp_dir : str
+        Path to the directory where temporary runs will be created. Defaults
+        to the system temporary directory.
+    buffer : str
+        Memory used for sorting. Consists of a number and a unit, as in UNIX
+        sort (e.g. 500M, 2G).
+    dedup : bool
+        Whether to drop records with the same keys as the previous one while
+        sorting, keeping the first of each group of duplicates.
+    stats : dict or None
+        If given, the number of input records ("pairs") and of duplicates
+        dropped ("duplicates") are added to it.
+
+    Returns
+    -------
+    int :
+        The number of records written.
+    """
+    meta, columns = load_pairs_binary(in_pairs)
+    n_pairs, read_ids = meta["n_pairs"], meta["read_ids"]
+    # Memory used by a record in a run: stored columns, read names as python
+    # strings, sort keys and copies made while sorting
+    record_size = sum(
+        values.itemsize for name, values in columns.items() if not name.startswith("readID")
+    )
+    if read_ids == "hash":
+        record_size += 8
+    elif read_ids == "keep":
+        record_size += 60 + len(columns["readID"]) // max(1, n_pairs)
+    record_size = 2 * record_size + 24 * len(keys)
+    run_size = max(1, parse_buffer_size(buffer) // record_size)
+    header = _sorted_header(meta["header"], keys)
+    init_pairs_binary(out_pairs)
+    run_dir = tempfile.mkdtemp(prefix="hicstuff_sort_", dir=tmp_dir)
+    try:
+        run_dirs = []
+        for start in range(0, n_pairs, run_size):
+            records = _binary_records(meta, columns, start, min(start + run_size, n_pairs))
+            key_cols = _binary_sort_keys(records, keys)
+            order = _argsort_keys(key_cols)
+            if dedup:
+                order = _drop_duplicates(key_cols, order)
+            # Small inputs are sorted in memory
+            if start == 0 and run_size >= n_pairs:
+                run_dirs.append(out_pairs)
             else:
-                output.write(line + "\n")
+                run_dirs.append(join(run_dir, f"run_{len(run_dirs)}"))
+                init_pairs_binary(run_dirs[-1])
+            for i in range(0, len(order), chunksize):
+                _append_binary_records(
+                    records.take(order[i : i + chunksize]), run_dirs[-1], read_ids
+                )
+            write_pairs_binary_meta(run_dirs[-1], header, read_ids=read_ids)
+            del records, key_cols, order
+        if len(run_dirs) > 1:
+            # Share the buffer between one block per run
+            block_size = max(1, min(chunksize, run_size // (2 * len(run_dirs))))
+            readers = [_binary_run_blocks(run, keys, block_size) for run in run_dirs]
+
+            def write(parts, order):
+                merged = pd.concat(parts, ignore_index=True).take(order)
+                _append_binary_records(merged, out_pairs, read_ids)
+
+            try:
+                _merge_runs(readers, write, dedup=dedup)
+            finally:
+                for reader in readers:
+                    reader.close()
+    finally:
+        shutil.rmtree(run_dir)
+    n_sorted = write_pairs_binary_meta(out_pairs, header, read_ids=read_ids)
+    if stats is not None:
+        stats["pairs"] = stats.get("pairs", 0) + n_pairs
+        stats["duplicates"] = stats.get("duplicates", 0) + n_pairs - n_sorted
+    return n_sorted
+
+
+def count_pairs(pairs):
+    """
+    Count the records of a pairs file or binary pairs directory. This is done
+    in constant time for binary pairs and text files with an up-to-date
+    sidecar index, other files are scanned.
+
+    Parameters
+    ----------
+    pairs : str
+        Path to the pairs file or binary pairs directory.
 
-    # Sort pairs and append to file.
-    with open(out_file, "a") as output:
-        grep_proc = sp.Popen(["grep", "-v", "^#", in_file], stdout=sp.PIPE)
-        sort_cmd = ["sort", f"-S {buffer}"] + list(sort_keys)
-        if tmp_dir is not None:
-            sort_cmd.append(f"--temporary-directory={tmp_dir}")
-        if parallel_ok:
-            sort_cmd.append(f"--parallel={threads}")
-        sort_proc = sp.Popen(sort_cmd, stdin=grep_proc.stdout, stdout=output)
-        sort_proc.communicate()
+    Returns
+    -------
+    int :
+        The number of records.
+
+    Examples
+    --------
+    >>> count_pairs("test_data/valid_idx.pairs")
+    10000
+    """
+    # Binary pairs store their number of records
+    if is_binary_pairs(pairs):
+        return load_pairs_binary(pairs)[0]["n_pairs"]
+    index = read_pairs_index(pairs)
+    if index is not None:
+        return index["n_pairs"]
+    n_pairs = 0
+    with read_compressed(pairs) as handle:
+        for line in handle:
+            if not line.startswith("#"):
+                n_pairs += 1
+    return n_pairs
+
+
+def get_line_shards(path, n_shards):
+    """
+    Split the body of an uncompressed text file with a "#"-prefixed header
+    into byte ranges of similar sizes aligned on line boundaries.
+
+    Parameters
+    ----------
+    path : str
+        Path to the text file.
+    n_shards : int
+        Number of shards in which to split the body.
+
+    Returns
+    -------
+    list of tuples of int :
+        The (start, end) byte offsets of each non-empty shard, in file order.
+
+    Examples
+    --------
+    >>> shards = get_line_shards("test_data/valid.pairs", 4)
+    >>> len(shards)
+    4
+    >>> all(end == start for (_, end), (start, _) in zip(shards[:-1], shards[1:]))
+    True
+    """
+    with open(path, "rb") as handle:
+        # Skip header lines
+        body_start = 0
+        for line in handle:
+            if not line.startswith(b"#"):
+                break
+            body_start += len(line)
+        file_size = os.fstat(handle.fileno()).st_size
+        bounds = [body_start]
+        for shard in range(1, n_shards):
+            # Move each boundary to the start of the next line
+            handle.seek(max(bounds[-1], body_start + shard * (file_size - body_start) // n_shards))
+            if handle.tell() > body_start:
+                handle.seek(-1, os.SEEK_CUR)
+                handle.readline()
+            bounds.append(handle.tell())
+        bounds.append(file_size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def read_lines_range(path, start, end):
+    """
+    Generates the lines of a text file between two byte offsets, as given by
+    get_line_shards.
+
+    Parameters
+    ----------
+    path : str
+        Path to the text file.
+    start : int
+        Offset of the first line.
+    end : int
+        Offset after the last line.
+
+    Yields
+    ------
+    str :
+        The lines in the range, with their line terminators.
+    """
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        pos = start
+        for line in handle:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode()
 
 
 def get_pairs_header(pairs):
@@ -1208,8 +2638,12 @@ def get_pairs_header(pairs):
         ['#sorted: chr1-chr2']
         >>> os.unlink(p.name)
     """
+    # Header of binary pairs is stored in their metadata
+    if is_binary_pairs(pairs):
+        with open(join(pairs, BINARY_PAIRS_META)) as handle:
+            return json.load(handle)["header"]
     # Open file if needed
-    with open(pairs) as pairs:
+    with read_compressed(pairs) as pairs:
         # Store header lines into a list
         header = []
         line = pairs.readline()
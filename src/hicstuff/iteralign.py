@@ -11,11 +11,14 @@ increase of properly mapped reads.
 """
 
 import contextlib
+import itertools
 import os
 import re
-import shutil as st
 import subprocess as sp
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
 
 import pysam as ps
@@ -23,6 +26,9 @@ import pysam as ps
 import hicstuff.io as hio
 from hicstuff.log import logger
 
+# Number of consecutive reads sent to the same chunk when splitting the input
+FASTQ_BLOCK_SIZE = 100000
+
 
 def iterative_align(
     fq_in,
@@ -34,12 +40,16 @@ def iterative_align(
     min_len=20,
     min_qual=30,
     read_len=None,
+    n_chunks=None,
+    persistent_index=False,
 ):
     """Iterative alignment
 
     Aligns reads iteratively reads of fq_in with bowtie2, minimap2 or bwa. Reads are
     truncated to the 20 first nucleotides and unmapped reads are extended by 20
-    nucleotides and realigned on each iteration.
+    nucleotides and realigned on each iteration. The input is split into
+    chunks which go through all iterations in parallel processes. At each
+    iteration, only the reads left unaligned are carried to the next one.
 
     Parameters
     ----------
@@ -65,6 +75,19 @@ def iterative_align(
         Read length in the fasta file. If set to None, the length of the first read
         is used. Set this value to the longest read length in the file if you have
         different read lengths.
+    n_chunks : int or None
+        Number of chunks aligned in parallel, sharing the n_cpu threads. Each
+        chunk runs its own aligner processes, which load the genome index
+        separately. Defaults to one chunk per 4 CPUs.
+    persistent_index : bool
+        Keep the genome index resident in memory across rounds and chunks
+        instead of reloading it in each aligner process: minimap2 uses an
+        index prebuilt once in tmp_dir, bowtie2 memory-maps the index so
+        that it stays in the page cache (--mm) and bwa loads it in shared
+        memory (bwa shm) for the duration of the alignment. As bwa can only
+        drop all indices in shared memory at once, an index already loaded
+        is reused and left loaded, and the index loaded here is left loaded
+        if other indices were loaded in the meantime.
 
     Examples
     --------
@@ -72,11 +95,9 @@ def iterative_align(
     iterative_align(fq_in='example_for.fastq', ref='example_bt2_index', bam_out='example_for.bam', aligner="bowtie2")
     iterative_align(fq_in='example_for.fastq', ref='example_genome.fa', bam_out='example_for.bam', aligner="minimap2")
     """
-    # set with the name of the unaligned reads :
-    remaining_reads = set()
-    total_reads = 0
-    # Store path of SAM containing aligned reads at each iteration.
-    iter_out = []
+    n_cpu = int(n_cpu)
+    if n_chunks is None:
+        n_chunks = max(1, n_cpu // 4)
 
     # If there is already a file with the same name as the output file,
     # remove it. Otherwise, ignore.
@@ -87,33 +108,19 @@ def iterative_align(
             logger.error("You need to give the BAM output file, not a folder.")
             raise
 
-    # Bowtie only accepts uncompressed fastq: uncompress it into a temp file
-    if aligner == "bowtie2" and hio.is_compressed(fq_in):
-        uncomp_path = join(tmp_dir, os.path.basename(fq_in) + ".tmp")
-        with hio.read_compressed(fq_in) as inf:
-            with open(uncomp_path, "w") as uncomp:
-                st.copyfileobj(inf, uncomp)
-    else:
-        uncomp_path = fq_in
-
     # throw error if index does not exist
     index = hio.check_fasta_index(ref, mode=aligner)
     if index is None:
         logger.error(f"Reference index is missing, please build the {aligner} index first.")
         sys.exit(1)
-    # Counting reads
-    with hio.read_compressed(uncomp_path) as inf:
-        for _ in inf:
-            total_reads += 1
-    total_reads /= 4
+
+    # Split reads into uncompressed chunks, which all aligners accept, and
+    # count them at the same time
+    chunks, total_reads, first_len = _split_fastq(fq_in, tmp_dir, n_chunks)
 
     # Use first read to guess read length if not provided.
     if read_len is None:
-        with hio.read_compressed(uncomp_path) as inf:
-            # Skip first line (read header)
-            inf.readline()
-            # Stripping newline from sequence line.
-            read_len = len(inf.readline().rstrip())
+        read_len = first_len
 
     # initial length of the fragments to align
     # In case reads are shorter than provided min_len
@@ -123,179 +130,369 @@ def iterative_align(
         logger.warning("min_len is longer than the reads. Iterative mapping will have no effect.")
         n = read_len
     logger.info(f"{int(total_reads)} reads to parse")
-
-    first_round = True
-    # iterative alignment per se
-    while n <= read_len:
-        logger.info(
-            "Truncating unaligned reads to {size}bp and mapping{again}.".format(
-                size=int(n), again="" if first_round else " again"
+    # Truncation lengths of all rounds, the last one is at full length
+    lengths = list(range(n, read_len + 1, 20))
+    lengths.append(lengths[-1] + 20)
+
+    chunk_cpu = max(1, n_cpu // max(len(chunks), 1))
+    with contextlib.ExitStack() as stack:
+        mm = False
+        if persistent_index:
+            ref, index, mm = stack.enter_context(
+                _resident_index(aligner, ref, index, tmp_dir, n_cpu)
             )
+        chunk_args = [
+            (fq, join(tmp_dir, f"chunk_{i}"), ref, index, aligner, lengths, read_len, min_qual)
+            + (chunk_cpu, mm)
+            for i, fq in enumerate(chunks)
+        ]
+        if len(chunks) > 1:
+            with ProcessPoolExecutor(len(chunks)) as pool:
+                results = list(pool.map(_align_chunk, *zip(*chunk_args)))
+        else:
+            results = [_align_chunk(*args) for args in chunk_args]
+
+    # Merge all aligned reads and unmapped reads into a single bam, sorted
+    # by name with the bounded memory of samtools sort
+    iter_out = [bam for bams, _ in results for bam in bams]
+    merged = join(tmp_dir, "merged.bam")
+    ps.cat("-o", merged, *iter_out)
+    ps.sort("-n", "-O", "BAM", "-@", str(n_cpu), "-T", join(tmp_dir, "sort"), "-o", bam_out, merged)
+    n_aligned = sum(aligned for _, aligned in results)
+    logger.info(f"{int(n_aligned)} reads aligned / {int(total_reads)} total reads.")
+
+    return 0
+
+
+def _split_fastq(fq_in, tmp_dir, n_chunks, block_size=FASTQ_BLOCK_SIZE):
+    """
+    Split a fastq file into uncompressed chunks. Blocks of block_size
+    consecutive reads are distributed to the chunks in turn.
+
+    Returns
+    -------
+    tuple :
+        Paths to the non-empty chunks, total number of reads and length of
+        the first read.
+    """
+    paths = [join(tmp_dir, f"chunk_{i}.fastq") for i in range(n_chunks)]
+    n_reads = read_len = 0
+    with contextlib.ExitStack() as stack:
+        outs = [stack.enter_context(open(path, "w")) for path in paths]
+        inf = stack.enter_context(hio.read_compressed(fq_in))
+        for block in itertools.count():
+            lines = list(itertools.islice(inf, 4 * block_size))
+            if not lines:
+                break
+            if n_reads == 0:
+                # Stripping newline from sequence line.
+                read_len = len(lines[1].rstrip())
+            outs[block % n_chunks].writelines(lines)
+            n_reads += len(lines) // 4
+    # Only n_reads / block_size chunks may have received reads
+    n_used = min(n_chunks, -(-n_reads // block_size))
+    for path in paths[n_used:]:
+        os.remove(path)
+    return paths[:n_used], n_reads, read_len
+
+
+def _is_minimap2(aligner):
+    """Whether the aligner name refers to minimap2."""
+    return re.match(r"^(minimap[2]?|mm[2]?)$", aligner, flags=re.IGNORECASE)
+
+
+def _is_bwa(aligner):
+    """Whether the aligner name refers to bwa."""
+    return re.match(r"^(bwa)$", aligner, flags=re.IGNORECASE)
+
+
+def _is_bowtie2(aligner):
+    """Whether the aligner name refers to bowtie2."""
+    return re.match(r"^(bowtie[2]?|bt[2]?)$", aligner, flags=re.IGNORECASE)
+
+
+@contextlib.contextmanager
+def _resident_index(aligner, ref, index, tmp_dir, n_cpu):
+    """
+    Context manager keeping the genome index of the aligner in memory
+    across alignment processes. See iterative_align.
+
+    Yields
+    ------
+    tuple :
+        The reference and index to give to _map_cmd, and whether bowtie2
+        should memory-map the index.
+    """
+    start = time.perf_counter()
+    if _is_minimap2(aligner):
+        # minimap2 indexes the fasta at each run unless given a prebuilt index
+        mmi = join(tmp_dir, "genome.mmi")
+        sp.run(
+            ["minimap2", "-x", "sr", "-t", str(n_cpu), "-d", mmi, ref],
+            check=True,
+            stderr=sp.DEVNULL,
         )
-        iter_out += [join(tmp_dir, f"trunc_{str(n)}.bam")]
-        # Generate a temporary input fastq file with the n first nucleotids
-        # of the reads.
-        truncated_reads = _truncate_reads(tmp_dir, uncomp_path, remaining_reads, n, first_round)
-
-        # Align the truncated reads on reference genome
-        temp_alignment = join(tmp_dir, "temp_alignment.bam")
-        map_args = {
-            "fa": ref,
-            "cpus": n_cpu,
-            "fq": truncated_reads,
-            "idx": index,
-            "bam": temp_alignment,
-        }
-        if re.match(r"^(minimap[2]?|mm[2]?)$", aligner, flags=re.IGNORECASE):
-            cmd = "minimap2 -x sr -a -t {cpus} {fa} {fq}".format(**map_args)
-        elif re.match(r"^(bwa)$", aligner, flags=re.IGNORECASE):
-            cmd = "bwa mem -t {cpus} -v 1 {idx} {fq}".format(**map_args)
-        elif re.match(r"^(bowtie[2]?|bt[2]?)$", aligner, flags=re.IGNORECASE):
-            cmd = ("bowtie2 -x {idx} -p {cpus} --quiet --very-sensitive-local -U {fq}").format(
-                **map_args
+        logger.info(f"minimap2 index built in {time.perf_counter() - start:.1f}s.")
+        yield mmi, index, False
+    elif _is_bwa(aligner):
+        with _BWA_SHM_LOCK:
+            owned = index in _BWA_SHM_USERS
+            if owned:
+                _BWA_SHM_USERS[index] += 1
+            elif index not in _bwa_shm_indices():
+                sp.run(["bwa", "shm", index], check=True)
+                _BWA_SHM_USERS[index] = 1
+                owned = True
+                logger.info(
+                    f"bwa index loaded in shared memory in {time.perf_counter() - start:.1f}s."
+                )
+        try:
+            yield ref, index, False
+        finally:
+            if owned:
+                _release_bwa_index(index)
+    else:
+        yield ref, index, True
+
+
+# Indices loaded in shared memory by this process, with their number of
+# users, as alignments of both mates may run concurrently in threads
+_BWA_SHM_USERS = {}
+_BWA_SHM_LOCK = threading.Lock()
+
+
+def _bwa_shm_indices():
+    """Names of the bwa indices currently loaded in shared memory."""
+    loaded = sp.run(["bwa", "shm", "-l"], stdout=sp.PIPE, stderr=sp.DEVNULL, text=True).stdout
+    return [line.split("\t")[0] for line in loaded.splitlines()]
+
+
+def _release_bwa_index(index):
+    """
+    Drop a bwa index loaded by _resident_index once it has no user left.
+    bwa can only drop all indices in shared memory at once, so the index
+    is kept if other indices were loaded since, by other processes.
+    """
+    with _BWA_SHM_LOCK:
+        _BWA_SHM_USERS[index] -= 1
+        if _BWA_SHM_USERS[index] > 0:
+            return
+        del _BWA_SHM_USERS[index]
+        others = [name for name in _bwa_shm_indices() if name != index]
+        if others:
+            logger.warning(
+                f"bwa index {index} left in shared memory, as other indices are loaded: "
+                "run 'bwa shm -d' to drop all of them."
             )
-        else:
-            raise ValueError("Unknown aligner. Select bowtie2, minimap2 or bwa.")
+            return
+        sp.run(["bwa", "shm", "-d"], check=True)
+
+
+def _map_cmd(aligner, ref, index, fastq, n_cpu, local=True, mm=False):
+    """
+    Build the shell command aligning fastq and writing SAM to stdout, in the
+    order of the reads. If mm is True, bowtie2 memory-maps its index.
+    """
+    if _is_minimap2(aligner):
+        return f"minimap2 -x sr -a -t {n_cpu} {ref} {fastq}"
+    if _is_bwa(aligner):
+        return f"bwa mem -t {n_cpu} -v 1 {index} {fastq}"
+    if _is_bowtie2(aligner):
+        mode = "--very-sensitive-local" if local else "--very-sensitive"
+        if mm:
+            mode += " --mm"
+        # bowtie2 only keeps the order of reads with --reorder
+        return f"bowtie2 -x {index} -p {n_cpu} --quiet --reorder {mode} -U {fastq}"
+    raise ValueError("Unknown aligner. Select bowtie2, minimap2 or bwa.")
+
+
+def _align_chunk(
+    chunk_fq, tmp_dir, ref, index, aligner, lengths, read_len, min_qual, n_cpu, mm=False
+):
+    """
+    Run all iterative alignment rounds on a chunk of reads. Reads left
+    unaligned by a round are written at full length to a new fastq file,
+    which is the input of the next round. Aligners keep the order of input
+    reads, so that alignments are matched to reads by walking both in
+    lock-step and memory does not depend on the number of reads.
 
+    Returns
+    -------
+    tuple :
+        Paths to the BAM files of the chunk (aligned reads of each round,
+        then unaligned reads), in the order of the reads, and number of
+        aligned reads.
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    remaining = chunk_fq
+    iter_out = []
+    temp_alignment = join(tmp_dir, "temp_alignment.bam")
+    truncated_reads = join(tmp_dir, "truncated.fastq")
+    n_reads = n_unaligned = _truncate_reads(remaining, truncated_reads, lengths[0])
+    for i, trunc_len in enumerate(lengths):
+        last_round = i == len(lengths) - 1
+        if last_round:
+            logger.info(f"Trying to map unaligned reads at full length ({int(read_len)}bp).")
+        else:
+            logger.info(
+                "Truncating unaligned reads to {size}bp and mapping{again}.".format(
+                    size=int(trunc_len), again="" if i == 0 else " again"
+                )
+            )
+            # First round reads were truncated when counting them
+            if i > 0:
+                _truncate_reads(remaining, truncated_reads, trunc_len)
+
+        # Align the truncated reads on reference genome, in the order of reads
+        cmd = _map_cmd(
+            aligner,
+            ref,
+            index,
+            remaining if last_round else truncated_reads,
+            n_cpu,
+            local=not last_round,
+            mm=mm,
+        )
+        start = time.perf_counter()
         map_process = sp.Popen(cmd, shell=True, stdout=sp.PIPE)
-        sort_process = sp.Popen(
-            "samtools sort -n -@ {cpus} -O BAM -o {bam}".format(**map_args),
+        view_process = sp.Popen(
+            f"samtools view -u -o {temp_alignment} -",
             shell=True,
             stdin=map_process.stdout,
         )
-        sort_process.wait()
+        # Only samtools reads the alignments, so that the aligner gets
+        # SIGPIPE if samtools exits first
+        map_process.stdout.close()
+        view_process.wait()
+        map_process.wait()
+        for process in (map_process, view_process):
+            if process.returncode != 0:
+                raise sp.CalledProcessError(process.returncode, process.args)
+        # Index loading time is included, to compare with persistent_index
+        logger.info(f"Alignment round took {time.perf_counter() - start:.1f}s.")
 
         # filter the reads: the reads whose truncated end was aligned are written
         # to the output file.
         # The reads whose truncated end was not aligned are kept for the next round.
-        remaining_reads = _filter_bamfile(temp_alignment, iter_out[-1], min_qual)
-
-        n += 20
-        first_round = False
-
-    # one last round without trimming
-    logger.info(f"Trying to map unaligned reads at full length ({int(read_len)}bp).")
-
-    truncated_reads = _truncate_reads(
-        tmp_dir,
-        infile=uncomp_path,
-        unaligned_set=remaining_reads,
-        trunc_len=n,
-        first_round=first_round,
-    )
-    if aligner == "minimap2" or aligner == "Minimap2":
-        cmd = f"minimap2 -x sr -a -t {n_cpu} {ref} {truncated_reads}"
-    elif aligner == "bwa" or aligner == "Bwa" or aligner == "BWA":
-        cmd = f"bwa mem -v 1 -t {n_cpu} {index} {truncated_reads}"
-    else:
-        cmd = f"bowtie2 -x {index} -p {n_cpu} --quiet --very-sensitive {truncated_reads}"
-    map_process = sp.Popen(cmd, shell=True, stdout=sp.PIPE)
-    # Keep reads sorted by name
-    sort_process = sp.Popen(
-        f"samtools sort -n -@ {n_cpu} -O BAM -o {temp_alignment}",
-        shell=True,
-        stdin=map_process.stdout,
-    )
-    sort_process.wait()
-    iter_out += [join(tmp_dir, f"trunc_{str(n)}.bam")]
-    remaining_reads = _filter_bamfile(temp_alignment, iter_out[-1], min_qual)
-
-    # Report unaligned reads as well
-    iter_out += [join(tmp_dir, "unaligned.bam")]
-    temp_bam = ps.AlignmentFile(temp_alignment, "rb", check_sq=False)
-    unmapped = ps.AlignmentFile(iter_out[-1], "wb", template=temp_bam)
-    for r in temp_bam:
-        # Do not write supplementary alignments (keeping 1 alignment/read)
-        if r.query_name in remaining_reads and not r.is_supplementary:
-            unmapped.write(r)
-    unmapped.close()
-    temp_bam.close()
-
-    # Merge all aligned reads and unmapped reads into a single bam
-    ps.merge("-n", "-O", "BAM", "-@", str(n_cpu), bam_out, *iter_out)
-    logger.info(
-        f"{int(total_reads - len(remaining_reads))} reads aligned / {int(total_reads)} total reads."
-    )
+        iter_out.append(join(tmp_dir, f"trunc_{trunc_len}.bam"))
+        if last_round:
+            # Report unaligned reads as well
+            iter_out.append(join(tmp_dir, "unaligned.bam"))
+            n_unaligned = _filter_bamfile(
+                temp_alignment, iter_out[-2], remaining, min_qual, unaligned_bam=iter_out[-1]
+            )
+            break
+        next_remaining = join(tmp_dir, f"remaining_{trunc_len}.fastq")
+        n_unaligned = _filter_bamfile(
+            temp_alignment, iter_out[-1], remaining, min_qual, unaligned_fq=next_remaining
+        )
+        if remaining != chunk_fq:
+            os.remove(remaining)
+        remaining = next_remaining
+        if n_unaligned == 0:
+            break
 
-    return 0
+    return iter_out, n_reads - n_unaligned
 
 
-def _truncate_reads(tmp_dir, infile, unaligned_set, trunc_len, first_round):
+def _truncate_reads(infile, outfile, trunc_len):
     """Trim read ends
 
-    Writes the n first nucleotids of each sequence in infile to an auxiliary.
-    file in the temporary folder.
+    Writes the n first nucleotids of each sequence in infile to outfile.
 
     Parameters
     ----------
 
-    tmp_dir : str
-        Path to the temporary folder.
     infile : str
         Path to the fastq file to truncate.
-    unaligned_set : set
-        Contains the names of all reads that did not map unambiguously in
-        previous rounds.
+    outfile : str
+        Path to the output fastq file containing truncated reads.
     trunc_len : int
         The number of basepairs to keep in each truncated sequence.
-    first_round : bool
-        If this is the first round, truncate all reads without checking mapping.
 
     Returns
     -------
 
-    str :
-        Path to the output fastq file containing truncated reads.
+    int :
+        The number of reads written.
     """
-
-    outfile = f"{tmp_dir}/truncated.fastq"
+    n_reads = 0
     with ps.FastxFile(infile, "r") as inf, open(outfile, "w") as outf:
         for entry in inf:
-            # If the read did not align in previous round or this is the first round
-            if (entry.name in unaligned_set) or first_round:
-                entry.sequence = entry.sequence[:trunc_len]
-                entry.quality = entry.quality[:trunc_len]
-                outf.write(str(entry) + "\n")
-    return outfile
+            entry.sequence = entry.sequence[:trunc_len]
+            entry.quality = entry.quality[:trunc_len]
+            outf.write(str(entry) + "\n")
+            n_reads += 1
+    return n_reads
 
 
-def _filter_bamfile(temp_alignment, filtered_out, min_qual=30):
+def _filter_bamfile(
+    temp_alignment, filtered_out, reads, min_qual=30, unaligned_fq=None, unaligned_bam=None
+):
     """Filter alignment BAM files
 
-    Reads all the reads in the input BAM alignment file.
-    Write reads to the output file if they are aligned with a good
-    quality, otherwise add their name in a set to stage them for the next round
-    of alignment.
+    Reads all the primary alignments in the input BAM alignment file, which
+    must be in the same order as the reads of the fastq file they were
+    aligned from. Write reads to the output file if they are aligned with a
+    good quality, otherwise stage them for the next round of alignment.
 
     Parameters
     ----------
     temp_alignment : str
         Path to the input temporary alignment.
-    outfile : str
+    filtered_out : str
         Path to the output filtered temporary alignment.
+    reads : str
+        Path to the fastq file with the aligned reads, at full length.
     min_qual : int
         Minimum mapping quality required to keep a Hi-C pair.
+    unaligned_fq : str or None
+        If given, path where the fastq entries of unaligned reads are written.
+    unaligned_bam : str or None
+        If given, path where the alignments of unaligned reads are written.
 
     Returns
     -------
-    set:
-        Contains the names reads that did not align.
+    int:
+        The number of reads that did not align.
     """
     # Check the quality and status of each aligned fragment.
     # Write the ones with good quality in the final output file.
     # Keep those that do not map unambiguously for the next round.
-
-    unaligned = set()
-    temp_bam = ps.AlignmentFile(temp_alignment, "rb", check_sq=False)
-    outf = ps.AlignmentFile(filtered_out, "wb", template=temp_bam)
-    for r in temp_bam:
-        if r.flag in [0, 16] and r.mapping_quality >= min_qual:
-            outf.write(r)
-        else:
-            unaligned.add(r.query_name)
-
-    logger.info(f"{len(unaligned)} reads left to map.")
-    temp_bam.close()
-    outf.close()
-
-    return unaligned
+    n_unaligned = 0
+    with contextlib.ExitStack() as stack:
+        temp_bam = stack.enter_context(ps.AlignmentFile(temp_alignment, "rb", check_sq=False))
+        outf = stack.enter_context(ps.AlignmentFile(filtered_out, "wb", template=temp_bam))
+        inf = stack.enter_context(ps.FastxFile(reads, "r"))
+        unal_fq = unal_bam = None
+        if unaligned_fq is not None:
+            unal_fq = stack.enter_context(open(unaligned_fq, "w"))
+        if unaligned_bam is not None:
+            unal_bam = stack.enter_context(ps.AlignmentFile(unaligned_bam, "wb", template=temp_bam))
+        # Keep 1 alignment per read
+        primary = (r for r in temp_bam if not (r.is_secondary or r.is_supplementary))
+        for entry, r in itertools.zip_longest(inf, primary):
+            if entry is None or r is None:
+                raise ValueError(
+                    f"{temp_alignment} and {reads} do not have the same number of reads."
+                )
+            # Aligners may strip the /1 or /2 suffix of read names
+            name = entry.name
+            if r.query_name != name and not (
+                name.endswith(("/1", "/2")) and r.query_name == name[:-2]
+            ):
+                raise ValueError(
+                    f"Alignment of read {r.query_name} found instead of {entry.name}: "
+                    "alignments must be in the order of reads."
+                )
+            if r.flag in [0, 16] and r.mapping_quality >= min_qual:
+                outf.write(r)
+                continue
+            n_unaligned += 1
+            if unal_fq is not None:
+                unal_fq.write(str(entry) + "\n")
+            if unal_bam is not None:
+                unal_bam.write(r)
+
+    logger.info(f"{n_unaligned} reads left to map.")
+    return n_unaligned
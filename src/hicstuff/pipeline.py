@@ -3,19 +3,23 @@ Handle generation of graal-compatible contact maps from fastq files.
 cmdoret, 20190322
 """
 
-import csv
+import contextlib
 import gzip
 import itertools
 import logging
 import os
 import pathlib
 import re
+import resource
 import shutil as st
 import subprocess as sp
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from os.path import join
+from queue import Full, Queue
 from shutil import which
 
 import cooler
@@ -36,10 +40,138 @@ import hicstuff.io as hio
 import hicstuff.iteralign as hci
 import hicstuff.log as hcl
 import hicstuff.stats as hcs
+import hicstuff.stream as hst
 from hicstuff import __version__
 from hicstuff.log import logger
 
 
+def _log_usage(name, wall, cpu, threads):
+    """Log the wall time and CPU utilisation of a pipeline stage."""
+    logger.info(
+        "%s: %.1fs wall time, %.1fs CPU time (%.0f%% of %d threads)",
+        name,
+        wall,
+        cpu,
+        100 * cpu / max(wall * threads, 1e-6),
+        threads,
+    )
+
+
+def _cpu_time():
+    """CPU time used by this process and its terminated children, in seconds."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def _log_stage(name, threads):
+    """
+    Context manager logging the wall time and CPU utilisation of the code
+    it runs, including subprocesses which have terminated.
+    """
+    wall, cpu = time.perf_counter(), _cpu_time()
+    yield
+    _log_usage(name, time.perf_counter() - wall, _cpu_time() - cpu, threads)
+
+
+def _run_logged(cmd, name, threads, **kwargs):
+    """
+    Run a command as subprocess.check_call does and log its wall time and
+    CPU utilisation, including processes it has waited for (e.g. in a shell
+    pipeline). CPU time is measured for this process only, so that stages
+    running concurrently are reported separately. Raises CalledProcessError
+    if the command exits with a nonzero code.
+    """
+    start = time.perf_counter()
+    proc = sp.Popen(cmd, **kwargs)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    _log_usage(name, time.perf_counter() - start, usage.ru_utime + usage.ru_stime, threads)
+    if proc.returncode != 0:
+        raise sp.CalledProcessError(proc.returncode, cmd)
+
+
+def _split_threads(threads, n_parts):
+    """
+    Split a thread budget between parts running concurrently, each part
+    getting at least one thread.
+
+    Examples
+    --------
+    >>> _split_threads(5, 2)
+    [3, 2]
+    >>> _split_threads(1, 2)
+    [1, 1]
+    """
+    return [max(1, threads // n_parts + (i < threads % n_parts)) for i in range(n_parts)]
+
+
+def _map_cmd(reads, genome, threads, aligner="bowtie2", reorder=False):
+    """
+    Build the command aligning reads with the selected aligner and writing
+    SAM records to stdout. If reorder is True, records are written in the
+    order of the input reads, even with multiple threads.
+    """
+    if aligner == "minimap2":
+        return ["minimap2", "-2", "-t", str(threads), "-ax", "sr", genome, reads]
+    if aligner == "bwa":
+        return ["bwa", "mem", "-t", str(threads), "-v", "1", genome, reads]
+    cmd = ["bowtie2", "--very-sensitive-local", "-p", str(threads), "-x", genome, "-U", reads]
+    # bowtie2 is the only aligner which does not keep input order by default
+    return cmd + ["--reorder"] if reorder else cmd
+
+
+@contextlib.contextmanager
+def _stream_cutsite(reads1, reads2, fifo1, fifo2, enzyme, threads):
+    """
+    Cut reads at ligation sites in a background thread, writing plain
+    digested reads to one named pipe per mate. Aligners reading the pipes
+    must run within the context, so that cutting and alignment overlap and
+    digested reads are never compressed.
+    """
+    fifos = (fifo1, fifo2)
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+    def cut():
+        try:
+            hcc.cut_ligation_sites(
+                fq_for=reads1,
+                fq_rev=reads2,
+                digest_for=fifo1,
+                digest_rev=fifo2,
+                enzyme=enzyme,
+                mode="for_vs_rev",
+                seed_size=20,
+                n_cpu=threads,
+                compress_level=None,
+            )
+        except BaseException:
+            # Aligners wait for the pipes to be opened, send them end of file
+            for fifo in fifos:
+                open(fifo, "wb").close()
+            raise
+
+    pool = ThreadPoolExecutor(1)
+    job = pool.submit(cut)
+    try:
+        yield
+    finally:
+        # If aligners stopped reading, the cutting thread is unblocked by
+        # opening the pipes until it fails on a broken pipe
+        while not job.done():
+            for fifo in fifos:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            wait([job], timeout=1)
+        pool.shutdown()
+        for fifo in fifos:
+            os.remove(fifo)
+    job.result()
+
+
 def align_reads(
     reads,
     genome,
@@ -50,6 +182,7 @@ def align_reads(
     iterative=False,
     min_qual=30,
     read_len=None,
+    persistent_index=False,
 ):
     """
     Select and call correct alignment method and generate logs accordingly.
@@ -81,6 +214,9 @@ def align_reads(
         Maximum read length to expect in the fastq file. Optionally used in iterative
         alignment mode. Estimated from the first read by default. Useful if input fastq
         is a composite of different read lengths.
+    persistent_index : bool
+        Keep the genome index in memory across the rounds of iterative
+        alignment, see hicstuff.iteralign.iterative_align.
     """
     if tmp_dir is None:
         tmp_dir = os.getcwd()
@@ -97,41 +233,355 @@ def align_reads(
             min_qual=min_qual,
             aligner=aligner,
             read_len=read_len,
+            persistent_index=persistent_index,
         )
         st.rmtree(iter_tmp_dir)
-        sp.call(
+        _run_logged(
             f"samtools view -F 2048 -h -@ {threads} -O BAM {tmp_bam} -o {out_bam}",
+            f"samtools view of {reads}",
+            threads,
             shell=True,
         )
     else:
-        if aligner == "minimap2":
-            map_cmd = "minimap2 -2 -t {threads} -ax sr {fasta} {fastq} > {sam}"
-        elif aligner == "bwa":
-            map_cmd = "bwa mem -t {threads} -v 1 {index} {fastq} > {sam}"
-        else:
-            map_cmd = "bowtie2 --very-sensitive-local -p {threads} -x {index} -U {fastq} > {sam}"
-        map_args = {
-            "threads": threads,
-            "sam": tmp_bam,
-            "fastq": reads,
-            "fasta": genome,
-            "index": genome,
-        }
-        sp.call(map_cmd.format(**map_args), shell=True)
-        # Remove supplementary alignments and sort reads by name
-        sp.call(
-            f"samtools view -F 2048 -h -@ {threads} {tmp_bam} | samtools sort -n -@ {threads} -o {out_bam} -",
+        with open(tmp_bam, "w") as sam:
+            _run_logged(
+                _map_cmd(reads, genome, threads, aligner),
+                f"{aligner} alignment of {reads}",
+                threads,
+                stdout=sam,
+            )
+        # Remove supplementary alignments and sort reads by name. Filtering
+        # is light compared to sorting, which gets most of the threads.
+        view_threads = max(1, threads // 4)
+        sort_threads = max(1, threads - view_threads)
+        _run_logged(
+            f"samtools view -F 2048 -h -@ {view_threads} {tmp_bam} | samtools sort -n -@ {sort_threads} -o {out_bam} -",
+            f"samtools sort of {reads}",
+            threads,
             shell=True,
         )
     os.remove(tmp_bam)
 
 
-def bam2pairs(bam1, bam2, out_pairs, info_contigs, min_qual=30):
+# Number of records read at once from each BAM file in bam2pairs
+BAM_BATCH_SIZE = 100000
+
+
+def _read_bam_batch(bam, size):
+    """
+    Read up to size alignment records from an open BAM file into arrays.
+    End-specific suffixes (/1 or /2) are removed from read names.
+
+    Returns
+    -------
+    dict :
+        Arrays "name", "ref", "pos", "strand" (True for reverse) and "mapq",
+        with one entry per record. Positions are 0-based.
+    """
+    names, refs, pos, strand, mapq = [], [], [], [], []
+    for read in itertools.islice(bam, size):
+        names.append(read.query_name)
+        refs.append(read.reference_id)
+        pos.append(read.reference_start)
+        strand.append(read.is_reverse)
+        mapq.append(read.mapping_quality)
+    return _make_batch(names, refs, pos, strand, mapq)
+
+
+def _make_batch(names, refs, pos, strand, mapq):
+    """Build a batch of records as returned by _read_bam_batch from lists."""
+    names = pd.Series(names, dtype=object).str.replace(r"/[12]$", "", regex=True)
+    return {
+        "name": names.to_numpy(dtype=object),
+        "ref": np.array(refs, dtype=np.int64),
+        "pos": np.array(pos, dtype=np.int64),
+        "strand": np.array(strand, dtype=bool),
+        "mapq": np.array(mapq, dtype=np.int64),
+    }
+
+
+def _read_sam_header(handle):
+    """
+    Read the header of a SAM stream. Returns the reference names, in the
+    order of the @SQ lines, and the first record line ("" if none).
+    """
+    ref_names = []
+    for line in handle:
+        if not line.startswith("@"):
+            return ref_names, line
+        if line.startswith("@SQ"):
+            fields = line.rstrip("\n").split("\t")
+            ref_names.append(next(f[3:] for f in fields if f.startswith("SN:")))
+    return ref_names, ""
+
+
+def _sam_batches(lines, ref_names, size):
+    """
+    Iterate over batches of primary alignments from SAM record lines, in
+    the format of _read_bam_batch. Secondary and supplementary alignments
+    are skipped. The last batch has less than size records.
+    """
+    refs = pd.Index(ref_names)
+    records = []
+    for line in lines:
+        # Only the first 5 fields are needed: QNAME FLAG RNAME POS MAPQ
+        fields = line.split("\t", 5)[:5]
+        # Skip secondary (256) and supplementary (2048) alignments
+        if int(fields[1]) & 2304:
+            continue
+        records.append(fields)
+        if len(records) == size:
+            yield _sam_records_batch(records, refs)
+            records = []
+    yield _sam_records_batch(records, refs)
+
+
+def _sam_records_batch(records, refs):
+    """Convert split SAM records to a batch, see _sam_batches."""
+    records = np.array(records, dtype=object).reshape(-1, 5)
+    flags = records[:, 1].astype(np.int64)
+    return _make_batch(
+        records[:, 0].tolist(),
+        # Unmapped reads have RNAME "*", which gets -1
+        refs.get_indexer(records[:, 2]),
+        records[:, 3].astype(np.int64) - 1,
+        (flags & 16) > 0,
+        records[:, 4].astype(np.int64),
+    )
+
+
+def _check_ended(procs, batches, size):
+    """
+    Wait on the processes whose batches of SAM records ended, either missing
+    or shorter than size, and raise CalledProcessError if one of them failed.
+    """
+    for proc, batch in zip(procs, batches):
+        if (batch is None or len(batch["name"]) < size) and proc.wait() != 0:
+            raise sp.CalledProcessError(proc.returncode, proc.args)
+
+
+def _bam_batches(bam, size):
+    """
+    Iterate over batches of records of an open BAM file, see
+    _read_bam_batch. The last batch has less than size records.
+    """
+    while True:
+        batch = _read_bam_batch(bam, size)
+        yield batch
+        if len(batch["name"]) < size:
+            return
+
+
+def _prefetch(items, depth=2):
+    """
+    Iterate over items generated in a background thread, which runs up to
+    depth items ahead of the consumer. Exceptions of the generator are
+    raised in the consumer. Once the consumer stops, whether the items are
+    exhausted or not, the thread is stopped and joined, so that resources
+    used by the generator can be released.
+    """
+    queue = Queue(depth)
+    end = object()
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as error:
+            put((None, error))
+            return
+        put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _concat_batches(first, second):
+    """Concatenate two batches of records from _read_bam_batch."""
+    return {key: np.concatenate([first[key], second[key]]) for key in first}
+
+
+def _slice_batch(batch, idx):
+    """Select records from a batch of records from _read_bam_batch."""
+    return {key: values[idx] for key, values in batch.items()}
+
+
+def _match_mates(names1, names2):
+    """
+    Merge-join two arrays of read names sorted in the same order, where
+    some names may be missing on either side.
+
+    Returns
+    -------
+    tuple of numpy.ndarray :
+        Indices of matched records in names1 and in names2, both increasing.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> _match_mates(np.array(["a", "b", "d", "e"]), np.array(["a", "c", "d", "e", "f"]))
+    (array([0, 2, 3]), array([0, 2, 3]))
+    """
+    if len(names1) == 0 or len(names2) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    lookup = pd.Index(names2)
+    first = ~lookup.duplicated(keep="first")
+    hits = lookup[first].get_indexer(names1)
+    hits = np.where(hits >= 0, np.flatnonzero(first)[hits], -1)
+    # Only keep matches in the order of both files, as a merge-join would
+    prev = np.concatenate([[-1], np.maximum.accumulate(hits)[:-1]])
+    keep = (hits >= 0) & (hits > prev)
+    return np.flatnonzero(keep), hits[keep]
+
+
+def _write_pairs_batch(handle, end1, end2, ref_names, min_qual, index):
+    """
+    Write matched mates from _read_bam_batch as pairs records, skipping
+    pairs where either read is unmapped or has MAPQ below min_qual. Pairs
+    are flipped to be in upper triangle.
+    """
+    passed = (end1["mapq"] >= min_qual) & (end2["mapq"] >= min_qual)
+    passed &= (end1["ref"] >= 0) & (end2["ref"] >= 0)
+    end1, end2 = _slice_batch(end1, passed), _slice_batch(end2, passed)
+    # Flipping to get upper triangle
+    flip = (end1["ref"] > end2["ref"]) | (
+        (end1["ref"] == end2["ref"]) & (end1["pos"] > end2["pos"])
+    )
+    first = {key: np.where(flip, end2[key], end1[key]) for key in end1}
+    second = {key: np.where(flip, end1[key], end2[key]) for key in end1}
+    chunk = pd.DataFrame(
+        {
+            "readID": end1["name"],
+            "chr1": ref_names[first["ref"]],
+            "pos1": first["pos"] + 1,
+            "chr2": ref_names[second["ref"]],
+            "pos2": second["pos"] + 1,
+            "strand1": np.where(first["strand"], "-", "+").astype(object),
+            "strand2": np.where(second["strand"], "-", "+").astype(object),
+        }
+    )
+    hio.write_pairs_chunk(chunk, handle, index=index)
+
+
+def _strnum_cmp(name1, name2):
+    """
+    Compare two read names in the order of samtools sort -n, where runs of
+    digits are compared as numbers and other characters by code. Returns a
+    negative number if name1 comes first, a positive number if name2 comes
+    first and 0 if they are equal.
+
+    Examples
+    --------
+    >>> _strnum_cmp("r9", "r10") < 0
+    True
+    >>> _strnum_cmp("r10:b", "r10:a") > 0
+    True
+    >>> _strnum_cmp("r007", "r7") > 0
+    True
+    """
+
+    def char(name, i):
+        return name[i] if i < len(name) else ""
+
+    def isdigit(c):
+        return "0" <= c <= "9"
+
+    i = j = 0
+    while i < len(name1) and j < len(name2):
+        if not (isdigit(name1[i]) and isdigit(name2[j])):
+            if name1[i] != name2[j]:
+                return ord(name1[i]) - ord(name2[j])
+            i, j = i + 1, j + 1
+            continue
+        # Leading zeros are ignored
+        while char(name1, i) == "0":
+            i += 1
+        while char(name2, j) == "0":
+            j += 1
+        while isdigit(char(name1, i)) and char(name1, i) == char(name2, j):
+            i, j = i + 1, j + 1
+        diff = ord(char(name1, i) or "\0") - ord(char(name2, j) or "\0")
+        # The number which ends later is larger
+        while isdigit(char(name1, i)) and isdigit(char(name2, j)):
+            i, j = i + 1, j + 1
+        if isdigit(char(name1, i)):
+            return 1
+        if isdigit(char(name2, j)):
+            return -1
+        if diff:
+            return diff
+    if char(name1, i) == char(name2, j):
+        # Names only differ by leading zeros
+        return (i > j) - (i < j)
+    return 1 if char(name1, i) else -1
+
+
+def _pairs_header(info_contigs):
+    """Make the header lines of the pairs files written from alignments."""
+    format_version = "## pairs format v1.0\n"
+    sorting = "#sorted: readID\n"
+    cols = "#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n"
+    # Chromosome order will be identical in info_contigs and pair files
+    # UP031 Use format specifiers instead of percent format
+    chroms = pd.read_csv(info_contigs, sep="\t").apply(
+        lambda x: f"#chromsize: {x.contig} {x.length}\n", axis=1
+    )
+    return [format_version, sorting, cols] + chroms.tolist()
+
+
+def _pairs_stats(n_reads, unmatched_reads, index, min_qual):
+    """Log the mapping rate of reads made into pairs and return counters."""
+    if unmatched_reads > 0:
+        logger.warning(
+            "%d reads were only present in one BAM file. Make sure you sorted reads by name before running the pipeline.",
+            unmatched_reads,
+        )
+    logger.info(
+        f"{100 * round(n_reads['mapped'] / max(n_reads['total'], 1), 2):.2f}% reads (single ends) mapped with Q >= {min_qual} ({n_reads['mapped']}/{n_reads['total']})"
+    )
+    return {
+        "reads": n_reads["total"],
+        "mapped_reads": n_reads["mapped"],
+        "unmatched_reads": unmatched_reads,
+        "pairs": index["n_pairs"],
+    }
+
+
+def bam2pairs(
+    bam1, bam2, out_pairs, info_contigs, min_qual=30, batch_size=BAM_BATCH_SIZE, threads=1
+):
     """
     Make a .pairs file from two Hi-C bam files sorted by read names.
     The Hi-C mates are matched by read identifier. Pairs where at least one
     reads maps with MAPQ below  min_qual threshold are discarded. Pairs are
     sorted by readID and stored in upper triangle (first pair higher).
+    Records are read in batches from both files and mates are matched,
+    filtered and written batch by batch. Each file is decoded in a
+    background thread, so that reading both files overlaps with writing
+    pairs.
 
     Parameters
     ----------
@@ -146,104 +596,184 @@ def bam2pairs(bam1, bam2, out_pairs, info_contigs, min_qual=30):
         Path to the info contigs file, to get info on chromosome sizes and order.
     min_qual : int
         Minimum mapping quality required to keep a Hi-C pair.
+    batch_size : int
+        Number of records read at once from each BAM file.
+    threads : int
+        Number of threads used by htslib for BGZF decompression, split
+        between both BAM files.
+
+    Returns
+    -------
+    dict :
+        Number of single-end reads read ("reads"), mapped with quality
+        above min_qual ("mapped_reads") and present in only one BAM file
+        ("unmatched_reads"), and number of pairs written ("pairs"). A sidecar
+        index is also written next to the pairs file.
     """
-    forward = ps.AlignmentFile(bam1, "rb")
-    reverse = ps.AlignmentFile(bam2, "rb")
-
-    # Generate header lines
-    format_version = "## pairs format v1.0\n"
-    sorting = "#sorted: readID\n"
-    cols = "#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n"
-    # Chromosome order will be identical in info_contigs and pair files
-    # UP031 Use format specifiers instead of percent format
-    chroms = pd.read_csv(info_contigs, sep="\t").apply(
-        lambda x: f"#chromsize: {x.contig} {x.length}\n", axis=1
-    )
-    with open(out_pairs, "w") as pairs:
-        pairs.writelines([format_version, sorting, cols] + chroms.tolist())
-        pairs_writer = csv.writer(pairs, delimiter="\t")
-        n_reads = {"total": 0, "mapped": 0}
-        # Remember if some read IDs were missing from either file
-        unmatched_reads = 0
-        # Remember if all reads in one bam file have been read
+    bgzf_threads = max(1, threads // 2)
+    index = hio.new_pairs_index()
+    n_reads = {"total": 0, "mapped": 0}
+    # Remember if some read IDs were missing from either file
+    unmatched_reads = 0
+    # Decoding threads are stopped before files are closed, on any exit
+    with contextlib.ExitStack() as stack:
+        forward = stack.enter_context(ps.AlignmentFile(bam1, "rb", threads=bgzf_threads))
+        reverse = stack.enter_context(ps.AlignmentFile(bam2, "rb", threads=bgzf_threads))
+        pairs = stack.enter_context(open(out_pairs, "w"))
+        batches1 = stack.enter_context(
+            contextlib.closing(_prefetch(_bam_batches(forward, batch_size)))
+        )
+        batches2 = stack.enter_context(
+            contextlib.closing(_prefetch(_bam_batches(reverse, batch_size)))
+        )
+        # Chromosome names, indexed by BAM reference id
+        ref_names = np.array(forward.references, dtype=object)
+        pairs.writelines(_pairs_header(info_contigs))
+        # Records of each file whose mate may not have been read yet
+        batch1 = batch2 = None
         exhausted = [False, False]
-        # Iterate on both BAM simultaneously
-        end_regex = re.compile(r"/[12]$")
-        for end1, end2 in itertools.zip_longest(forward, reverse):
-            # Remove end-specific suffix if any
-            end1.query_name = re.sub(end_regex, "", end1.query_name)
-            end2.query_name = re.sub(end_regex, "", end2.query_name)
-            # Both file still have reads
-            # Check if reads pass filter
-            try:
-                end1_passed = end1.mapping_quality >= min_qual
-            # Happens if end1 bam file has been exhausted
-            except AttributeError:
-                exhausted[0] = True
-                end1_passed = False
-            try:
-                end2_passed = end2.mapping_quality >= min_qual
-            # Happens if end2 bam file has been exhausted
-            except AttributeError:
-                exhausted[1] = True
-                end2_passed = False
-            # Skip read if mate is not present until they match or reads
-            # have been exhausted
-            while sum(exhausted) == 0 and end1.query_name != end2.query_name:
-                # Get next read and check filters again
-                # Count single-read iteration
-                unmatched_reads += 1
-                n_reads["total"] += 1
-                if end1.query_name < end2.query_name:
-                    try:
-                        end1 = next(forward)
-                        end1_passed = end1.mapping_quality >= min_qual
-                    # If EOF is reached in BAM 1
-                    except (StopIteration, AttributeError):
-                        exhausted[0] = True
-                        end1_passed = False
-                    n_reads["mapped"] += end1_passed
-                elif end1.query_name > end2.query_name:
-                    try:
-                        end2 = next(reverse)
-                        end2_passed = end2.mapping_quality >= min_qual
-                    # If EOF is reached in BAM 2
-                    except (StopIteration, AttributeError):
-                        exhausted[1] = True
-                        end2_passed = False
-                    n_reads["mapped"] += end2_passed
-
-            # 2 reads processed per iteration, unless one file is exhausted
-            n_reads["total"] += 2 - sum(exhausted)
-            n_reads["mapped"] += sum([end1_passed, end2_passed])
-            # Keep only pairs where both reads have good quality
-            if end1_passed and end2_passed:
-                # Flipping to get upper triangle
-                if (
-                    end1.reference_id == end2.reference_id
-                    and end1.reference_start > end2.reference_start
-                ) or end1.reference_id > end2.reference_id:
-                    end1, end2 = end2, end1
-                pairs_writer.writerow(
-                    [
-                        end1.query_name,
-                        end1.reference_name,
-                        end1.reference_start + 1,
-                        end2.reference_name,
-                        end2.reference_start + 1,
-                        "-" if end1.is_reverse else "+",
-                        "-" if end2.is_reverse else "+",
-                    ]
-                )
-    pairs.close()
-    if unmatched_reads > 0:
-        logger.warning(
-            "%d reads were only present in one BAM file. Make sure you sorted reads by name before running the pipeline.",
-            unmatched_reads,
+        empty = _read_bam_batch([], 0)
+        while not all(exhausted):
+            new1 = next(batches1, empty)
+            new2 = next(batches2, empty)
+            for i, new in enumerate([new1, new2]):
+                exhausted[i] = len(new["name"]) < batch_size
+                n_reads["total"] += len(new["name"])
+                n_reads["mapped"] += int(((new["mapq"] >= min_qual) & (new["ref"] >= 0)).sum())
+            batch1 = new1 if batch1 is None else _concat_batches(batch1, new1)
+            batch2 = new2 if batch2 is None else _concat_batches(batch2, new2)
+            n1, n2 = len(batch1["name"]), len(batch2["name"])
+            idx1, idx2 = _match_mates(batch1["name"], batch2["name"])
+            # Records before the last match have no mate. Records after it
+            # may only match records of the other file which were not read.
+            if len(idx1):
+                last1, last2 = idx1[-1] + 1, idx2[-1] + 1
+            elif not any(exhausted):
+                # No match at all: the batch ending with the lower name, in
+                # the order of samtools sort -n, can not have mates further
+                # on, as in a merge-join
+                lower1 = _strnum_cmp(batch1["name"][-1], batch2["name"][-1]) < 0
+                last1, last2 = (n1, 0) if lower1 else (0, n2)
+            else:
+                last1 = last2 = 0
+            if exhausted[1]:
+                last1 = n1
+            if exhausted[0]:
+                last2 = n2
+            unmatched_reads += last1 + last2 - 2 * len(idx1)
+            _write_pairs_batch(
+                pairs,
+                _slice_batch(batch1, idx1),
+                _slice_batch(batch2, idx2),
+                ref_names,
+                min_qual,
+                index,
+            )
+            batch1 = _slice_batch(batch1, slice(last1, None))
+            batch2 = _slice_batch(batch2, slice(last2, None))
+    hio.write_pairs_index(out_pairs, index)
+    return _pairs_stats(n_reads, unmatched_reads, index, min_qual)
+
+
+def align_pairs(
+    reads1,
+    reads2,
+    genome,
+    out_pairs,
+    info_contigs,
+    threads=1,
+    aligner="bowtie2",
+    min_qual=30,
+    batch_size=BAM_BATCH_SIZE,
+):
+    """
+    Align forward and reverse Hi-C reads concurrently and make a .pairs file
+    directly from the SAM output of both aligners. As aligners keep the order
+    of input reads, mates are paired in lock-step, without writing alignment
+    files or sorting them by read name. Pairs are filtered and flipped as in
+    bam2pairs.
+
+    Parameters
+    ----------
+    reads1 : str
+        Path to the fastq file with forward Hi-C reads.
+    reads2 : str
+        Path to the fastq file with reverse Hi-C reads, in the same order.
+    genome : str
+        Path to the genome bowtie2/bwa index prefix if using bowtie2 or bwa, or to the
+        fasta if using minimap2.
+    out_pairs : str
+        Path to the output .pairs file with columns
+        readID, chr1 pos1 chr2 pos2 strand1 strand2
+    info_contigs : str
+        Path to the info contigs file, to get info on chromosome sizes and order.
+    threads : int
+        Number of threads, split between both aligners.
+    aligner : str
+        Read alignment software to use: "bowtie2", "bwa" or "minimap2".
+    min_qual : int
+        Minimum mapping quality required to keep a Hi-C pair.
+    batch_size : int
+        Number of records parsed at once from each aligner.
+
+    Returns
+    -------
+    dict :
+        Number of single-end reads aligned ("reads"), mapped with quality
+        above min_qual ("mapped_reads"), always 0 "unmatched_reads", and
+        number of pairs written ("pairs").
+    """
+    map_threads = max(1, threads // 2)
+    procs = [
+        sp.Popen(
+            _map_cmd(reads, genome, map_threads, aligner, reorder=True),
+            stdout=sp.PIPE,
+            universal_newlines=True,
         )
-    logger.info(
-        f"{100 * round(n_reads['mapped'] / n_reads['total'], 2):.2f}% reads (single ends) mapped with Q >= {min_qual} ({n_reads['mapped']}/{n_reads['total']})"
-    )
+        for reads in (reads1, reads2)
+    ]
+    index = hio.new_pairs_index()
+    n_reads = {"total": 0, "mapped": 0}
+    batches = []
+    try:
+        for proc in procs:
+            ref_names, first = _read_sam_header(proc.stdout)
+            lines = itertools.chain([first] if first else [], proc.stdout)
+            batches.append(_prefetch(_sam_batches(lines, ref_names, batch_size)))
+        # Chromosome names, indexed by SAM reference id
+        ref_names = np.array(ref_names, dtype=object)
+        with open(out_pairs, "w") as pairs:
+            pairs.writelines(_pairs_header(info_contigs))
+            for end1, end2 in itertools.zip_longest(*batches):
+                if end1 is None or end2 is None or len(end1["name"]) != len(end2["name"]):
+                    # A stream ending early is most likely an aligner crash,
+                    # whose error is reported rather than the mismatch
+                    _check_ended(procs, (end1, end2), batch_size)
+                    raise ValueError(
+                        "Forward and reverse reads do not have the same number of reads."
+                    )
+                if (end1["name"] != end2["name"]).any():
+                    raise ValueError("Forward and reverse reads are not in the same order.")
+                for end in (end1, end2):
+                    n_reads["total"] += len(end["name"])
+                    n_reads["mapped"] += int(((end["mapq"] >= min_qual) & (end["ref"] >= 0)).sum())
+                _write_pairs_batch(pairs, end1, end2, ref_names, min_qual, index)
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+        raise
+    finally:
+        # Prefetch threads stop once the aligners are done or killed
+        for batch in batches:
+            batch.close()
+        for proc in procs:
+            proc.wait()
+            proc.stdout.close()
+    for proc in procs:
+        if proc.returncode != 0:
+            raise sp.CalledProcessError(proc.returncode, proc.args)
+    hio.write_pairs_index(out_pairs, index)
+    return _pairs_stats(n_reads, 0, index, min_qual)
 
 
 def generate_log_header(log_path, input1, input2, genome, enzyme):
@@ -258,62 +788,75 @@ def generate_log_header(log_path, input1, input2, genome, enzyme):
     hcl.set_file_handler(log_path, formatter=hcl.logfile_formatter)
 
 
-def filter_pcr_dup(pairs_idx_file, filtered_file):
+def filter_pcr_dup(pairs_idx_file, filtered_file, threads=1, tmp_dir=None, max_mismatch=0):
     """
-    Filter out PCR duplicates from a coordinate-sorted pairs file using
-    overrrepresented exact coordinates. If multiple fragments have two reads
-    with the exact same coordinates, only one of those fragments is kept.
+    Filter out PCR duplicates from a pairs file using overrrepresented exact
+    coordinates. If multiple fragments have two reads with the exact same
+    coordinates, only one of those fragments is kept. Duplicates are
+    dropped while sorting the pairs by coordinates, so the input does not
+    need to be sorted. With max_mismatch, near duplicates (e.g. optical
+    duplicates) whose positions differ by at most max_mismatch bp on each
+    side are removed as well.
     Parameters
     ----------
     pairs_idx_file : str
-        Path to an indexed pairs file containing the Hi-C reads.
+        Path to an indexed pairs file (or binary pairs directory) containing
+        the Hi-C reads. Binary pairs must be sorted by coordinates.
     filtered_file : str
-        Path to the output pairs file after removing duplicates.
+        Path to the output pairs file after removing duplicates. Written as a
+        binary pairs directory if the input is binary.
+    threads : int
+        Number of threads used for sorting.
+    tmp_dir : str
+        Path to the directory where temporary sort files are written.
+    max_mismatch : int
+        Maximum distance in bp between the positions of duplicates on each
+        side. Exact coordinates are used if 0.
+
+    Returns
+    -------
+    dict :
+        Number of pairs read ("pcr_pairs"), of duplicates removed
+        ("pcr_duplicates") and of pairs written ("pairs").
     """
-    # Keep count of how many reads are filtered
-    filter_count = 0
-    reads_count = 0
-    # Store header lines
+    stats = {}
     header = hio.get_pairs_header(pairs_idx_file)
-    with open(pairs_idx_file) as pairs, open(filtered_file, "w") as filtered:
-        # Copy header lines to filtered file
-        for head_line in header:
-            filtered.write(head_line + "\n")
-            next(pairs)
-
-        # Use csv methods to easily access columns
-        paircols = [
-            "readID",
-            "chr1",
-            "pos1",
-            "chr2",
-            "pos2",
-            "strand1",
-            "strand2",
-            "frag1",
-            "frag2",
-        ]
-        # Columns used for comparison of coordinates
-        coord_cols = [col for col in paircols if col != "readID"]
-        pair_reader = csv.DictReader(pairs, delimiter="\t", fieldnames=paircols)
-        filt_writer = csv.DictWriter(filtered, delimiter="\t", fieldnames=paircols)
-
-        # Initialise a variable to store coordinates of reads in previous pair
-        prev = {k: 0 for k in paircols}
-        for pair in pair_reader:
-            reads_count += 1
-            # If coordinates are the same as before, skip pair
-            if all(pair[pair_var] == prev[pair_var] for pair_var in coord_cols):
-                filter_count += 1
-                continue
-            # Else write pair and store new coordinates as previous
-            else:
-                filt_writer.writerow(pair)
-                prev = pair
-        logger.info(
-            f"{100 * round(filter_count / reads_count, 3):.1f}% PCR duplicates have been filtered out ({filter_count}/{reads_count} pairs)"
+    # Binary pairs are deduplicated into binary pairs
+    if hio.is_binary_pairs(pairs_idx_file):
+        chunks = hst.remove_duplicates(
+            hio.read_pairs_chunks(pairs_idx_file), stats, max_mismatch=max_mismatch
         )
-        logger.info(f"{reads_count - filter_count} pairs remaining after removing PCR duplicates")
+        read_ids = hio.load_pairs_binary(pairs_idx_file)[0]["read_ids"]
+        stats["pairs"] = hio.write_pairs_binary(chunks, filtered_file, header, read_ids=read_ids)
+    elif max_mismatch > 0:
+        # Near duplicates are found in a sliding window over sorted pairs
+        sorted_file = filtered_file + ".sorted"
+        hio.sort_pairs(
+            pairs_idx_file, sorted_file, keys=hst.DUP_COLS, tmp_dir=tmp_dir, threads=threads
+        )
+        chunks = hst.remove_duplicates(
+            hio.read_pairs_chunks(sorted_file), stats, max_mismatch=max_mismatch
+        )
+        stats["pairs"] = hio.write_pairs(chunks, filtered_file, header)
+        for file in [sorted_file, hio.get_pairs_index_path(sorted_file)]:
+            if os.path.exists(file):
+                os.remove(file)
+    else:
+        # Sorting on all coordinates makes duplicates consecutive
+        sort_stats = {}
+        stats["pairs"] = hio.sort_pairs(
+            pairs_idx_file,
+            filtered_file,
+            keys=hst.DUP_COLS,
+            tmp_dir=tmp_dir,
+            threads=threads,
+            dedup=True,
+            stats=sort_stats,
+        )
+        stats["pcr_pairs"] = sort_stats["pairs"]
+        stats["pcr_duplicates"] = sort_stats["duplicates"]
+    hst.log_duplicates(stats)
+    return stats
 
 
 def pairs2cool(pairs_file, cool_file, bins_file, exclude):
@@ -454,97 +997,14 @@ def pairs2matrix(pairs_file, mat_file, fragments_file, mat_fmt="graal", threads=
     mat_fmt : str
         The format to use when writing the matrix. Can be graal or bg2 format.
     threads : int
-        Number of threads to use in parallel.
+        Unused, contacts are counted without sorting the pairs.
     tmp_dir : str
-        Temporary directory for sorting files. If None given, will use the system default.
+        Path to the directory where contacts are written while counting.
+        Defaults to the system temporary directory.
     """
-    # Number of fragments is N lines in frag list - 1 for the header
-    n_frags = sum(1 for line in open(fragments_file)) - 1
-    frags = pd.read_csv(fragments_file, delimiter="\t")
-
-    def write_mat_entry(frag1, frag2, contacts):
-        """Write a single sparse matrix entry in either graal or bg2 format"""
-        if mat_fmt == "graal":
-            mat.write("\t".join(map(str, [frag1, frag2, n_occ])) + "\n")
-        elif mat_fmt == "bg2":
-            frag1, frag2 = int(frag1), int(frag2)
-            mat.write(
-                "\t".join(
-                    map(
-                        str,
-                        [
-                            frags.chrom[frag1],
-                            frags.start_pos[frag1],
-                            frags.end_pos[frag1],
-                            frags.chrom[frag2],
-                            frags.start_pos[frag2],
-                            frags.end_pos[frag2],
-                            contacts,
-                        ],
-                    )
-                )
-                + "\n"
-            )
-
-    pre_mat_file = mat_file + ".pre.pairs"
-    hio.sort_pairs(
-        pairs_file,
-        pre_mat_file,
-        keys=["frag1", "frag2"],
-        threads=threads,
-        tmp_dir=tmp_dir,
-    )
-    header_size = len(hio.get_pairs_header(pre_mat_file))
-    with open(pre_mat_file) as pairs, open(mat_file, "w") as mat:
-        # Skip header lines
-        for _ in range(header_size):
-            next(pairs)
-        prev_pair = ["0", "0"]  # Pairs identified by [frag1, frag2]
-        n_occ = 0  # Number of occurences of each frag combination
-        n_nonzero = 0  # Total number of nonzero matrix entries
-        n_pairs = 0  # Total number of pairs entered in the matrix
-        pairs_reader = csv.reader(pairs, delimiter="\t")
-        # First line contains nrows, ncols and number of nonzero entries.
-        # Number of nonzero entries is unknown for now
-        if mat_fmt == "graal":
-            mat.write("\t".join(map(str, [n_frags, n_frags, "-"])) + "\n")
-        for pair in pairs_reader:
-            # Fragment ids are field 8 and 9
-            curr_pair = [pair[7], pair[8]]
-            # Increment number of occurences for fragment pair
-            if prev_pair == curr_pair:
-                n_occ += 1
-            # Write previous pair and start a new one
-            else:
-                if n_occ > 0:
-                    write_mat_entry(prev_pair[0], prev_pair[1], n_occ)
-                prev_pair = curr_pair
-                n_pairs += n_occ
-                n_occ = 1
-                n_nonzero += 1
-        # Write the last value
-        write_mat_entry(curr_pair[0], curr_pair[1], n_occ)
-        n_nonzero += 1
-        n_pairs += 1
-
-    # Edit header line to fill number of nonzero entries inplace in graal header
-    if mat_fmt == "graal":
-        with open(mat_file) as mat, open(pre_mat_file, "w") as tmp_mat:
-            header = mat.readline()
-            header = header.replace("-", str(n_nonzero))
-            tmp_mat.write(header)
-            st.copyfileobj(mat, tmp_mat)
-        # Replace the matrix file with the one with corrected header
-        os.rename(pre_mat_file, mat_file)
-    else:
-        os.remove(pre_mat_file)
-
-    logger.info(
-        "%d pairs used to build a contact map of %d bins with %d nonzero entries.",
-        n_pairs,
-        n_frags,
-        n_nonzero,
-    )
+    contacts = {}
+    hst.consume(hst.count_contacts(hio.read_pairs_chunks(pairs_file), contacts, tmp_dir=tmp_dir))
+    hst.write_contacts(contacts, mat_file, fragments_file, mat_fmt)
 
 
 def check_tool(name):
@@ -575,6 +1035,7 @@ def full_pipeline(
     no_cleanup=False,
     out_dir=None,
     pcr_duplicates=False,
+    pcr_max_mismatch=0,
     plot=False,
     prefix=None,
     read_len=None,
@@ -583,6 +1044,11 @@ def full_pipeline(
     threads=1,
     tmp_dir=None,
     skip_count=False,
+    binary_pairs=False,
+    read_ids="keep",
+    stream_align=False,
+    stream_cutsite=False,
+    persistent_index=False,
 ):
     """
     Run the whole hicstuff pipeline. Starting from fastq files and a genome to
@@ -653,6 +1119,10 @@ def full_pipeline(
         If True, PCR duplicates will be filtered based on genomic positions.
         Pairs where both reads have exactly the same coordinates are considered
         duplicates and only one of those will be conserved.
+    pcr_max_mismatch : int
+        If above 0, pairs whose positions differ by at most this many bp on
+        each side from a kept pair are also considered duplicates, to catch
+        optical duplicates and positional jitter.
     distance_law : bool
         If True, generates a distance law file with the values of the probabilities
         to have a contact between two distances for each chromosomes or arms if the
@@ -673,6 +1143,24 @@ def full_pipeline(
     skip_count : bool
         If True, skip counting reads in the input FASTQ files. Useful for very
         large files where counting is slow.
+    binary_pairs : bool
+        If True, intermediate pairs attributed to fragments are stored in the
+        binary columnar format of hicstuff.io instead of text. The final pairs
+        are exported as text.
+    read_ids : str
+        How read names are stored in binary pairs: "keep", "hash" or "drop".
+    stream_align : bool
+        If True, forward and reverse reads are aligned concurrently and the
+        pairs file is made directly from the aligners output, without
+        writing and name-sorting BAM files. Not available with iterative
+        mapping.
+    stream_cutsite : bool
+        If True and mapping is "cutsite", digested reads are streamed to the
+        aligners through named pipes while reads are being cut, instead of
+        being written to temporary gzipped fastq files.
+    persistent_index : bool
+        If True and mapping is "iterative", the genome index is kept in memory
+        across alignment rounds, see hicstuff.iteralign.iterative_align.
     """
     # Check if third parties can be run
     if aligner in ("bowtie2", "minimap2", "bwa"):
@@ -769,9 +1257,11 @@ def full_pipeline(
     bam1 = _tmp_file("for.bam")
     bam2 = _tmp_file("rev.bam")
     pairs = _tmp_file("valid.pairs")
-    pairs_idx = _tmp_file("valid_idx.pairs")
-    pairs_filtered = _tmp_file("valid_idx_filtered.pairs")
-    pairs_pcr = _tmp_file("valid_idx_pcrfree.pairs")
+    # Binary pairs are directories, named after the text files they replace
+    pairs_ext = ".pairs.bin" if binary_pairs else ".pairs"
+    pairs_idx = _tmp_file("valid_idx" + pairs_ext)
+    pairs_filtered = _tmp_file("valid_idx_filtered" + pairs_ext)
+    pairs_pcr = _tmp_file("valid_idx_pcrfree" + pairs_ext)
 
     # Enable file logging
     hcl.set_file_handler(log_file)
@@ -882,11 +1372,20 @@ def full_pipeline(
         bam1, bam2 = input1, input2
     elif start_stage == 2:
         pairs = input1
-    elif start_stage == 3:
+    elif start_stage == 3 and not binary_pairs:
         pairs_idx = input1
 
     # Perform genome alignment
     nreads_input1 = 0
+    # Reads cut at ligation sites and streamed to the aligners, if any
+    digest_streams = None
+
+    def _digest_stream():
+        if digest_streams is None:
+            return contextlib.nullcontext()
+        # Cutting is light compared to alignment
+        return _stream_cutsite(*digest_streams, enzyme=enzyme, threads=max(2, threads // 4))
+
     if start_stage == 0:
         if skip_count:
             logger.info("Skipping read count check (--skip-count).")
@@ -917,46 +1416,59 @@ def full_pipeline(
             # normal alignment.
             except ValueError:
                 iterative = False
-                digest_for = _tmp_file("digest_for.fq.gz")
-                digest_rev = _tmp_file("digest_rev.fq.gz")
-                hcc.cut_ligation_sites(
-                    fq_for=reads1,
-                    fq_rev=reads2,
-                    digest_for=digest_for,
-                    digest_rev=digest_rev,
-                    enzyme=enzyme,
-                    mode="for_vs_rev",
-                    seed_size=20,
-                    n_cpu=threads,
-                )
+                if stream_cutsite:
+                    # Reads are cut while being aligned, through named pipes
+                    digest_for = _tmp_file("digest_for.fq")
+                    digest_rev = _tmp_file("digest_rev.fq")
+                    digest_streams = (reads1, reads2, digest_for, digest_rev)
+                else:
+                    digest_for = _tmp_file("digest_for.fq.gz")
+                    digest_rev = _tmp_file("digest_rev.fq.gz")
+                    hcc.cut_ligation_sites(
+                        fq_for=reads1,
+                        fq_rev=reads2,
+                        digest_for=digest_for,
+                        digest_rev=digest_rev,
+                        enzyme=enzyme,
+                        mode="for_vs_rev",
+                        seed_size=20,
+                        n_cpu=threads,
+                        # Digested reads are temporary, favour speed over size
+                        compress_level=1,
+                    )
                 reads1, reads2 = digest_for, digest_rev
         else:
             logger.error("mapping must be either normal, iterative or cutsite.")
             raise ValueError
 
-        logger.info("Now separately mapping R1 and R2 reads...")
-        align_reads(
-            reads1,
-            genome,
-            bam1,
-            tmp_dir=tmp_dir,
-            threads=threads,
-            aligner=aligner,
-            iterative=iterative,
-            min_qual=min_qual,
-            read_len=read_len,
-        )
-        align_reads(
-            reads2,
-            genome,
-            bam2,
-            tmp_dir=tmp_dir,
-            threads=threads,
-            aligner=aligner,
-            iterative=iterative,
-            min_qual=min_qual,
-            read_len=read_len,
-        )
+        if stream_align and iterative:
+            logger.warning("Iterative mapping requires BAM files, --stream-align is ignored.")
+            stream_align = False
+        # Reads are aligned when making pairs in streaming mode
+        if not stream_align:
+            logger.info("Now separately mapping R1 and R2 reads concurrently...")
+            # Both mates share the thread budget
+            with _log_stage("Alignment", threads), _digest_stream(), ThreadPoolExecutor(2) as pool:
+                jobs = [
+                    pool.submit(
+                        align_reads,
+                        reads,
+                        genome,
+                        bam,
+                        tmp_dir=tmp_dir,
+                        threads=mate_threads,
+                        aligner=aligner,
+                        iterative=iterative,
+                        min_qual=min_qual,
+                        read_len=read_len,
+                        persistent_index=persistent_index,
+                    )
+                    for reads, bam, mate_threads in zip(
+                        [reads1, reads2], [bam1, bam2], _split_threads(threads, 2)
+                    )
+                ]
+                for job in jobs:
+                    job.result()
 
     # Detect if multiple enzymes are given
     if re.search(",", enzyme):
@@ -989,9 +1501,29 @@ def full_pipeline(
         hcd.frag_len(frags_file_name=fragments_list, plot=plot, fig_path=frag_plot)
 
         # Make pairs file (readID, chr1, chr2, pos1, pos2, strand1, strand2)
-        bam2pairs(bam1, bam2, pairs, info_contigs, min_qual=min_qual)
+        if start_stage == 0 and stream_align:
+            logger.info("Now mapping R1 and R2 reads concurrently into pairs...")
+            with _log_stage("Alignment", threads), _digest_stream():
+                align_pairs(
+                    reads1,
+                    reads2,
+                    genome,
+                    pairs,
+                    info_contigs,
+                    threads=threads,
+                    aligner=aligner,
+                    min_qual=min_qual,
+                )
+        else:
+            with _log_stage("Pairing of BAM files", threads):
+                bam2pairs(bam1, bam2, pairs, info_contigs, min_qual=min_qual, threads=threads)
 
     # Starting from pairs file
+    pairs_sorted = False
+    tot_pairs = None
+    # Histograms of events, counted during attribution to estimate filtering
+    # thresholds without reading pairs again
+    n_events = None
     if start_stage <= 2:
         restrict_table = {}
         for record in SeqIO.parse(hio.read_compressed(fasta), "fasta"):
@@ -1002,26 +1534,66 @@ def full_pipeline(
 
         # Add fragment index to pairs (readID, chr1, pos1, chr2,
         # pos2, strand1, strand2, frag1, frag2)
-        hcd.attribute_fragments(pairs, pairs_idx, restrict_table)
+        if threads > 1 and not binary_pairs and not hio.is_compressed(pairs):
+            # Attribute parts of the pairs file in parallel processes, each
+            # sorting its pairs in runs merged into the indexed pairs file
+            attribution = hcd.attribute_fragments(
+                pairs,
+                pairs_idx,
+                restrict_table,
+                threads=threads,
+                count_events=filter_events,
+                sort_keys=["chr1", "pos1", "chr2", "pos2"],
+                tmp_dir=tmp_dir,
+            )
+            tot_pairs = attribution["pairs"]
+            n_events = attribution.get("events")
+            pairs_sorted = True
+        else:
+            header = hst.add_frag_columns(hio.get_pairs_header(pairs))
+            chunks = hst.attribute_fragments(
+                hio.read_pairs_chunks(pairs), restrict_table, hst.get_chrom_order(header)
+            )
+            if filter_events:
+                n_events = {}
+                chunks = hst.count_events(chunks, n_events)
+            if not binary_pairs:
+                # Stream attributed pairs directly to sort
+                tot_pairs = hio.sort_pairs_chunks(
+                    chunks,
+                    header,
+                    pairs_idx,
+                    keys=["chr1", "pos1", "chr2", "pos2"],
+                    threads=threads,
+                    tmp_dir=tmp_dir,
+                )
+                pairs_sorted = True
+    elif binary_pairs:
+        header = hio.get_pairs_header(input1)
+        chunks = hio.read_pairs_chunks(input1)
 
     # Sort pairs file by coordinates for next steps
-    hio.sort_pairs(
-        pairs_idx,
-        pairs_idx + ".sorted",
-        keys=["chr1", "pos1", "chr2", "pos2"],
-        threads=threads,
-        tmp_dir=tmp_dir,
-    )
-    os.rename(pairs_idx + ".sorted", pairs_idx)
-
-    # Count total pairs
-    tot_pairs = 0
-    with open(pairs_idx) as file:
-        for line in file:
-            if line.startswith("#"):
-                continue
-            else:
-                tot_pairs += 1
+    if binary_pairs:
+        unsorted_idx = pairs_idx + ".unsorted"
+        tot_pairs = hio.write_pairs_binary(chunks, unsorted_idx, header, read_ids=read_ids)
+        hio.sort_pairs_binary(
+            unsorted_idx, pairs_idx, keys=["chr1", "pos1", "chr2", "pos2"], tmp_dir=tmp_dir
+        )
+        st.rmtree(unsorted_idx)
+    elif not pairs_sorted:
+        hio.sort_pairs(
+            pairs_idx,
+            pairs_idx + ".sorted",
+            keys=["chr1", "pos1", "chr2", "pos2"],
+            threads=threads,
+            tmp_dir=tmp_dir,
+        )
+        hio.rename_pairs(pairs_idx + ".sorted", pairs_idx)
+
+    # Total pairs are counted by the producing stage, or read from the
+    # sidecar index of a given indexed pairs file
+    if tot_pairs is None:
+        tot_pairs = hio.count_pairs(pairs_idx)
     if nreads_input1 != 0:
         logger.info(
             f"{tot_pairs} pairs successfully mapped ({round(100 * tot_pairs / (nreads_input1), 2)}%)"
@@ -1029,23 +1601,45 @@ def full_pipeline(
     else:
         logger.info(f"{tot_pairs} pairs successfully mapped")
 
-    # Filter pairs if requested
+    # Filter pairs, remove PCR duplicates and count contacts in a single
+    # pass over the sorted pairs. Only the final pairs file is written.
+    header = hio.get_pairs_header(pairs_idx)
+    chunks = hio.read_pairs_chunks(pairs_idx)
+    pairs_stats = {}
+    use_pairs = pairs_idx
     if filter_events:
         uncut_thr, loop_thr = hcf.get_thresholds(
-            pairs_idx, plot_events=plot, fig_path=dist_plot, prefix=prefix
+            pairs_idx, plot_events=plot, fig_path=dist_plot, prefix=prefix, n_events=n_events
         )
-        hcf.filter_events(
-            pairs_idx,
-            pairs_filtered,
+        chunks = hst.filter_events(chunks, uncut_thr, loop_thr, pairs_stats)
+        use_pairs = pairs_filtered
+        # Keep filtered pairs before PCR duplicates removal for inspection
+        if pcr_duplicates and no_cleanup:
+            chunks = hst.tee(chunks, pairs_filtered, header, binary=binary_pairs, read_ids=read_ids)
+    if pcr_duplicates:
+        chunks = hst.remove_duplicates(chunks, pairs_stats, max_mismatch=pcr_max_mismatch)
+        use_pairs = pairs_pcr
+    if mat_fmt != "cool":
+        contacts = {}
+        chunks = hst.count_contacts(chunks, contacts, tmp_dir=tmp_dir)
+    pairs_count = tot_pairs
+    if use_pairs != pairs_idx and binary_pairs:
+        pairs_count = hio.write_pairs_binary(chunks, use_pairs, header, read_ids=read_ids)
+    elif use_pairs != pairs_idx:
+        pairs_count = hio.write_pairs(chunks, use_pairs, header)
+    elif mat_fmt != "cool":
+        hst.consume(chunks)
+    if filter_events:
+        hcf.summarize_events(
+            pairs_stats,
             uncut_thr,
             loop_thr,
             plot_events=plot,
             fig_path=pie_plot,
             prefix=prefix,
         )
-        use_pairs = pairs_filtered
-    else:
-        use_pairs = pairs_idx
+    if pcr_duplicates:
+        hst.log_duplicates(pairs_stats)
 
     # Generate fragments file if it has not been already
     if not fragments_updated:
@@ -1083,21 +1677,15 @@ def full_pipeline(
             p_s = hcdl.normalize_distance_law(x_s, p_s)
             hcdl.plot_ps_slope(x_s, p_s, labels=chr_labels, fig_path=distance_law_plot)
 
-    # Filter out PCR duplicates if requested
-    if pcr_duplicates:
-        filter_pcr_dup(use_pairs, pairs_pcr)
-        use_pairs = pairs_pcr
+    # Export final binary pairs to 4DN text format, for cooler and output
+    if binary_pairs:
+        pairs_text = use_pairs[: -len(".bin")]
+        hio.write_pairs(hio.read_pairs_chunks(use_pairs), pairs_text, header)
+        use_pairs = pairs_text
 
     # Build matrix from pairs.
     if mat_fmt == "cool":
         # Log which pairs file is being used and how many pairs are listed
-        pairs_count = 0
-        with open(use_pairs) as file:
-            for line in file:
-                if line.startswith("#"):
-                    continue
-                else:
-                    pairs_count += 1
         logger.info(
             "Generating matrix from pairs file %s (%d pairs in the file) ",
             use_pairs,
@@ -1127,14 +1715,7 @@ def full_pipeline(
             # Balance binned matrix
             balance(mat, balancing_args)
     else:
-        pairs2matrix(
-            use_pairs,
-            mat,
-            fragments_list,
-            mat_fmt=mat_fmt,
-            threads=threads,
-            tmp_dir=tmp_dir,
-        )
+        hst.write_contacts(contacts, mat, fragments_list, mat_fmt)
 
     # Get stats on the pipeline
     try:
@@ -1153,6 +1734,9 @@ def full_pipeline(
     # to avoid destroying input files given directly by the user.
     if p.parent == out_dir_abs / "tmp":
         p.rename(pairsf)
+        # The final pairs file is sorted again below, its index is obsolete
+        if os.path.exists(hio.get_pairs_index_path(use_pairs)):
+            os.remove(hio.get_pairs_index_path(use_pairs))
     else:
         st.copy2(str(p), str(pairsf))
 
@@ -1193,7 +1777,16 @@ def full_pipeline(
         # Remove the rest of tempfiles
         for file in tempfiles:
             try:
-                os.remove(file)
+                # Binary pairs are directories
+                if os.path.isdir(file):
+                    st.rmtree(file)
+                else:
+                    os.remove(file)
+            except FileNotFoundError:
+                pass
+            # Sidecar index of text pairs files
+            try:
+                os.remove(hio.get_pairs_index_path(file))
             except FileNotFoundError:
                 pass
 
@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+"""Streaming pairs engine
+
+Process Hi-C pairs as a stream of record blocks instead of rewriting a text
+file at each step of the pipeline. Each stage is a generator which takes an
+iterable of blocks (pandas.DataFrame with one column per pairs column, as
+generated by hicstuff.io.read_pairs_chunks) and yields transformed blocks,
+so that stages can be chained in memory and records are only written to disk
+once at the end:
+
+    chunks = hio.read_pairs_chunks("valid.pairs")
+    chunks = attribute_fragments(chunks, restriction_table, chrom_order)
+    chunks = count_events(chunks, n_events)
+    chunks = filter_events(chunks, thr_uncut, thr_loop, stats)
+    chunks = remove_duplicates(chunks, stats)
+    hio.write_pairs(chunks, "valid_idx_pcrfree.pairs", header)
+
+Counters of each stage are accumulated in a dictionary given by the caller
+and are only complete once the stream has been entirely consumed.
+
+@author: cmdoret
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import hicstuff.digest as hcd
+import hicstuff.filter as hcf
+import hicstuff.io as hio
+from hicstuff.log import logger
+
+# Columns which must be identical for two pairs to be PCR duplicates
+DUP_COLS = ["chr1", "pos1", "chr2", "pos2", "strand1", "strand2", "frag1", "frag2"]
+
+# Nonzero entries of a contact matrix, as written to temporary files
+CONTACTS_DTYPE = np.dtype([("frag1", np.int64), ("frag2", np.int64), ("contacts", np.int64)])
+
+# Number of fragment pairs counted in memory before spilling to disk
+DEFAULT_MAX_CONTACTS = 2**24
+
+
+def _add_counts(stats, counts):
+    """Add values from counts to the matching entries of stats, inplace."""
+    for key, value in counts.items():
+        stats[key] = stats.get(key, 0) + value
+
+
+def get_chrom_order(header):
+    """
+    Get chromosome names from the "#chromsize:" lines of a pairs header.
+
+    Parameters
+    ----------
+    header : list of str
+        Header lines of a pairs file.
+
+    Returns
+    -------
+    list of str :
+        Chromosome names, in the order of the header.
+
+    Examples
+    --------
+    >>> get_chrom_order(["## pairs format v1.0", "#chromsize: chrA 10", "#chromsize: chrB 5"])
+    ['chrA', 'chrB']
+    """
+    return [line.split()[1] for line in header if line.startswith("#chromsize")]
+
+
+def add_frag_columns(header):
+    """
+    Add the frag1 and frag2 columns to the "#columns:" line of a pairs header.
+
+    Parameters
+    ----------
+    header : list of str
+        Header lines of a pairs file.
+
+    Returns
+    -------
+    list of str :
+        The updated header lines.
+
+    Examples
+    --------
+    >>> add_frag_columns(["#columns: readID chr1 pos1 chr2 pos2 strand1 strand2"])
+    ['#columns: readID chr1 pos1 chr2 pos2 strand1 strand2 frag1 frag2']
+    """
+    return [
+        line.rstrip() + " frag1 frag2" if line.startswith("#columns") else line for line in header
+    ]
+
+
+def attribute_fragments(chunks, restriction_table, chrom_order):
+    """
+    Stream stage adding the genome-based restriction fragment index of each
+    read in columns frag1 and frag2.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records with columns readID, chr1, pos1, chr2, pos2,
+        strand1, strand2.
+    restriction_table : dict
+        Dictionary with chromosome identifiers (str) as keys and list of
+        positions (int) of restriction sites as values.
+    chrom_order : list of str
+        Chromosome names, in the order of the pairs header.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        Blocks of records with frag1 and frag2 columns. Records on contigs
+        absent from chrom_order are discarded.
+    """
+    shift_frags = hcd.get_frag_shifts(chrom_order, restriction_table)
+    missing_contigs = set()
+    for chunk in chunks:
+        chunk, missing = hcd.attribute_pairs(chunk, restriction_table, shift_frags)
+        missing_contigs |= missing
+        yield chunk
+    if missing_contigs:
+        logger.warning(
+            "Pairs on the following contigs were discarded as "
+            "those contigs are not listed in the paris file header. "
+            "This is normal if you filtered out small contigs: {}".format(
+                " ".join(list(missing_contigs))
+            )
+        )
+
+
+def count_events(chunks, n_events):
+    """
+    Stream stage counting intrachromosomal events of each type by number of
+    restriction sites between reads, so that filtering thresholds can be
+    estimated without reading the pairs again. Records are not modified.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records with frag1 and frag2 columns.
+    n_events : dict
+        Histograms of events, updated inplace as in
+        hicstuff.filter.count_events.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        The input blocks.
+    """
+    for chunk in chunks:
+        hcf.count_events(chunk, n_events)
+        yield chunk
+
+
+def filter_events(chunks, thr_uncut, thr_loop, stats):
+    """
+    Stream stage removing loops, uncuts and weird events. The number of
+    pairs of each category is added to stats under keys "uncuts", "loops",
+    "weirds", "intra" and "inter".
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records with frag1 and frag2 columns.
+    thr_uncut : int
+        Minimum number of restriction sites between reads to keep an
+        intrachromosomal +- pair.
+    thr_loop : int
+        Minimum number of restriction sites between reads to keep an
+        intrachromosomal -+ pair.
+    stats : dict
+        Counters of the stream, updated inplace.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        Blocks of records which passed the filters.
+    """
+    _add_counts(stats, dict.fromkeys(["uncuts", "loops", "weirds", "intra", "inter"], 0))
+    for chunk in chunks:
+        chunk, counts = hcf.filter_pairs(chunk, thr_uncut, thr_loop)
+        _add_counts(stats, counts)
+        yield chunk
+
+
+def remove_duplicates(chunks, stats, max_mismatch=0):
+    """
+    Stream stage removing PCR duplicates from coordinate-sorted records: a
+    pair with the exact same coordinates as the previous one is discarded.
+    If max_mismatch is set, a pair is discarded if both its ends are within
+    max_mismatch bp of the ends of a pair kept before it, with the same
+    chromosomes and strands, as in pairtools dedup. The number of input
+    pairs and of duplicates are added to stats under keys "pcr_pairs" and
+    "pcr_duplicates".
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records with frag1 and frag2 columns, sorted by
+        chr1, pos1, chr2 and pos2.
+    stats : dict
+        Counters of the stream, updated inplace.
+    max_mismatch : int
+        Maximum distance in bp between the positions of two duplicates, on
+        each side.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        Blocks of records without duplicates.
+    """
+    if max_mismatch > 0:
+        yield from _remove_near_duplicates(chunks, stats, max_mismatch)
+        return
+    last = None
+    for chunk in chunks:
+        if chunk.shape[0] == 0:
+            continue
+        dup = np.ones(chunk.shape[0], dtype=bool)
+        for col in DUP_COLS:
+            values = chunk[col].to_numpy()
+            dup[1:] &= values[1:] == values[:-1]
+            # First record is compared to the last one of the previous block
+            dup[0] &= last is not None and values[0] == last[col]
+        last = {col: chunk[col].iat[-1] for col in DUP_COLS}
+        _add_counts(stats, {"pcr_pairs": chunk.shape[0], "pcr_duplicates": int(dup.sum())})
+        yield chunk[~dup]
+
+
+# Columns compared to find near duplicates
+WINDOW_COLS = ["chr1", "pos1", "chr2", "pos2", "strand1", "strand2"]
+
+
+def _near_pairs(window, max_mismatch):
+    """
+    Find all pairs of records (j, i) with j < i in a coordinate-sorted
+    block, with the same chromosomes and strands and positions within
+    max_mismatch bp on each side. Candidates are taken in a sliding window
+    on pos1 using binary searches. Returns the arrays of i and j.
+    """
+    chr1 = pd.factorize(window.chr1)[0].astype(np.int64)
+    pos1 = window.pos1.to_numpy(dtype=np.int64)
+    # Sorted key merging chromosome and position, windows never span two chromosomes
+    key1 = (chr1 << 33) + pos1
+    starts = np.searchsorted(key1, key1 - max_mismatch, side="left")
+    counts = np.arange(len(key1)) - starts
+    right = np.repeat(np.arange(len(key1)), counts)
+    left = (
+        np.repeat(starts, counts)
+        + np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    near = np.abs(pos1[right] - pos1[left]) <= max_mismatch
+    near &= np.abs(window.pos2.to_numpy()[right] - window.pos2.to_numpy()[left]) <= max_mismatch
+    for col in ["chr2", "strand1", "strand2"]:
+        values = window[col].to_numpy()
+        near &= values[right] == values[left]
+    return right[near], left[near]
+
+
+def _remove_near_duplicates(chunks, stats, max_mismatch):
+    """
+    Remove near duplicates from coordinate-sorted blocks of records. See
+    remove_duplicates. Kept records within max_mismatch bp of the end of
+    each block are carried to the next one, so that memory is bounded by
+    the window and block sizes.
+    """
+    tail = None
+    for chunk in chunks:
+        if chunk.shape[0] == 0:
+            continue
+        window = chunk[WINDOW_COLS]
+        n_tail = 0 if tail is None else tail.shape[0]
+        if n_tail:
+            window = pd.concat([tail, window], ignore_index=True)
+        # Exact copies of a previous record are always duplicates, near pairs
+        # are only searched between distinct records.
+        uniq = np.flatnonzero(~window.duplicated().to_numpy())
+        right, left = _near_pairs(window.iloc[uniq].reset_index(drop=True), max_mismatch)
+        right, left = uniq[right], uniq[left]
+        # Records of the tail were already kept
+        in_chunk = right >= n_tail
+        right, left = right[in_chunk], left[in_chunk]
+        # Records without any near record before them are kept, records near
+        # one of them are duplicates.
+        kept = np.zeros(window.shape[0], dtype=bool)
+        kept[uniq] = True
+        kept[right] = False
+        dup = np.zeros(window.shape[0], dtype=bool)
+        dup[right[kept[left]]] = True
+        # Other records depend on whether their near records were kept
+        if not dup[right].all():
+            order = np.argsort(right, kind="stable")
+            right, left = right[order], left[order]
+            pending = np.unique(right[~dup[right]])
+            starts = np.searchsorted(right, pending, side="left")
+            ends = np.searchsorted(right, pending, side="right")
+            for i, start, end in zip(pending.tolist(), starts.tolist(), ends.tolist()):
+                kept[i] = not kept[left[start:end]].any()
+        # Keep kept records which may be near records of the next block
+        last = window.iloc[-1]
+        tail = window[
+            kept
+            & (window.chr1 == last.chr1).to_numpy()
+            & (window.pos1 >= last.pos1 - max_mismatch).to_numpy()
+        ].reset_index(drop=True)
+        kept = kept[n_tail:]
+        _add_counts(stats, {"pcr_pairs": chunk.shape[0], "pcr_duplicates": int((~kept).sum())})
+        yield chunk[kept]
+
+
+def log_duplicates(stats):
+    """Log the number of PCR duplicates counted by remove_duplicates."""
+    filter_count = stats.get("pcr_duplicates", 0)
+    reads_count = stats.get("pcr_pairs", 0)
+    logger.info(
+        f"{100 * round(filter_count / max(reads_count, 1), 3):.1f}% PCR duplicates have been filtered out ({filter_count}/{reads_count} pairs)"
+    )
+    logger.info(f"{reads_count - filter_count} pairs remaining after removing PCR duplicates")
+
+
+def tee(chunks, out_file, header, binary=False, read_ids="keep"):
+    """
+    Stream stage writing records to a pairs file while passing them
+    unchanged to the next stage. Useful to keep intermediate files. Text
+    files get a sidecar index once the stream is exhausted.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records.
+    out_file : str
+        Path to the pairs file to write.
+    header : list of str
+        Header lines of the pairs file.
+    binary : bool
+        Whether to write a binary pairs directory instead of a text file.
+    read_ids : str
+        How to store read names in binary pairs: "keep", "hash" or "drop".
+
+    Yields
+    ------
+    pandas.DataFrame :
+        The input blocks.
+    """
+    if binary:
+        chroms = get_chrom_order(header)
+        hio.init_pairs_binary(out_file)
+        for chunk in chunks:
+            hio.write_pairs_binary_chunk(chunk, out_file, chroms, read_ids=read_ids)
+            yield chunk
+        hio.write_pairs_binary_meta(out_file, header, read_ids=read_ids)
+        return
+    index = hio.new_pairs_index()
+    with open(out_file, "w") as output:
+        for line in header:
+            output.write(line + "\n")
+        for chunk in chunks:
+            hio.write_pairs_chunk(chunk, output, index=index)
+            yield chunk
+    hio.write_pairs_index(out_file, index)
+
+
+def _reduce_contacts(keys, counts):
+    """Sum the counts of identical keys. Returns sorted unique keys and sums."""
+    keys = np.concatenate(keys)
+    counts = np.concatenate(counts)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    return uniq, np.bincount(inverse, weights=counts, minlength=len(uniq)).astype(np.int64)
+
+
+def _contact_keys(records):
+    """Encode fragment pairs of contact records as single integers."""
+    return (records["frag1"] << 32) | records["frag2"]
+
+
+def _contact_records(keys, counts):
+    """Decode sorted keys and their counts into contact records."""
+    records = np.empty(len(keys), dtype=CONTACTS_DTYPE)
+    records["frag1"] = keys >> 32
+    records["frag2"] = keys & 0xFFFFFFFF
+    records["contacts"] = counts
+    return records
+
+
+def _merge_contacts(run_files, out_file, block_size):
+    """
+    Merge runs of contact records sorted by fragment pair into out_file,
+    summing the counts of fragment pairs found in several runs. Runs are
+    read by blocks: all entries up to the smallest last key of the current
+    blocks are complete and can be written.
+    """
+    runs = [np.memmap(run_file, dtype=CONTACTS_DTYPE, mode="r") for run_file in run_files]
+    starts = [0] * len(runs)
+    with open(out_file, "wb") as output:
+        while True:
+            blocks = []
+            for i, run in enumerate(runs):
+                block = run[starts[i] : starts[i] + block_size]
+                if len(block):
+                    blocks.append((i, _contact_keys(block), block["contacts"]))
+            if not blocks:
+                break
+            bound = min(block_keys[-1] for _, block_keys, _ in blocks)
+            keys, counts = [], []
+            for i, block_keys, block_counts in blocks:
+                end = np.searchsorted(block_keys, bound, side="right")
+                keys.append(block_keys[:end])
+                counts.append(block_counts[:end])
+                starts[i] += end
+            _contact_records(*_reduce_contacts(keys, counts)).tofile(output)
+
+
+def count_contacts(chunks, contacts, tmp_dir=None, max_contacts=DEFAULT_MAX_CONTACTS):
+    """
+    Stream stage counting the number of occurences of each combination of
+    restriction fragments, without sorting the records. Once the stream is
+    consumed, contacts holds numpy arrays "frag1", "frag2" and "contacts"
+    with nonzero entries of the matrix sorted by frag1 and frag2. Those
+    arrays are mapped from a temporary file rather than held in memory.
+
+    When records are sorted by frag1, as in pairs sorted by coordinates,
+    rows of the matrix below the first fragment of the current block are
+    complete and are written out as the stream goes. Otherwise, counts are
+    written to a new temporary run whenever more than max_contacts fragment
+    pairs are held in memory, and runs are merged at the end.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Blocks of pairs records with frag1 and frag2 columns.
+    contacts : dict
+        Output dictionary, filled inplace.
+    tmp_dir : str
+        Path to the directory where temporary files will be created. Defaults
+        to the system temporary directory.
+    max_contacts : int
+        Maximum number of fragment pairs counted in memory.
+
+    Yields
+    ------
+    pandas.DataFrame :
+        The input blocks.
+    """
+    run_dir = tempfile.mkdtemp(prefix="hicstuff_contacts_", dir=tmp_dir)
+    run_files = []
+    output = None
+    # Largest key written to the current run
+    last = -1
+
+    def flush(keys, counts):
+        nonlocal output, last
+        # Keys must follow those of the current run, else a new run starts
+        if output is None or keys[0] <= last:
+            if output is not None:
+                output.close()
+            run_files.append(os.path.join(run_dir, f"run_{len(run_files)}.bin"))
+            output = open(run_files[-1], "wb")
+        _contact_records(keys, counts).tofile(output)
+        last = keys[-1]
+
+    try:
+        # Fragment pairs are encoded as a single integer: frag1 in the upper
+        # 32 bits and frag2 in the lower 32 bits.
+        keys, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        n_reduced = n_pending = 0
+        for chunk in chunks:
+            frag1 = chunk["frag1"].to_numpy(dtype=np.int64)
+            chunk_keys = (frag1 << 32) | chunk["frag2"].to_numpy(dtype=np.int64)
+            chunk_keys, chunk_counts = np.unique(chunk_keys, return_counts=True)
+            keys.append(chunk_keys)
+            counts.append(chunk_counts)
+            n_pending += len(chunk_keys)
+            # Merge pending entries once they outnumber merged ones to bound
+            # memory without re-merging everything at each block
+            if n_pending > n_reduced and len(chunk_keys):
+                reduced_keys, reduced_counts = _reduce_contacts(keys, counts)
+                # Rows below the first fragment of the block are complete
+                # if records are sorted by frag1
+                n_done = np.searchsorted(reduced_keys, (chunk_keys[0] >> 32) << 32)
+                if n_done and reduced_keys[0] > last:
+                    flush(reduced_keys[:n_done], reduced_counts[:n_done])
+                    reduced_keys, reduced_counts = reduced_keys[n_done:], reduced_counts[n_done:]
+                if len(reduced_keys) > max_contacts:
+                    flush(reduced_keys, reduced_counts)
+                    reduced_keys, reduced_counts = reduced_keys[:0], reduced_counts[:0]
+                keys, counts = [reduced_keys], [reduced_counts]
+                n_reduced, n_pending = len(reduced_keys), 0
+            yield chunk
+        keys, counts = _reduce_contacts(keys, counts)
+        if len(keys):
+            flush(keys, counts)
+        if output is not None:
+            output.close()
+            output = None
+        if len(run_files) > 1:
+            out_file = os.path.join(run_dir, "contacts.bin")
+            _merge_contacts(run_files, out_file, max(2**16, max_contacts // len(run_files)))
+            run_files = [out_file]
+        if run_files:
+            records = np.memmap(run_files[0], dtype=CONTACTS_DTYPE, mode="r")
+        else:
+            records = np.zeros(0, dtype=CONTACTS_DTYPE)
+        contacts["frag1"] = records["frag1"]
+        contacts["frag2"] = records["frag2"]
+        contacts["contacts"] = records["contacts"]
+    finally:
+        if output is not None:
+            output.close()
+        # Mapped records remain readable once their file is removed
+        shutil.rmtree(run_dir)
+
+
+def write_contacts(contacts, mat_file, fragments_file, mat_fmt="graal"):
+    """
+    Write a sparse contact matrix counted by count_contacts, by blocks of
+    entries.
+
+    Parameters
+    ----------
+    contacts : dict
+        Dictionary with numpy arrays "frag1", "frag2" and "contacts".
+    mat_file : str
+        Path where the matrix will be written.
+    fragments_file : str
+        Path to the fragments_list.txt file. Used to know total
+        matrix size in case some observations are not observed at the end.
+    mat_fmt : str
+        The format to use when writing the matrix. Can be graal or bg2 format.
+    """
+    frags = pd.read_csv(fragments_file, delimiter="\t")
+    n_frags = frags.shape[0]
+    n_nonzero = len(contacts["contacts"])
+    if mat_fmt not in ("graal", "bg2"):
+        raise ValueError("mat_fmt must be either graal or bg2.")
+    chrom = frags.chrom.to_numpy()
+    start = frags.start_pos.to_numpy()
+    end = frags.end_pos.to_numpy()
+    with open(mat_file, "w") as out:
+        # First line contains nrows, ncols and number of nonzero entries.
+        if mat_fmt == "graal":
+            out.write(f"{n_frags}\t{n_frags}\t{n_nonzero}\n")
+        # Entries are written by blocks, as they may not fit in memory
+        for i in range(0, n_nonzero, hio.DEFAULT_PAIRS_CHUNKSIZE):
+            frag1 = np.asarray(contacts["frag1"][i : i + hio.DEFAULT_PAIRS_CHUNKSIZE])
+            frag2 = np.asarray(contacts["frag2"][i : i + hio.DEFAULT_PAIRS_CHUNKSIZE])
+            counts = np.asarray(contacts["contacts"][i : i + hio.DEFAULT_PAIRS_CHUNKSIZE])
+            if mat_fmt == "graal":
+                mat = pd.DataFrame({"frag1": frag1, "frag2": frag2, "contacts": counts})
+            else:
+                mat = pd.DataFrame(
+                    {
+                        "chr1": chrom[frag1],
+                        "start1": start[frag1],
+                        "end1": end[frag1],
+                        "chr2": chrom[frag2],
+                        "start2": start[frag2],
+                        "end2": end[frag2],
+                        "contacts": counts,
+                    }
+                )
+            mat.to_csv(out, sep="\t", header=False, index=False, lineterminator="\n")
+
+    logger.info(
+        "%d pairs used to build a contact map of %d bins with %d nonzero entries.",
+        contacts["contacts"].sum(),
+        n_frags,
+        n_nonzero,
+    )
+
+
+def consume(chunks):
+    """Exhaust a stream of blocks, so that all its stages are run."""
+    for _ in chunks:
+        pass
@@ -206,6 +206,31 @@ def test_iteralign(runner):
     assert result.exit_code == 0, result.output
 
 
+@pytest.mark.parametrize("aligner, genome", [("bowtie2", "seq"), ("minimap2", "seq.fa")])
+def test_iteralign_persistent_index(runner, aligner, genome):
+    result = runner.invoke(
+        cli,
+        [
+            "iteralign",
+            "-g",
+            f"test_data/genome/{genome}",
+            "-a",
+            aligner,
+            "-t",
+            "2",
+            "-T",
+            "tmp",
+            "-l",
+            "30",
+            "--persistent-index",
+            "-o",
+            f"{OUT}/test.bam",
+            "test_data/sample.reads_for.fastq.gz",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+
 def test_digest(runner):
     su.rmtree(OUT, ignore_errors=True)
     result = runner.invoke(
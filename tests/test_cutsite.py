@@ -0,0 +1,81 @@
+# Test functions for the cutsite submodule
+
+import gzip
+import struct
+
+import pytest
+
+import hicstuff.cutsite as hcc
+
+
+@pytest.mark.parametrize("mode", ["for_vs_rev", "all", "pile"])
+def test_cut_ligation_sites(tmp_path, mode):
+    """Digested reads are identical and in the same order with a worker pool"""
+    digested = {}
+    for n_cpu in (1, 4):
+        digest_for = str(tmp_path / f"for_{n_cpu}.fq.gz")
+        digest_rev = str(tmp_path / f"rev_{n_cpu}.fq.gz")
+        hcc.cut_ligation_sites(
+            "test_data/sample.reads_for.fastq.gz",
+            "test_data/sample.reads_rev.fastq.gz",
+            digest_for,
+            digest_rev,
+            enzyme="DpnII,HinfI",
+            mode=mode,
+            seed_size=20,
+            n_cpu=n_cpu,
+        )
+        with gzip.open(digest_for, "rt") as for_fq, gzip.open(digest_rev, "rt") as rev_fq:
+            digested[n_cpu] = (for_fq.read(), rev_fq.read())
+    assert digested[1][0].count("\n") > 0
+    assert digested[1] == digested[4]
+
+
+@pytest.mark.parametrize("compress_level", [0, 1, 9])
+def test_cut_ligation_sites_bgzf(tmp_path, compress_level):
+    """Digested reads are written as BGZF blocks at any compression level"""
+    digest_for = str(tmp_path / "for.fq.gz")
+    digest_rev = str(tmp_path / "rev.fq.gz")
+    hcc.cut_ligation_sites(
+        "test_data/sample.reads_for.fastq.gz",
+        "test_data/sample.reads_rev.fastq.gz",
+        digest_for,
+        digest_rev,
+        enzyme="DpnII,HinfI",
+        mode="for_vs_rev",
+        seed_size=20,
+        n_cpu=2,
+        compress_level=compress_level,
+    )
+    with open(digest_for, "rb") as for_fq:
+        data = for_fq.read()
+    assert data.endswith(hcc.BGZF_EOF)
+    # Each block holds its own size, blocks must span the whole file
+    offset = 0
+    while offset < len(data):
+        assert data[offset + 12 : offset + 14] == b"BC"
+        offset += struct.unpack_from("<H", data, offset + 16)[0] + 1
+    assert offset == len(data)
+    with gzip.open(digest_for, "rt") as for_fq:
+        assert for_fq.read().count("\n") > 0
+
+
+def test_write_pair_many_sites():
+    """Guard against quadratic stack building on reads with many ligation sites"""
+    n_frags = 40
+    seqs = [f"{'ACGT' * 5}{k:04d}" for k in range(n_frags)]
+    quals = ["F" * len(seq) for seq in seqs]
+    stack_for, stack_rev = [b"@first\n"], [b"@first\n"]
+    new_for, new_rev, n_pairs = stack_for, stack_rev, 0
+    for read in range(20):
+        new_for, new_rev, n_pairs = hcc.write_pair(
+            new_for, new_rev, f"read{read}", seqs, quals, seqs, quals, "all", n_pairs
+        )
+        # Records are appended to the stacks given, which are never copied
+        assert new_for is stack_for
+        assert new_rev is stack_rev
+    # All 2-combinations of the 80 fragments of each pair
+    assert n_pairs == len(new_for) - 1 == len(new_rev) - 1
+    assert n_pairs == 20 * (2 * n_frags) * (2 * n_frags - 1) // 2
+    assert new_for[0] == new_rev[0] == b"@first\n"
+    assert all(isinstance(record, bytes) for record in new_for + new_rev)
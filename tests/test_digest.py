@@ -2,13 +2,17 @@
 # 20190402
 import filecmp
 import os
+import random
 from os.path import join
 from tempfile import NamedTemporaryFile
 
 import pandas as pd
+import pytest
 from Bio import SeqIO
 
 from hicstuff import digest as hcd
+from hicstuff import filter as hcf
+from hicstuff import io as hio
 
 
 def test_write_frag_info():
@@ -45,6 +49,98 @@ def test_attribute_fragments():
     for record in SeqIO.parse("test_data/genome/seq.fa", "fasta"):
         # Get chromosome restriction table
         restriction_table[record.id] = hcd.get_restriction_table(record.seq, "DpnII")
-    hcd.attribute_fragments("test_data/valid.pairs", idx_pairs.name, restriction_table)
+    stats = hcd.attribute_fragments("test_data/valid.pairs", idx_pairs.name, restriction_table)
 
     assert filecmp.cmp("test_data/valid_idx.pairs", idx_pairs.name)
+    assert stats["pairs"] == hio.count_pairs(idx_pairs.name) == 10000
+    assert stats["discarded"] == 0
+    index = hio.read_pairs_index(idx_pairs.name)
+
+    # Attribution by small blocks must give the same output
+    hcd.attribute_fragments(
+        "test_data/valid.pairs", idx_pairs.name, restriction_table, chunksize=333
+    )
+    assert filecmp.cmp("test_data/valid_idx.pairs", idx_pairs.name)
+
+    # Parallel attribution must give the same output
+    stats = hcd.attribute_fragments(
+        "test_data/valid.pairs", idx_pairs.name, restriction_table, threads=3
+    )
+    assert filecmp.cmp("test_data/valid_idx.pairs", idx_pairs.name)
+    assert stats["pairs"] == 10000
+    assert hio.read_pairs_index(idx_pairs.name)["offsets"] == index["offsets"]
+
+    # Histograms of events counted during attribution
+    n_events = {}
+    for chunk in hio.read_pairs_chunks("test_data/valid_idx.pairs"):
+        hcf.count_events(chunk, n_events)
+    for threads in (1, 3):
+        stats = hcd.attribute_fragments(
+            "test_data/valid.pairs",
+            idx_pairs.name,
+            restriction_table,
+            threads=threads,
+            count_events=True,
+        )
+        for event in hcf.EVENT_TYPES:
+            assert (stats["events"][event] == n_events[event]).all()
+
+    # Attributed pairs sorted in runs, by one or several processes, match
+    # the sorted indexed pairs
+    keys = ["chr1", "pos1", "chr2", "pos2"]
+    sorted_pairs = idx_pairs.name + ".sorted"
+    hio.sort_pairs("test_data/valid_idx.pairs", sorted_pairs, keys)
+    for threads, buffer in [(1, "2G"), (1, "300K"), (3, "2G"), (3, "900K")]:
+        stats = hcd.attribute_fragments(
+            "test_data/valid.pairs",
+            idx_pairs.name,
+            restriction_table,
+            threads=threads,
+            sort_keys=keys,
+            buffer=buffer,
+        )
+        assert filecmp.cmp(sorted_pairs, idx_pairs.name, shallow=False)
+        assert stats["pairs"] == hio.count_pairs(idx_pairs.name) == 10000
+    os.unlink(sorted_pairs)
+    os.unlink(hio.get_pairs_index_path(sorted_pairs))
+    os.unlink(idx_pairs.name)
+    os.unlink(hio.get_pairs_index_path(idx_pairs.name))
+
+
+# Bases matching each IUPAC code, to plant degenerate sites in reads
+IUPAC_BASES = {
+    "A": "A",
+    "C": "C",
+    "G": "G",
+    "T": "T",
+    "R": "AG",
+    "Y": "CT",
+    "W": "AT",
+    "N": "ACGT",
+}
+
+
+@pytest.mark.parametrize("enzyme", ["DpnII,HinfI,DdeI,MseI", "HincII", "AvaII,DpnII"])
+def test_gen_ligation_matcher(enzyme):
+    """Test that the ligation matcher finds the same sites as the regex"""
+    regex = hcd.gen_enzyme_religation_regex(enzyme)
+    matcher = hcd.gen_ligation_matcher(enzyme)
+    sites = hcd.gen_religation_sites(enzyme)
+    random.seed(1)
+    for _ in range(1000):
+        seq = "".join(random.choice("ACGT") for _ in range(150))
+        # Plant a few ligation sites in the read
+        for site in random.choices(sites, k=3):
+            site = "".join(random.choice(IUPAC_BASES[b]) for b in site)
+            start = random.randrange(len(seq) - len(site))
+            seq = seq[:start] + site + seq[start + len(site) :]
+        expected = [(m.start(), m.end()) for m in regex.finditer(seq)]
+        assert [(m.start(), m.end()) for m in matcher.finditer(seq)] == expected
+
+
+def test_gen_ligation_matcher_iupac():
+    """Test that only N is a wildcard in ligation sites, as in the regex"""
+    matcher = hcd.gen_ligation_matcher("AvaII")
+    assert matcher.pattern == "GGWCGWCC"
+    assert not list(matcher.finditer("AAGGACGACCAA"))
+    assert [m.start() for m in matcher.finditer("AAGGWCGWCCAA")] == [2]
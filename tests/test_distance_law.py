@@ -151,6 +151,37 @@ def test_get_distance_law():
     os.unlink(distance_law.name)
 
 
+def test_get_distance_law_counts():
+    """Contacts counted by blocks match contacts counted record by record."""
+    xs, ps, _ = hcdl.get_distance_law(pairs_reads_file, fragments_file)
+    bins = hcdl._get_chr_segment_bins_index(fragments)
+    ref = [np.zeros(len(x)) for x in xs]
+    pairs = pd.read_csv(
+        pairs_reads_file,
+        sep="\t",
+        comment="#",
+        header=None,
+        names=["readID", "chr1", "pos1", "chr2", "pos2", "strand1", "strand2", "frag1", "frag2"],
+    )
+    for rec in pairs.itertuples():
+        if rec.strand1 != rec.strand2:
+            continue
+        bin1 = np.searchsorted(bins, rec.frag1, side="right") - 1
+        bin2 = np.searchsorted(bins, rec.frag2, side="right") - 1
+        if bin1 != bin2 or bin1 % 2:
+            continue
+        col = "start_pos" if rec.strand1 == "-" else "end_pos"
+        distance = abs(fragments[col][rec.frag1] - fragments[col][rec.frag2])
+        ref[bin1 // 2][np.searchsorted(xs[bin1 // 2], distance, side="right") - 1] += 1
+    hcdl._normalize_logbins(xs, ref, hcdl._get_chr_segment_length(fragments, bins))
+    for p, r in zip(ps, ref):
+        assert np.allclose(p, r)
+    # Compressed pairs give the same result
+    _, ps_gz, _ = hcdl.get_distance_law(pairs_reads_file + ".gz", fragments_file)
+    for p, p_gz in zip(ps, ps_gz):
+        assert np.allclose(p, p_gz)
+
+
 def test_normalize_distance_law():
     """Test function making the average of distance law."""
     # Test normal conditions.
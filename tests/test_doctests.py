@@ -1,6 +1,7 @@
 import doctest
 
 from hicstuff import (
+    cutsite,
     digest,
     filter,
     hicstuff,
@@ -8,11 +9,13 @@ from hicstuff import (
     iteralign,
     log,
     pipeline,
+    stream,
     view,
 )
 
 
 def test_doctest():
+    doctest.testmod(cutsite)
     doctest.testmod(digest)
     doctest.testmod(filter)
     doctest.testmod(hicstuff)
@@ -20,4 +23,5 @@ def test_doctest():
     doctest.testmod(iteralign)
     doctest.testmod(log)
     doctest.testmod(pipeline)
+    doctest.testmod(stream)
     doctest.testmod(view)
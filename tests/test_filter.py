@@ -6,6 +6,7 @@ import os
 from tempfile import NamedTemporaryFile
 
 from hicstuff import filter as hcf
+from hicstuff import io as hio
 
 
 def hash_file(filename):
@@ -59,7 +60,67 @@ def test_filter_pairs():
     # Test if the filtered pairs file mathes expectations
     assert hash_file("test_data/valid_idx_filtered.pairs") == hash_file(filt_pairs.name)
 
+    # Filtering shards in parallel must give the same output and counts
+    counts = hcf.filter_events("test_data/valid_idx.pairs", filt_pairs.name, 6, 5)
+    shard_counts = hcf.filter_events("test_data/valid_idx.pairs", filt_pairs.name, 6, 5, threads=3)
+    assert shard_counts == counts
+    assert hash_file("test_data/valid_idx_filtered.pairs") == hash_file(filt_pairs.name)
+
     # Remove figure if it was created
     if os.path.isfile(fig_file):
         os.remove(fig_file)
     os.unlink(filt_pairs.name)
+
+
+def test_filter_events_matches_process_read_pair():
+    """Vectorized filtering keeps the records reordered by process_read_pair"""
+    filt_pairs = NamedTemporaryFile("w", delete=False)
+    filt_pairs.close()
+    counts = hcf.filter_events("test_data/valid_idx.pairs", filt_pairs.name, 6, 5)
+    expected = []
+    with open("test_data/valid_idx.pairs") as pairs:
+        for line in pairs:
+            if line.startswith("#"):
+                continue
+            p = hcf.process_read_pair(line.rstrip("\n"))
+            if p["chr1"] == p["chr2"]:
+                if p["frag1"] == p["frag2"] and p["strand1"] == p["strand2"]:
+                    continue
+                if (p["type"] == "-+" and p["nsites"] <= 5) or (
+                    p["type"] == "+-" and p["nsites"] <= 6
+                ):
+                    continue
+            cols = ["readID", "chr1", "pos1", "chr2", "pos2", "strand1", "strand2"]
+            expected.append("\t".join(map(str, [p[c] for c in cols + ["frag1", "frag2"]])))
+    with open(filt_pairs.name) as filtered:
+        records = [line.rstrip("\n") for line in filtered if not line.startswith("#")]
+    assert records == expected
+    assert counts["intra"] + counts["inter"] == len(expected)
+    os.unlink(filt_pairs.name)
+    os.unlink(filt_pairs.name + ".idx")
+
+
+def test_event_histograms():
+    """Thresholds from histograms counted during attribution or sampled over
+    the whole file match thresholds from the first pairs"""
+    chunks = hio.read_pairs_chunks("test_data/valid_idx.pairs", chunksize=1000)
+    n_events = {}
+    for chunk in chunks:
+        hcf.count_events(chunk, n_events)
+    assert hcf.get_thresholds(None, n_events=n_events) == (6, 5)
+
+    # The sample holds all pairs of the file
+    sampled = hcf.sample_events(
+        hio.read_pairs_chunks("test_data/valid_idx.pairs", chunksize=1000), n_pairs=20000
+    )
+    for event in hcf.EVENT_TYPES:
+        assert (sampled[event] == n_events[event]).all()
+    # A smaller sample has the requested size, drawn from the whole file
+    sampled = hcf.sample_events(
+        hio.read_pairs_chunks("test_data/valid_idx.pairs", chunksize=1000), n_pairs=2000
+    )
+    n_sampled = sum(sampled[event].sum() for event in hcf.EVENT_TYPES)
+    n_counted = sum(n_events[event].sum() for event in hcf.EVENT_TYPES)
+    assert 0 < n_sampled <= 2000
+    assert abs(n_sampled / 2000 - n_counted / 10000) < 0.05
+    assert hcf.get_thresholds("test_data/valid_idx.pairs", sample=True) == (6, 5)
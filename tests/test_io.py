@@ -165,3 +165,171 @@ def test_check_fastq_entries():
     assert nreads == 10000
     nreads = hio.check_fastq_entries(filen, threads=2)
     assert nreads == 10000
+
+
+@pytest.mark.parametrize("read_ids", ["keep", "hash", "drop"])
+def test_pairs_binary(tmp_path, read_ids):
+    """Test writing, reading and sorting binary columnar pairs"""
+    pairs = "test_data/valid_idx.pairs"
+    header = hio.get_pairs_header(pairs)
+    exp = pd.concat(hio.read_pairs_chunks(pairs)).reset_index(drop=True)
+    bin_pairs = str(tmp_path / "valid_idx.pairs.bin")
+    n_pairs = hio.write_pairs_binary(
+        hio.read_pairs_chunks(pairs, chunksize=3000), bin_pairs, header, read_ids=read_ids
+    )
+    assert n_pairs == hio.count_pairs(bin_pairs) == exp.shape[0]
+    assert hio.get_pairs_header(bin_pairs) == header
+    obs = pd.concat(hio.read_pairs_chunks(bin_pairs, chunksize=777)).reset_index(drop=True)
+    cols = [col for col in exp.columns if col != "readID"]
+    assert (obs[cols].astype(str) == exp[cols].astype(str)).all().all()
+    if read_ids == "keep":
+        assert obs.readID.tolist() == exp.readID.tolist()
+
+    # Sorting uses the order of chromosomes in the header, in memory or
+    # by merging runs spilled to disk
+    chroms = [line.split()[1] for line in header if line.startswith("#chromsize")]
+    exp = exp.assign(code=exp.chr2.map(chroms.index))
+    exp = exp.sort_values(["code", "pos2"], kind="stable").reset_index(drop=True)
+    for buffer in ["2G", "400K"]:
+        sorted_pairs = str(tmp_path / "sorted.pairs.bin")
+        hio.sort_pairs_binary(
+            bin_pairs,
+            sorted_pairs,
+            keys=["chr2", "pos2"],
+            chunksize=999,
+            tmp_dir=str(tmp_path),
+            buffer=buffer,
+        )
+        obs = pd.concat(hio.read_pairs_chunks(sorted_pairs)).reset_index(drop=True)
+        assert (obs[cols].astype(str) == exp[cols].astype(str)).all().all()
+        if read_ids == "keep":
+            assert obs.readID.tolist() == exp.readID.tolist()
+
+    # Duplicates are dropped while sorting
+    keys = ["chr1", "pos1", "strand1"]
+    stats = {}
+    n_sorted = hio.sort_pairs_binary(
+        bin_pairs, sorted_pairs, keys=keys, buffer="400K", dedup=True, stats=stats
+    )
+    obs = pd.concat(hio.read_pairs_chunks(sorted_pairs)).reset_index(drop=True)
+    exp = pd.concat(hio.read_pairs_chunks(pairs)).reset_index(drop=True)
+    exp = exp.assign(code=exp.chr1.map(chroms.index))
+    exp = exp.sort_values(["code", "pos1", "strand1"], kind="stable")
+    exp = exp.drop_duplicates(keys).reset_index(drop=True)
+    assert n_sorted == exp.shape[0] == obs.shape[0] == stats["pairs"] - stats["duplicates"]
+    assert (obs[cols].astype(str) == exp[cols].astype(str)).all().all()
+
+
+def test_pairs_index(tmp_path):
+    """Test if sidecar indices of written and scanned pairs files agree"""
+    pairs = "test_data/valid_idx.pairs"
+    out = str(tmp_path / "valid_idx.pairs")
+    header = hio.get_pairs_header(pairs)
+    index = hio.new_pairs_index(step=777)
+    with open(out, "w") as handle:
+        handle.write("\n".join(header) + "\n")
+        for chunk in hio.read_pairs_chunks(pairs, chunksize=1000):
+            hio.write_pairs_chunk(chunk, handle, index=index)
+    hio.write_pairs_index(out, index)
+    assert hio.read_pairs_index(out) == hio.index_pairs(out, step=777, block_size=4096)
+    assert hio.count_pairs(out) == index["n_pairs"] == 10000
+    assert len(index["offsets"]) == 13
+    # Offsets point to the start of every step-th record
+    exp = pd.concat(hio.read_pairs_chunks(pairs)).readID.tolist()
+    with open(out, "rb") as handle:
+        for i, offset in enumerate(index["offsets"]):
+            handle.seek(offset)
+            assert handle.readline().decode().split("\t")[0] == exp[i * 777]
+    # Indices of modified files are ignored
+    with open(out, "a") as handle:
+        handle.write("\t".join(["extra"] + exp[:8]) + "\n")
+    assert hio.read_pairs_index(out) is None
+    assert hio.count_pairs(out) == 10001
+
+
+@pytest.mark.parametrize(
+    "keys", [["chr1", "pos1", "chr2", "pos2"], ["readID"], ["chr2", "strand1"]]
+)
+def test_sort_pairs(tmp_path, keys):
+    """Test if the external merge sort gives the same stable order as an in-memory sort"""
+    pairs = "test_data/valid_idx.pairs"
+    header = hio.get_pairs_header(pairs)
+    chroms = [line.split()[1] for line in header if line.startswith("#chromsize")]
+    exp = pd.concat(hio.read_pairs_chunks(pairs)).reset_index(drop=True)
+    sort_cols = [exp[key].map(chroms.index) if key.startswith("chr") else exp[key] for key in keys]
+    exp = exp.iloc[np.lexsort(sort_cols[::-1])].reset_index(drop=True)
+    sorted_file = str(tmp_path / "sorted.pairs")
+    # Spill many runs to disk
+    n_pairs = hio.sort_pairs(
+        pairs, sorted_file, keys, tmp_dir=str(tmp_path), threads=2, buffer="200K"
+    )
+    assert n_pairs == hio.count_pairs(sorted_file) == 10000
+    assert f"#sorted: {'-'.join(keys)}" in hio.get_pairs_header(sorted_file)
+    obs = pd.concat(hio.read_pairs_chunks(sorted_file)).reset_index(drop=True)
+    assert obs.equals(exp)
+    # Records are copied without reformatting
+    with open(pairs) as handle:
+        exp_lines = sorted(line for line in handle if not line.startswith("#"))
+    with open(sorted_file) as handle:
+        assert sorted(line for line in handle if not line.startswith("#")) == exp_lines
+    # Temporary runs are removed
+    assert sorted(os.listdir(tmp_path)) == ["sorted.pairs", "sorted.pairs.idx"]
+
+    # Blank lines are skipped without shifting records against their keys
+    blank_file = str(tmp_path / "blank.pairs")
+    with open(pairs) as src, open(blank_file, "w") as dst:
+        for i, line in enumerate(src):
+            dst.write(line + ("\n" if i % 7 == 0 and not line.startswith("#") else ""))
+    hio.sort_pairs(blank_file, sorted_file, keys, tmp_dir=str(tmp_path), buffer="200K")
+    obs = pd.concat(hio.read_pairs_chunks(sorted_file)).reset_index(drop=True)
+    assert obs.equals(exp)
+
+    # Sorting streams of records in memory gives the same records
+    hio.sort_pairs_chunks(hio.read_pairs_chunks(pairs, chunksize=999), header, sorted_file, keys)
+    obs = pd.concat(hio.read_pairs_chunks(sorted_file)).reset_index(drop=True)
+    assert obs.equals(exp)
+
+
+def test_sort_pairs_dedup(tmp_path):
+    """Test if duplicates spread over several runs are dropped while sorting"""
+    pairs = "test_data/valid_idx.pairs"
+    header = hio.get_pairs_header(pairs)
+    records = pd.concat(hio.read_pairs_chunks(pairs)).reset_index(drop=True)
+    # Every tenth pair is repeated at the end of the stream
+    dups = pd.concat([records, records.iloc[::10], records.iloc[::20]], ignore_index=True)
+    keys = ["chr1", "pos1", "chr2", "pos2", "strand1", "strand2", "frag1", "frag2"]
+    stats = {}
+    sorted_file = str(tmp_path / "dedup.pairs")
+    n_pairs = hio.sort_pairs_chunks(
+        (dups.iloc[i : i + 1500] for i in range(0, dups.shape[0], 1500)),
+        header,
+        sorted_file,
+        keys,
+        tmp_dir=str(tmp_path),
+        buffer="300K",
+        dedup=True,
+        stats=stats,
+    )
+    exp = dups.drop_duplicates(keys).shape[0]
+    assert n_pairs == hio.count_pairs(sorted_file) == exp
+    assert stats == {"pairs": dups.shape[0], "duplicates": dups.shape[0] - exp}
+    obs = pd.concat(hio.read_pairs_chunks(sorted_file))
+    assert not obs.duplicated(keys).any()
+
+
+def test_read_pairs_columns(tmp_path):
+    """Test if selected columns are read by blocks alike from plain and gzipped pairs"""
+    pairs = "test_data/valid_idx.pairs"
+    gz_pairs = str(tmp_path / "valid_idx.pairs.gz")
+    with open(pairs, "rb") as src, gzip.open(gz_pairs, "wb") as dst:
+        dst.write(src.read())
+    columns = ["chr1", "pos1", "frag2"]
+    exp = pd.concat(hio.read_pairs_chunks(pairs)).reset_index(drop=True)
+    for path in [pairs, gz_pairs]:
+        chunks = list(hio.read_pairs_columns(path, columns, chunksize=3000))
+        assert [len(chunk["pos1"]) for chunk in chunks] == [3000, 3000, 3000, 1000]
+        assert all(list(chunk) == columns for chunk in chunks)
+        for col in columns:
+            assert (np.concatenate([chunk[col] for chunk in chunks]) == exp[col]).all()
+    with pytest.raises(ValueError):
+        next(hio.read_pairs_columns(pairs, ["chr1", "mapq"]))
@@ -0,0 +1,141 @@
+# Tests for the iterative alignment submodule
+
+import gzip
+import itertools
+import subprocess as sp
+
+import pysam as ps
+import pytest
+
+import hicstuff.iteralign as hci
+
+FASTQ = "test_data/sample.reads_for.fastq.gz"
+
+
+@pytest.mark.parametrize(
+    "n_chunks, block_size",
+    [(1, 100000), (3, 7), (4, 1000), (8, 3000), (3, 10000)],
+)
+def test_split_fastq(tmp_path, n_chunks, block_size):
+    """Test if reads split into chunks can be put back together in order"""
+    with gzip.open(FASTQ, "rt") as fq:
+        lines = fq.readlines()
+    n_reads = len(lines) // 4
+    paths, obs_reads, read_len = hci._split_fastq(FASTQ, str(tmp_path), n_chunks, block_size)
+    assert obs_reads == n_reads
+    assert read_len == len(lines[1].rstrip())
+    # Empty chunks are not kept
+    assert len(paths) == min(n_chunks, -(-n_reads // block_size))
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(p.split("/")[-1] for p in paths)
+    chunks = []
+    for path in paths:
+        with open(path) as chunk:
+            chunk_lines = chunk.readlines()
+        # Chunks only contain whole records
+        assert len(chunk_lines) % 4 == 0
+        assert all(line.startswith("@") for line in chunk_lines[::4])
+        assert all(line == "+\n" for line in chunk_lines[2::4])
+        chunks.append(iter(chunk_lines))
+    # Blocks of block_size reads are given to the chunks in turn
+    merged = []
+    for chunk in itertools.cycle(chunks):
+        block = list(itertools.islice(chunk, 4 * block_size))
+        if not block:
+            break
+        merged.extend(block)
+    assert merged == lines
+
+
+def _write_alignments(path, reads):
+    """Write (name, flag, mapq) alignments to an unsorted BAM file."""
+    header = {"SQ": [{"SN": "seq1", "LN": 60000}]}
+    with ps.AlignmentFile(path, "wb", header=header) as bam:
+        for i, (name, flag, mapq) in enumerate(reads):
+            read = ps.AlignedSegment(bam.header)
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = 100 * i
+            read.mapping_quality = mapq
+            read.cigarstring = "10M"
+            read.query_sequence = "A" * 10
+            bam.write(read)
+
+
+def _write_reads(path, names):
+    """Write reads with the given names to a fastq file."""
+    with open(path, "w") as fq:
+        fq.writelines(f"@{name}\n{'A' * 20}\n+\n{'F' * 20}\n" for name in names)
+
+
+def test_filter_bamfile(tmp_path):
+    """Test if alignments are matched to reads in lock-step"""
+    bam, reads = str(tmp_path / "aln.bam"), str(tmp_path / "reads.fastq")
+    out, unaligned = str(tmp_path / "out.bam"), str(tmp_path / "unaligned.fastq")
+    _write_reads(reads, ["r1/1", "r2/1", "r3/1", "r4/1"])
+    # Secondary and supplementary alignments are skipped, read suffixes
+    # may be stripped by the aligner
+    _write_alignments(
+        bam,
+        [
+            ("r1", 0, 40),
+            ("r1", 256, 40),
+            ("r2/1", 16, 10),
+            ("r3", 2048, 40),
+            ("r3", 16, 40),
+            ("r4", 4, 0),
+        ],
+    )
+    assert hci._filter_bamfile(bam, out, reads, 30, unaligned_fq=unaligned) == 2
+    with ps.AlignmentFile(out, "rb", check_sq=False) as aligned:
+        assert [r.query_name for r in aligned] == ["r1", "r3"]
+    with ps.FastxFile(unaligned) as fq:
+        assert [entry.name for entry in fq] == ["r2/1", "r4/1"]
+
+
+@pytest.mark.parametrize(
+    "names",
+    [["r1", "r3", "r2"], ["r1", "r2"], ["r1", "r2", "r3", "r4"]],
+)
+def test_filter_bamfile_order(tmp_path, names):
+    """Test if alignments out of the order of reads or missing are rejected"""
+    bam, reads = str(tmp_path / "aln.bam"), str(tmp_path / "reads.fastq")
+    _write_reads(reads, ["r1", "r2", "r3"])
+    _write_alignments(bam, [(name, 0, 40) for name in names])
+    with pytest.raises(ValueError):
+        hci._filter_bamfile(bam, str(tmp_path / "out.bam"), reads)
+
+
+@pytest.mark.parametrize("others", [[], ["other"]])
+def test_resident_index_bwa(tmp_path, monkeypatch, others):
+    """Test if bwa indices are only dropped from shared memory when safe"""
+    loaded, calls = [], []
+
+    def run(cmd, **kwargs):
+        calls.append(cmd[2:])
+        if cmd[2:] == ["-l"]:
+            out = "".join(f"{name}\t1000\n" for name in loaded)
+            return sp.CompletedProcess(cmd, 0, stdout=out)
+        if cmd[2:] == ["-d"]:
+            loaded.clear()
+        else:
+            loaded.append(cmd[2])
+            # Another index is loaded while aligning
+            loaded.extend(others)
+        return sp.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(hci.sp, "run", run)
+    # Concurrent alignments share the index loaded by the first one
+    with hci._resident_index("bwa", "ref", "idx", str(tmp_path), 1):
+        with hci._resident_index("bwa", "ref", "idx", str(tmp_path), 1):
+            assert loaded[0] == "idx"
+        assert "idx" in loaded
+    assert calls.count(["idx"]) == 1
+    assert (["-d"] in calls) == (not others)
+    # Indices loaded by someone else are left loaded
+    loaded[:] = ["idx"]
+    calls.clear()
+    with hci._resident_index("bwa", "ref", "idx", str(tmp_path), 1):
+        pass
+    assert calls == [["-l"]]
+    assert loaded == ["idx"]
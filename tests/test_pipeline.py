@@ -1,12 +1,19 @@
 # Test functions for the pipeline submodule
 
 import filecmp
+import logging
 import os
 import shutil
+import subprocess as sp
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
 
+import pandas as pd
+import pysam as ps
 import pytest
 
+import hicstuff.io as hio
 import hicstuff.pipeline as hpi
 
 MAPPING_PARAMETERS = ("mapping", ["normal", "iterative"])
@@ -16,6 +23,203 @@ ALIGNER_PARAMETERS = ("aligner", ["bowtie2", "bwa", "minimap2"])
 def test_sam2pairs(): ...
 
 
+def test_run_logged(caplog):
+    """Test if concurrent commands are logged separately and failures raised"""
+    busy = "import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end: pass"
+    with caplog.at_level(logging.INFO), ThreadPoolExecutor(2) as pool:
+        jobs = [
+            pool.submit(hpi._run_logged, [sys.executable, "-c", busy], name, 1)
+            for name in ("first", "second")
+        ]
+        for job in jobs:
+            job.result()
+    for name in ("first", "second"):
+        message = next(r.getMessage() for r in caplog.records if r.getMessage().startswith(name))
+        cpu = float(message.split(", ")[1].split("s CPU")[0])
+        # Each command only accounts for its own CPU time
+        assert 0.3 <= cpu < 0.6
+    with pytest.raises(sp.CalledProcessError):
+        hpi._run_logged("exit 3", "failing", 1, shell=True)
+
+
+def _write_test_bam(path, reads):
+    """Write (name, chrom id, pos, reverse, mapq) alignments to a BAM file."""
+    header = {"SQ": [{"SN": "seq1", "LN": 60000}, {"SN": "seq2", "LN": 20000}]}
+    with ps.AlignmentFile(path, "wb", header=header) as bam:
+        for name, ref, pos, reverse, mapq in reads:
+            read = ps.AlignedSegment(bam.header)
+            read.query_name = name
+            read.flag = 16 if reverse else 0
+            read.reference_id = ref
+            read.reference_start = pos
+            read.mapping_quality = mapq
+            read.cigarstring = "10M"
+            read.query_sequence = "A" * 10
+            bam.write(read)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_bam2pairs(tmp_path, batch_size, threads):
+    """Test mate matching, quality filter and flipping of BAM pairs"""
+    bam1, bam2 = str(tmp_path / "for.bam"), str(tmp_path / "rev.bam")
+    out_pairs = str(tmp_path / "valid.pairs")
+    _write_test_bam(
+        bam1,
+        [
+            ("r1/1", 0, 100, False, 40),
+            ("r2/1", 1, 50, True, 40),
+            ("r3/1", 0, 70, False, 40),
+            ("r4/1", 0, 500, False, 10),
+            ("r5/1", 1, 10, False, 40),
+            ("r6/1", 0, 300, False, 40),
+        ],
+    )
+    _write_test_bam(
+        bam2,
+        [
+            ("r1/2", 0, 50, True, 40),
+            ("r2/2", 0, 20, False, 40),
+            ("r4/2", 0, 600, False, 40),
+            ("r5/2", 1, 5, True, 40),
+            ("r6/2", 0, 400, False, 40),
+            ("r7/2", 1, 90, False, 40),
+        ],
+    )
+    stats = hpi.bam2pairs(
+        bam1,
+        bam2,
+        out_pairs,
+        "test_data/info_contigs.txt",
+        batch_size=batch_size,
+        threads=threads,
+    )
+    assert stats == {"reads": 12, "mapped_reads": 11, "unmatched_reads": 2, "pairs": 4}
+    with open(out_pairs) as pairs:
+        records = [line.rstrip("\n").split("\t") for line in pairs if not line.startswith("#")]
+    assert records == [
+        ["r1", "seq1", "51", "seq1", "101", "-", "+"],
+        ["r2", "seq1", "21", "seq2", "51", "+", "-"],
+        ["r5", "seq2", "6", "seq2", "11", "-", "+"],
+        ["r6", "seq1", "301", "seq1", "401", "+", "+"],
+    ]
+    assert hio.read_pairs_index(out_pairs)["n_pairs"] == 4
+
+
+def test_bam2pairs_natural_order(tmp_path):
+    """Test if unmatched reads are skipped in the name order of samtools sort -n"""
+    bam1, bam2 = str(tmp_path / "for.bam"), str(tmp_path / "rev.bam")
+    out_pairs = str(tmp_path / "valid.pairs")
+    # r9 comes before r10 in natural order, but after it in code point order
+    _write_test_bam(bam1, [("r9", 0, 100, False, 40), ("r10", 0, 200, False, 40)])
+    _write_test_bam(bam2, [("r10", 0, 300, False, 40), ("r11", 0, 400, False, 40)])
+    stats = hpi.bam2pairs(bam1, bam2, out_pairs, "test_data/info_contigs.txt", batch_size=1)
+    assert stats["pairs"] == 1
+    assert stats["unmatched_reads"] == 2
+
+
+def test_prefetch():
+    """Test if prefetching threads forward errors and stop with their consumer"""
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    batches = hpi._prefetch(items(), depth=2)
+    assert next(batches) == 0
+    batches.close()
+    n_produced = len(produced)
+    assert n_produced < 10
+    assert len(produced) == n_produced
+
+    def failing():
+        yield 1
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError, match="broken"):
+        list(hpi._prefetch(failing()))
+
+
+SAM_HEADER = [
+    "@HD\tVN:1.6\tSO:unsorted\n",
+    "@SQ\tSN:seq1\tLN:60000\n",
+    "@SQ\tSN:seq2\tLN:20000\n",
+    "@PG\tID:bowtie2\tPN:bowtie2\n",
+]
+
+
+def _sam_record(name, flag, rname, pos, mapq):
+    """Format a SAM record line with placeholder alignment fields."""
+    fields = [name, flag, rname, pos, mapq, "10M", "*", 0, 0, "A" * 10, "I" * 10]
+    return "\t".join(map(str, fields)) + "\n"
+
+
+def test_sam_batches():
+    """Test parsing of SAM records into batches, with flags and unmapped reads"""
+    records = [
+        _sam_record("r1/1", 0, "seq1", 101, 40),
+        _sam_record("r1/1", 256, "seq2", 51, 0),
+        _sam_record("r2/1", 16, "seq2", 201, 10),
+        _sam_record("r3/1", 4, "*", 0, 0),
+        _sam_record("r3/1", 2048, "seq1", 11, 0),
+    ]
+    ref_names, first = hpi._read_sam_header(iter(SAM_HEADER + records))
+    assert ref_names == ["seq1", "seq2"]
+    assert first == records[0]
+    # Secondary and supplementary alignments are skipped
+    batches = list(hpi._sam_batches(records, ref_names, 2))
+    assert [len(batch["name"]) for batch in batches] == [2, 1]
+    assert batches[0]["name"].tolist() == ["r1", "r2"]
+    assert batches[0]["ref"].tolist() == [0, 1]
+    assert batches[0]["pos"].tolist() == [100, 200]
+    assert batches[0]["strand"].tolist() == [False, True]
+    assert batches[0]["mapq"].tolist() == [40, 10]
+    # Unmapped reads have no reference
+    assert batches[1]["name"].tolist() == ["r3"]
+    assert batches[1]["ref"].tolist() == [-1]
+    batch = hpi._sam_records_batch([], pd.Index(ref_names))
+    assert all(len(values) == 0 for values in batch.values())
+
+
+def test_sam_batches_header_only():
+    """Test parsing of a SAM stream without records"""
+    ref_names, first = hpi._read_sam_header(iter(SAM_HEADER))
+    assert ref_names == ["seq1", "seq2"]
+    assert first == ""
+    batches = list(hpi._sam_batches([], ref_names, 2))
+    assert len(batches) == 1
+    assert len(batches[0]["name"]) == 0
+
+
+@pytest.mark.parametrize("returncode", [0, 1])
+def test_align_pairs_truncated(tmp_path, monkeypatch, returncode):
+    """Test if a failed aligner is reported before the mismatch of its reads"""
+    names = ["r1", "r2", "r3"]
+    sam1, sam2 = tmp_path / "for.sam", tmp_path / "rev.sam"
+    sam1.write_text("".join(SAM_HEADER + [_sam_record(n, 0, "seq1", 101, 40) for n in names]))
+    sam2.write_text("".join(SAM_HEADER + [_sam_record(names[0], 16, "seq2", 201, 40)]))
+    # Fake aligners write the SAM file given as reads, the reverse one fails
+    script = "import sys; sys.stdout.write(open(sys.argv[1]).read()); sys.exit(int(sys.argv[2]))"
+
+    def map_cmd(reads, genome, threads, aligner="bowtie2", reorder=False):
+        code = returncode if reads == str(sam2) else 0
+        return [sys.executable, "-c", script, reads, str(code)]
+
+    monkeypatch.setattr(hpi, "_map_cmd", map_cmd)
+    error = sp.CalledProcessError if returncode else ValueError
+    with pytest.raises(error):
+        hpi.align_pairs(
+            str(sam1),
+            str(sam2),
+            "genome",
+            str(tmp_path / "valid.pairs"),
+            "test_data/info_contigs.txt",
+            batch_size=2,
+        )
+
+
 def test_pairs2mat(): ...
 
 
@@ -39,15 +243,18 @@ def test_filter_pcr_dup():
 
     # Remove duplicates from the original pairs file and from the artificially
     # amplified one
-    hpi.filter_pcr_dup("test_data/valid_idx.pairs", dup_rm.name)
-    hpi.filter_pcr_dup(test_pairs.name, test_rm.name)
+    dup_stats = hpi.filter_pcr_dup("test_data/valid_idx.pairs", dup_rm.name)
+    test_stats = hpi.filter_pcr_dup(test_pairs.name, test_rm.name)
 
     # Check if duplicates have been removed correctly (both files are identical
     # after PCR filter)
     assert filecmp.cmp(dup_rm.name, test_rm.name)
+    assert test_stats["pcr_duplicates"] == dup_stats["pcr_duplicates"] + 30
+    assert test_stats["pairs"] == dup_stats["pairs"]
     os.unlink(test_pairs.name)
-    os.unlink(dup_rm.name)
-    os.unlink(test_rm.name)
+    for pairs in (dup_rm.name, test_rm.name):
+        os.unlink(pairs)
+        os.unlink(hio.get_pairs_index_path(pairs))
 
 
 def test_full_pipeline_frags():
@@ -262,3 +469,58 @@ def test_full_pipeline_bin(mapping, aligner):
     shutil.rmtree(out_dir)
     if mapping == "iterative" and aligner == "minimap2":
         shutil.rmtree("test_out/")
+
+
+@pytest.mark.parametrize(*ALIGNER_PARAMETERS)
+def test_full_pipeline_stream_align(aligner):
+    """Pairs made directly from the aligners match pairs made from BAM files"""
+    pairs = {}
+    for stream_align in (False, True):
+        out_dir = f"test_out_stream_{aligner}_{stream_align}"
+        hpi.full_pipeline(
+            input1="test_data/sample.reads_for.fastq.gz",
+            input2="test_data/sample.reads_rev.fastq.gz",
+            genome="test_data/genome/seq.fa.gz",
+            enzyme="DpnII",
+            out_dir=out_dir,
+            aligner=aligner,
+            mat_fmt="graal",
+            no_cleanup=True,
+            force=True,
+            stream_align=stream_align,
+        )
+        with open(os.path.join(out_dir, "tmp", "valid.pairs")) as handle:
+            pairs[stream_align] = sorted(line for line in handle if not line.startswith("#"))
+        shutil.rmtree(out_dir)
+    assert pairs[True] == pairs[False]
+
+
+@pytest.mark.parametrize(*ALIGNER_PARAMETERS)
+@pytest.mark.parametrize("stream_align", [False, True])
+def test_full_pipeline_stream_cutsite(aligner, stream_align):
+    """Reads streamed from cutsite to the aligners give the same pairs"""
+    pairs = {}
+    for stream_cutsite in (False, True):
+        out_dir = f"test_out_cutsite_{aligner}_{stream_align}_{stream_cutsite}"
+        hpi.full_pipeline(
+            input1="test_data/sample.reads_for.fastq.gz",
+            input2="test_data/sample.reads_rev.fastq.gz",
+            genome="test_data/genome/seq.fa.gz",
+            enzyme="DpnII",
+            mapping="cutsite",
+            out_dir=out_dir,
+            aligner=aligner,
+            mat_fmt="graal",
+            no_cleanup=True,
+            force=True,
+            threads=4,
+            stream_align=stream_align,
+            stream_cutsite=stream_cutsite,
+        )
+        tmp_files = os.listdir(os.path.join(out_dir, "tmp"))
+        assert ("digest_for.fq.gz" in tmp_files) != stream_cutsite
+        assert "digest_for.fq" not in tmp_files
+        with open(os.path.join(out_dir, "tmp", "valid.pairs")) as handle:
+            pairs[stream_cutsite] = sorted(line for line in handle if not line.startswith("#"))
+        shutil.rmtree(out_dir)
+    assert pairs[True] == pairs[False]
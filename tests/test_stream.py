@@ -0,0 +1,102 @@
+# Tests for the hicstuff streaming pairs engine.
+
+import collections
+import os
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+import pandas as pd
+
+import hicstuff.io as hio
+import hicstuff.stream as hst
+
+PAIRS_IDX = "test_data/valid_idx.pairs"
+
+
+def test_filter_events():
+    """Test if filtering a stream of blocks gives the same pairs as the reference file"""
+    stats = {}
+    out = NamedTemporaryFile(mode="w", delete=False)
+    out.close()
+    chunks = hio.read_pairs_chunks(PAIRS_IDX, chunksize=1000)
+    hio.write_pairs(
+        hst.filter_events(chunks, 6, 5, stats), out.name, hio.get_pairs_header(PAIRS_IDX)
+    )
+    with open(out.name) as obs, open("test_data/valid_idx_filtered.pairs") as exp:
+        obs_body = [line for line in obs if not line.startswith("#")]
+        exp_body = [line for line in exp if not line.startswith("#")]
+    os.unlink(out.name)
+    assert obs_body == exp_body
+    assert stats["uncuts"] == 9663
+    assert stats["loops"] == 31
+    assert stats["weirds"] == 2
+
+
+def test_remove_duplicates():
+    """Test if duplicates are removed across block boundaries"""
+    pairs = next(hio.read_pairs_chunks(PAIRS_IDX, chunksize=10))
+    # Duplicate each pair so that some copies fall in the next block
+    dups = pairs.loc[pairs.index.repeat(2)].reset_index(drop=True)
+    stats = {}
+    chunks = (dups.iloc[i : i + 3] for i in range(0, dups.shape[0], 3))
+    kept = list(hst.remove_duplicates(chunks, stats))
+    assert sum(chunk.shape[0] for chunk in kept) == 10
+    assert stats["pcr_pairs"] == 20
+    assert stats["pcr_duplicates"] == 10
+
+
+def test_remove_near_duplicates():
+    """Test if near duplicates are removed across block boundaries"""
+    pairs = next(hio.read_pairs_chunks(PAIRS_IDX, chunksize=50))
+    pairs = pairs.sort_values(hst.DUP_COLS).reset_index(drop=True)
+    # Shift a copy of each pair by a few bp on each side
+    shifted = pairs.copy()
+    shifted["pos1"] += 2
+    shifted["pos2"] -= 3
+    dups = pd.concat([pairs, shifted]).sort_values(hst.DUP_COLS, kind="stable")
+    dups = dups.reset_index(drop=True)
+    # Naive reference: compare each pair to all pairs kept before it
+    cols = ["chr1", "chr2", "strand1", "strand2"]
+    kept = []
+    for i, pair in dups.iterrows():
+        if not any(
+            (dups.loc[j, cols] == pair[cols]).all()
+            and abs(dups.pos1[j] - pair.pos1) <= 3
+            and abs(dups.pos2[j] - pair.pos2) <= 3
+            for j in kept
+        ):
+            kept.append(i)
+    stats = {}
+    chunks = (dups.iloc[i : i + 7] for i in range(0, dups.shape[0], 7))
+    obs = pd.concat(list(hst.remove_duplicates(chunks, stats, max_mismatch=3)))
+    assert list(obs.index) == kept
+    assert stats["pcr_pairs"] == 100
+    assert stats["pcr_duplicates"] == 100 - len(kept)
+    # Shifted copies are not duplicates with exact coordinates
+    stats = {}
+    chunks = (dups.iloc[i : i + 7] for i in range(0, dups.shape[0], 7))
+    hst.consume(hst.remove_duplicates(chunks, stats))
+    assert stats["pcr_duplicates"] == 0
+
+
+def test_count_contacts():
+    """Test if contacts counted in blocks match a naive count"""
+    contacts = {}
+    chunks = hio.read_pairs_chunks(PAIRS_IDX, chunksize=700)
+    hst.consume(hst.count_contacts(chunks, contacts))
+    exp = collections.Counter()
+    for chunk in hio.read_pairs_chunks(PAIRS_IDX):
+        exp.update(zip(chunk.frag1, chunk.frag2))
+    obs = dict(zip(zip(contacts["frag1"], contacts["frag2"]), contacts["contacts"]))
+    assert obs == exp
+    assert np.all(np.diff(contacts["frag1"]) >= 0)
+
+    # Complete rows of records sorted by frag1 are written as they come,
+    # unsorted records are spilled to several runs which are merged
+    records = pd.concat(hio.read_pairs_chunks(PAIRS_IDX))
+    for order in [records.sort_values("frag1"), records.sample(frac=1, random_state=1)]:
+        chunks = (order.iloc[i : i + 500] for i in range(0, order.shape[0], 500))
+        obs = {}
+        hst.consume(hst.count_contacts(chunks, obs, max_contacts=300))
+        for col in ["frag1", "frag2", "contacts"]:
+            assert (obs[col] == contacts[col]).all()